@@ -0,0 +1,249 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import scipy
+import skimage
+import tifffile
+from skimage.measure import label
+
+from turmoric.apply_thresholds import apply_li_threshold, apply_all_thresh, create_microglia_mask
+from turmoric.cell_analysis import DEFAULT_PROPERTIES, apply_regionprops, apply_regionprops_recursively
+from turmoric.image_process import normalize_npy_data, read_image
+from turmoric.utils import iter_filepaths
+from turmoric.synthetic import synthetic_microglia_image
+
+"""
+Benchmarks of every stage of the turmoric pipeline on synthetic microglia images.
+
+Run the suite and save the timings as JSON:
+
+    python benchmarks/run_benchmarks.py run -o results.json --size 2048
+
+Compare a run against a stored baseline. The command exits with status 1 if any
+stage is slower than the baseline by more than the tolerance:
+
+    python benchmarks/run_benchmarks.py compare baseline.json results.json
+
+Each stage is timed `repeat` times and the minimum is compared, as the minimum
+is the least affected by other load on the machine. The images are generated
+with a fixed seed, so runs with the same parameters time the same work.
+"""
+
+CHANNEL = 1
+TOLERANCE = 0.2
+
+
+def _write_tif(path, image, channel_axis):
+    """
+    Write a channel-first synthetic image as a tif with channels on `channel_axis`.
+    """
+    tifffile.imwrite(path, np.moveaxis(image, 0, channel_axis))
+
+
+def _write_like_nd2_to_tif(image, path, tile=(512, 512), compression=None):
+    """
+    Write a `(C, Y, X)` stack with the options `nd2_to_tif_streaming` uses.
+    """
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(image, photometric='minisblack', compression=compression,
+                  tile=tuple(tile) if tile is not None else None,
+                  resolution=(1, 1), resolutionunit=tifffile.RESUNIT.MICROMETER,
+                  metadata={'axes': 'CYX'})
+
+
+def _setup(work_dir, size, channels, density, n_images, seed):
+    """
+    Generate the synthetic images and the intermediate files the stages read.
+    """
+    images = [synthetic_microglia_image((size, size), n_channels=channels, density=density,
+                                        channel=CHANNEL, seed=seed + index)
+              for index in range(n_images)]
+
+    # Channel-first stacks, as written by nd2_to_tif, for the end-to-end stage
+    input_folder = os.path.join(work_dir, 'images')
+    os.makedirs(input_folder)
+    for index, image in enumerate(images):
+        _write_tif(os.path.join(input_folder, f'image{index}.tif'), image, channel_axis=0)
+
+    # Channels-last image read by apply_li_threshold and apply_all_thresh
+    single_folder = os.path.join(work_dir, 'single')
+    os.makedirs(single_folder)
+    tif_path = os.path.join(single_folder, 'image0.tif')
+    _write_tif(tif_path, images[0], channel_axis=-1)
+
+    mask = create_microglia_mask(images[0][CHANNEL])
+    mask_path = os.path.join(work_dir, 'image0_mask.npy')
+    np.save(mask_path, mask)
+    labels = label(mask)
+
+    return dict(work_dir=work_dir, images=images, input_folder=input_folder,
+                single_folder=single_folder, tif_path=tif_path, mask_path=mask_path,
+                labels=labels, cells=int(labels.max()))
+
+
+def _stages(context, workers, compression):
+    """
+    The benchmarked callables, keyed by stage name.
+    """
+    work_dir = context['work_dir']
+    image = context['images'][0]
+    normalized = np.empty(context['labels'].shape, dtype=np.uint8)
+
+    def end_to_end():
+        # The path of scripts/apply_single_threshold.py and scripts/apply_regionprops.py
+        output_folder = os.path.join(work_dir, 'end_to_end')
+        shutil.rmtree(output_folder, ignore_errors=True)
+        os.makedirs(output_folder)
+        for file in iter_filepaths(context['input_folder'], '.tif', sort=True):
+            mask = create_microglia_mask(read_image(file, CHANNEL, channel_axis=0))
+            name = os.path.basename(file).replace('.tif', '_li_thresh.npy')
+            np.save(os.path.join(output_folder, name), mask)
+        return apply_regionprops_recursively(output_folder, workers=workers)
+
+    return {
+        'apply_li_threshold': lambda: apply_li_threshold(context['tif_path'], channel=CHANNEL),
+        'apply_all_thresh': lambda: apply_all_thresh(context['single_folder'],
+                                                     os.path.join(work_dir, 'all_thresh'),
+                                                     channel=CHANNEL, render='none'),
+        'apply_all_thresh_render': lambda: apply_all_thresh(context['single_folder'],
+                                                            os.path.join(work_dir, 'all_thresh'),
+                                                            channel=CHANNEL, render='all'),
+        'create_microglia_mask': lambda: create_microglia_mask(image[CHANNEL]),
+        'apply_regionprops': lambda: apply_regionprops(context['mask_path'], list(DEFAULT_PROPERTIES)),
+        'apply_regionprops_fast': lambda: apply_regionprops(context['mask_path'],
+                                                            ['area', 'perimeter', 'circularity']),
+        'normalize_npy_data': lambda: normalize_npy_data(context['labels'], out=normalized),
+        'tif_write': lambda: _write_like_nd2_to_tif(image, os.path.join(work_dir, 'written.tif'),
+                                                    compression=compression),
+        'end_to_end': end_to_end,
+    }
+
+
+def _time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'scikit-image': skimage.__version__,
+        'tifffile': tifffile.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+@click.group()
+def cli():
+    """Benchmark the turmoric pipeline on synthetic microglia images."""
+
+
+@cli.command()
+@click.option('-o', '--output', default='benchmark_results.json', show_default=True,
+              help='JSON file the results are written to.')
+@click.option('--size', default=2048, show_default=True, help='Side of the square images, in pixels.')
+@click.option('--channels', default=3, show_default=True, help='Channels per image.')
+@click.option('--density', default=100.0, show_default=True, help='Cells per megapixel.')
+@click.option('--images', 'n_images', default=4, show_default=True,
+              help='Images in the folder of the end-to-end stage.')
+@click.option('--repeat', default=5, show_default=True, help='Timings per stage.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the first synthetic image.')
+@click.option('--workers', default=None, type=int, help='Workers measuring the masks in the end-to-end stage.')
+@click.option('--compression', default=None, help="Compression of the tif writes, e.g. 'zlib'.")
+@click.option('-s', '--stage', 'selected', multiple=True,
+              help='Stage to run. Repeat to run several; all stages run by default.')
+def run(output, size, channels, density, n_images, repeat, seed, workers, compression, selected):
+    """Time every stage and write the results to a JSON file."""
+    if channels <= CHANNEL:
+        raise click.BadParameter(f'the microglia are in channel {CHANNEL}, so at least '
+                                 f'{CHANNEL + 1} channels are needed.', param_hint='--channels')
+    params = dict(size=size, channels=channels, density=density, images=n_images,
+                  repeat=repeat, seed=seed, workers=workers, compression=compression)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        context = _setup(work_dir, size, channels, density, n_images, seed)
+        stages = _stages(context, workers, compression)
+        unknown = set(selected) - set(stages)
+        if unknown:
+            raise click.BadParameter(f"unknown stages {sorted(unknown)}, choose from {list(stages)}.",
+                                     param_hint='--stage')
+        click.echo(f"{size} x {size} px, {channels} channels, {context['cells']} cells in the mask")
+
+        results = {}
+        for name, func in stages.items():
+            if selected and name not in selected:
+                continue
+            times = _time(func, repeat)
+            results[name] = {'min': min(times), 'median': statistics.median(times), 'times': times}
+            click.echo(f"{name:<26} min {min(times):9.4f} s   median {statistics.median(times):9.4f} s")
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': _environment(),
+        'params': params,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f"Results written to '{output}'.")
+
+
+@cli.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@click.option('-t', '--tolerance', default=TOLERANCE, show_default=True,
+              help='Allowed slowdown, as a fraction of the baseline time.')
+def compare(baseline, current, tolerance):
+    """Compare two result files and exit with status 1 if a stage regressed."""
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+
+    for key in ('size', 'channels', 'density', 'images', 'seed', 'workers', 'compression'):
+        if baseline['params'].get(key) != current['params'].get(key):
+            click.echo(f"Warning: {key} differs ({baseline['params'].get(key)} in the baseline, "
+                       f"{current['params'].get(key)} now), the timings are not comparable.")
+
+    regressions = []
+    click.echo(f"{'stage':<26} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            click.echo(f"{name:<26} {'-':>10} {result['min']:10.4f}      new")
+            continue
+        before, after = baseline['results'][name]['min'], result['min']
+        change = after / before - 1 if before > 0 else 0.0
+        status = ''
+        if change > tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif change < -tolerance:
+            status = 'faster'
+        click.echo(f"{name:<26} {before:10.4f} {after:10.4f} {change:+8.1%}  {status}")
+
+    if regressions:
+        click.echo(f"{len(regressions)} stage(s) slower than the baseline by more than "
+                   f"{tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    click.echo("No regressions.")
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,25 +1,34 @@
 from pathlib import Path
-from turmoric.cell_analysis import apply_regionprops_recursively
+from turmoric.cell_analysis import apply_regionprops_recursively, write_regionprops_table
+from turmoric.instrumentation import Instrumentation, JSONLinesSink, instrumented, stage
 import click
-import numpy as np
 
 # props_list = ('area', 'bbox_area', 'centroid', 'convex_area',
 #               'eccentricity', 'equivalent_diameter', 'euler_number',
 #               'extent', 'filled_area', 'major_axis_length',
 #               'minor_axis_length', 'orientation', 'perimeter', 'solidity')
 
-props_list = ('area', 'perimeter')
+props_list = ('area', 'perimeter', 'circularity')
 
 
 @click.command()
 @click.argument('input_folder', type=click.Path(exists=True,
                                                 readable=True, path_type=Path))
 @click.argument('output_csv', type=click.Path(exists=False, path_type=Path))
-def recursively_apply_regionprops(input_folder, output_csv):
-    regionprops_df = apply_regionprops_recursively(input_folder, props_list)
-    regionprops_df['circularity'] = 4*np.pi*regionprops_df.area/regionprops_df.perimeter**2
+@click.option("--timings", type=click.Path(path_type=Path), default=None,
+              help="Append per-file and per-stage timings to this JSON-lines "
+                   "file (see turmoric.instrumentation.summarize_stages).")
+def recursively_apply_regionprops(input_folder, output_csv, timings):
+    instrumentation = Instrumentation(JSONLinesSink(timings)) if timings else None
+    regionprops_df = apply_regionprops_recursively(input_folder, props_list,
+                                                   instrumentation=instrumentation)
     #regionprops_df['aspect_ratio'] = regionprops_df.major_axis_length/regionprops_df.minor_axis_length
-    regionprops_df.to_csv(output_csv, index=False)
+    # .parquet output stores filename dictionary-encoded
+    with instrumented(instrumentation), stage('write_table', output_csv) as record:
+        write_regionprops_table(regionprops_df, output_csv)
+        record.bytes_written = output_csv.stat().st_size
+    if instrumentation is not None:
+        instrumentation.close()
 
 
 # Example usage
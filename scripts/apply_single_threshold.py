@@ -8,23 +8,12 @@ from skimage.measure import block_reduce, label, regionprops
 from skimage.morphology import remove_small_objects
 from skimage.segmentation import clear_border
 import tifffile as tiff
-
-def create_microglia_mask(image, threshold_method=filters.threshold_li):
-
-    thresh_li = threshold_method(image)
-    binary_li = image > thresh_li
-
-    objects = label(binary_li)
-    objects = clear_border(objects)
-    large_objects = remove_small_objects(objects, min_size=50000)
-    small_objects = label((objects ^ large_objects) > thresh_li)
-
-    binary_li = ndimage.binary_fill_holes(remove_small_objects(small_objects > thresh_li, min_size=500))
-
-    #scaled_img = ((image - image.min()) * (1/(image.max() - image.min()) * 255)).astype('uint8')
-    #hist = np.histogram(scaled_img.flatten(), range=[0,50], bins=50)
-    return binary_li
-
+from turmoric.image_process import read_image
+from turmoric.apply_thresholds import create_microglia_mask
+from turmoric.tiled import apply_li_threshold_tiled
+from turmoric.mask_store import MaskStore
+from turmoric.cache import (CacheManifest, MANIFEST_FILE, function_key,
+                            remove_file)
 
 
 @click.command()
@@ -33,7 +22,25 @@ def create_microglia_mask(image, threshold_method=filters.threshold_li):
 @click.argument('output_folder', type=click.Path(exists=False, path_type=Path))
 @click.option("-s", "--size", type=click.INT, default=71)
 @click.option("-c", "--channel", type=click.INT, default=1)
-def apply_li_threshold(input_folder, output_folder, channel, size):
+@click.option("-m", "--mask-store", is_flag=True, default=False,
+              help="Append masks to a single mask store in OUTPUT_FOLDER "
+                   "instead of writing one .npy per image.")
+@click.option("--cache/--no-cache", default=False,
+              help="Only threshold images that are new or changed since the "
+                   "last run with the same parameters.")
+@click.option("--hash-contents", is_flag=True, default=False,
+              help="With --cache, compare images by content hash instead of "
+                   "size and modification time.")
+@click.option("-t", "--tile-size", type=click.INT, default=None,
+              help="Process images tile by tile with tiles of this size, for "
+                   "whole-slide scans that do not fit in memory.")
+@click.option("--nd2", is_flag=True, default=False,
+              help="Threshold .nd2 files directly instead of .tif files "
+                   "converted with nd2_to_tif.")
+@click.option("-p", "--position", type=click.INT, default=None,
+              help="With --nd2, the stage position to threshold.")
+def apply_li_threshold(input_folder, output_folder, channel, size, mask_store,
+                       cache, hash_contents, tile_size, nd2, position):
     """
     Applies Li thresholding to all .tif images in the input folder
     (and subfolders)
@@ -43,59 +50,113 @@ def apply_li_threshold(input_folder, output_folder, channel, size):
     - input_folder: Path to the folder containing .tif images.
     - output_folder: Path to save the processed binary masks.
     - size: Minimum size of objects to retain in the binary mask.
+    - channel: Index of the microglia channel (channel-first stacks).
+    - mask_store: Write all masks to a MaskStore in the output folder.
+    - cache: Skip images whose mask is up to date according to the cache
+      manifest in the output folder, and delete masks of removed images.
+    - hash_contents: Compare images by SHA-256 digest in the cache manifest.
+    - tile_size: Threshold out of core, writing memory-mapped .npy masks.
+    - nd2: Read .nd2 files instead of .tif files, skipping the conversion.
+    - position: Stage position to read from .nd2 files.
     """
     if not os.path.isdir(input_folder):
         print(f"Error: Input folder '{input_folder}' does not exist.")
         return
 
+    if tile_size is not None and mask_store:
+        print("Error: --tile-size writes .npy masks and cannot be combined "
+              "with --mask-store.")
+        return
+    if tile_size is not None and nd2:
+        print("Error: --tile-size reads .tif files and cannot be combined "
+              "with --nd2.")
+        return
+    extension = ".nd2" if nd2 else ".tif"
+
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
+    store = MaskStore(output_folder, mode='a') if mask_store else None
+
+    manifest = None
+    if cache:
+        manifest = CacheManifest(
+            os.path.join(output_folder, MANIFEST_FILE),
+            function_key(create_microglia_mask, channel=channel, size=size,
+                         method='li', mask_store=mask_store,
+                         tile_size=tile_size, position=position),
+            hash_contents=hash_contents)
+        output_exists = (store.__contains__ if store is not None
+                         else os.path.exists)
+    seen = []
 
     # Walk through all files and subfolders
     for root, _, files in os.walk(input_folder):
         for file in files:
-            if file.endswith(".tif"):
+            if file.endswith(extension):
                 # Full input path
                 input_path = os.path.join(root, file)
 
                 # Create corresponding output subfolder
                 relative_path = os.path.relpath(root, input_folder)
                 output_subfolder = os.path.join(output_folder, relative_path)
-                os.makedirs(output_subfolder, exist_ok=True)
+                if store is None:
+                    os.makedirs(output_subfolder, exist_ok=True)
 
                 # Full output path
                 output_path = os.path.join(output_subfolder,
-                                           file.replace(".tif",
+                                           file.replace(extension,
                                                         "_li_thresh.npy"))
+                store_name = os.path.normpath(os.path.join(
+                    relative_path, file.replace(extension, "_li_thresh")))
+                name = os.path.relpath(input_path, input_folder)
+                seen.append(name)
 
-                try:
-                    # Read the image
-                    img = io.imread(input_path)
-
-                    # Assume the second channel is the microglia channel
-                    # if img.ndim == 3:
-                    #     microglia_im = img[:, :, 1]
-                    # elif img.ndim == 2:
-                    #     microglia_im = img[1, :, :]
-                    # else:
-                    #     microglia_im = img
-
-                    microglia_im = img[1, :, :]
-
-                    # Apply Li threshold
+                if manifest is not None and manifest.is_fresh(
+                        name, input_path, output_exists):
+                    continue
 
+                try:
+                    if tile_size is not None:
+                        # Whole-slide scans: stream tiles from disk
+                        apply_li_threshold_tiled(input_path, output_path, channel,
+                                                 channel_axis=0,
+                                                 tile_size=tile_size,
+                                                 microglia=True)
+                        if manifest is not None:
+                            manifest.record(name, input_path, output_path)
+                        continue
+
+                    # Read the microglia channel once, stacks from
+                    # nd2_to_tif are channel-first
+                    microglia_im = read_image(input_path, channel,
+                                              channel_axis=0,
+                                              position=position)
 
-                    # img = tiff.imread(input_path)
-                    
                     binary_li = create_microglia_mask(microglia_im)
 
+                    if store is not None:
+                        # Append the bit-packed mask to the store
+                        store.append(store_name, binary_li)
+                    else:
                         # Save the binary mask as .npy
-                    np.save(output_path, binary_li)
-                        
+                        np.save(output_path, binary_li)
+
+                    if manifest is not None:
+                        manifest.record(name, input_path,
+                                        store_name if store is not None
+                                        else output_path)
 
                 except Exception as e:
                     print(f"Error processing {input_path}: {e}")
 
+    if manifest is not None:
+        # Drop masks of images that were removed since the last run
+        manifest.evict(seen, remove=remove_file if store is None else
+                       lambda name: store.remove(name) if name in store
+                       else None)
+        manifest.save()
+    if store is not None:
+        store.close()
     print(f"Processing completed. Results are saved in '{output_folder}'.")
 
 
@@ -2,6 +2,7 @@ from pathlib import Path
 import click
 import numpy as np
 import pandas as pd
+from turmoric.cell_analysis import read_regionprops_table, write_regionprops_table
 
 
 
@@ -26,7 +27,7 @@ def recursively_apply_regionprops(output_csv):
     regionprops_dfs = []
 
     for csv in csv_list:
-        df = pd.read_csv(csv)
+        df = read_regionprops_table(csv)
         file_name = csv.split("/")[-1]
         treatment_1 = file_name.split("_")[0]
         treatment_2 = file_name.split("_")[1]
@@ -43,7 +44,7 @@ def recursively_apply_regionprops(output_csv):
 
     regionprops_df['circularity'] = 4*np.pi*regionprops_df["area"]/regionprops_df.perimeter**2
     regionprops_df['aspect_ratio'] = regionprops_df.major_axis_length/regionprops_df.minor_axis_length
-    regionprops_df.to_csv(output_csv, index=False)
+    write_regionprops_table(regionprops_df, output_csv)
 
 
 # Example usage
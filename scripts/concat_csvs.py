@@ -2,15 +2,40 @@ import os
 import pandas as pd
 from pathlib import Path
 import glob
+from turmoric.cell_analysis import read_regionprops_table, write_regionprops_table
+
+def concat_categorical(dataframes):
+    """
+    Concatenate tables keeping the repeated string columns categorical.
+
+    pd.concat falls back to object dtype when categories differ between
+    frames, so the categories are unified first.
+    """
+    for column in ('filename', 'treatment', 'source_file'):
+        if all(column in df.columns for df in dataframes):
+            categories = pd.api.types.union_categoricals(
+                [df[column].astype('category') for df in dataframes]).categories
+            for df in dataframes:
+                df[column] = df[column].astype(pd.CategoricalDtype(categories))
+    return pd.concat(dataframes, ignore_index=True)
+
+
+def find_tables(root_path):
+    """
+    Recursively find regionprops tables (.csv or .parquet) under root_path.
+    """
+    return sorted(list(root_path.rglob("*.csv")) + list(root_path.rglob("*.parquet")))
+
 
 def load_and_concatenate_csvs(root_directory, output_file=None):
     """
-    Recursively search for CSV files, add treatment column based on subdirectory,
-    and concatenate all CSVs into a single DataFrame.
+    Recursively search for CSV and Parquet files, add treatment column based on
+    subdirectory, and concatenate all tables into a single DataFrame.
     
     Args:
-        root_directory (str): Root directory to search for CSV files
-        output_file (str, optional): Path to save the concatenated CSV
+        root_directory (str): Root directory to search for CSV/Parquet files
+        output_file (str, optional): Path to save the concatenated table
+            (.csv or .parquet)
     
     Returns:
         pandas.DataFrame: Concatenated DataFrame with treatment column
@@ -23,7 +48,7 @@ def load_and_concatenate_csvs(root_directory, output_file=None):
         raise ValueError(f"Directory {root_directory} does not exist")
     
     # Find all CSV files recursively
-    csv_files = list(root_path.rglob("*.csv"))
+    csv_files = find_tables(root_path)
     
     if not csv_files:
         print(f"No CSV files found in {root_directory}")
@@ -36,7 +61,7 @@ def load_and_concatenate_csvs(root_directory, output_file=None):
     for csv_file in csv_files:
         try:
             # Load the CSV
-            df = pd.read_csv(csv_file)
+            df = read_regionprops_table(csv_file)
             
             # Get the immediate parent directory name as treatment
             treatment = csv_file.parent.name
@@ -46,10 +71,10 @@ def load_and_concatenate_csvs(root_directory, output_file=None):
                 treatment = root_path.name
             
             # Add treatment column
-            df['treatment'] = treatment
+            df['treatment'] = pd.Categorical([treatment] * len(df))
             
             # Add source file info (optional, can be useful for debugging)
-            df['source_file'] = str(csv_file.relative_to(root_path))
+            df['source_file'] = pd.Categorical([str(csv_file.relative_to(root_path))] * len(df))
             
             dataframes.append(df)
             print(f"Loaded: {csv_file.name} with treatment '{treatment}' ({len(df)} rows)")
@@ -64,14 +89,14 @@ def load_and_concatenate_csvs(root_directory, output_file=None):
     
     # Concatenate all dataframes
     try:
-        combined_df = pd.concat(dataframes, ignore_index=True)
+        combined_df = concat_categorical(dataframes)
         print(f"\nSuccessfully concatenated {len(dataframes)} files")
         print(f"Final dataset shape: {combined_df.shape}")
         print(f"Treatment values: {combined_df['treatment'].unique()}")
         
         # Save to file if specified
         if output_file:
-            combined_df.to_csv(output_file, index=False)
+            write_regionprops_table(combined_df, output_file)
             print(f"Saved concatenated data to: {output_file}")
         
         return combined_df
@@ -85,16 +110,17 @@ def load_csvs_with_custom_treatment(root_directory, treatment_mapping=None, outp
     Alternative version that allows custom treatment mapping based on directory paths.
     
     Args:
-        root_directory (str): Root directory to search for CSV files
+        root_directory (str): Root directory to search for CSV/Parquet files
         treatment_mapping (dict, optional): Custom mapping of directory names to treatment names
-        output_file (str, optional): Path to save the concatenated CSV
+        output_file (str, optional): Path to save the concatenated table
+            (.csv or .parquet)
     
     Returns:
         pandas.DataFrame: Concatenated DataFrame with treatment column
     """
     
     root_path = Path(root_directory)
-    csv_files = list(root_path.rglob("*.csv"))
+    csv_files = find_tables(root_path)
     
     if not csv_files:
         print(f"No CSV files found in {root_directory}")
@@ -104,7 +130,7 @@ def load_csvs_with_custom_treatment(root_directory, treatment_mapping=None, outp
     
     for csv_file in csv_files:
         try:
-            df = pd.read_csv(csv_file)
+            df = read_regionprops_table(csv_file)
             
             # Get treatment name
             dir_name = csv_file.parent.name
@@ -115,8 +141,8 @@ def load_csvs_with_custom_treatment(root_directory, treatment_mapping=None, outp
             else:
                 treatment = dir_name
             
-            df['treatment'] = treatment
-            df['source_file'] = str(csv_file.relative_to(root_path))
+            df['treatment'] = pd.Categorical([treatment] * len(df))
+            df['source_file'] = pd.Categorical([str(csv_file.relative_to(root_path))] * len(df))
             
             dataframes.append(df)
             print(f"Loaded: {csv_file.name} with treatment '{treatment}'")
@@ -126,10 +152,10 @@ def load_csvs_with_custom_treatment(root_directory, treatment_mapping=None, outp
             continue
     
     if dataframes:
-        combined_df = pd.concat(dataframes, ignore_index=True)
+        combined_df = concat_categorical(dataframes)
         
         if output_file:
-            combined_df.to_csv(output_file, index=False)
+            write_regionprops_table(combined_df, output_file)
         
         return combined_df
     
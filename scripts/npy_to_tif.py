@@ -11,6 +11,7 @@ from sklearn.model_selection import train_test_split
 from skimage.segmentation import clear_border
 import skimage
 import tifffile as tiff
+from turmoric.image_process import normalize_npy_data
 from os.path import isfile, join
 
 
@@ -47,6 +48,8 @@ if not os.path.isdir(root_directory):
 output_dir = os.path.join(root_directory, "converted_tiffs")
 os.makedirs(output_dir, exist_ok=True)
 
+buffer = None
+
 # Walk through the directory tree
 for dirpath, dirnames, filenames in os.walk(root_directory):
     for file in filenames:
@@ -58,18 +61,11 @@ for dirpath, dirnames, filenames in os.walk(root_directory):
                 # Load the .npy file
                 image_data = skimage.measure.label(np.load(npy_path))
 
-                # Normalize to uint8 if needed
-                # Handle boolean arrays
-                if image_data.dtype == np.bool_:
-                    # Convert boolean to uint8 (True -> 255, False -> 0)
-                    image_data = (image_data * 255).astype(np.uint8)
-                else:
-                    # Normalize and scale image data to uint8 if it's not already
-                    if image_data.dtype != np.uint8:
-                        image_data = (
-                            255 * (image_data - image_data.min()) / (np.ptp(image_data) + 1e-8)
-                        ).astype(np.uint8)
-                        
+                # Normalize to uint8 if needed, reusing one output buffer
+                if buffer is None or buffer.shape != image_data.shape:
+                    buffer = np.empty(image_data.shape, dtype=np.uint8)
+                image_data = normalize_npy_data(image_data, out=buffer)
+
                 # Construct the output TIFF file path
                 relative_path = os.path.relpath(dirpath, root_directory)
                 tiff_dir = os.path.join(output_dir, relative_path)
@@ -4,6 +4,7 @@ import seaborn as sns
 import numpy as np
 from pathlib import Path
 import os
+from turmoric.cell_analysis import read_regionprops_table
 
 def plot_treatment_means(csv_file, output_dir="plots", figsize=(10, 6)):
     """
@@ -18,7 +19,7 @@ def plot_treatment_means(csv_file, output_dir="plots", figsize=(10, 6)):
     
     # Read the data
     try:
-        df = pd.read_csv(csv_file)
+        df = read_regionprops_table(csv_file)
         print(f"Loaded data with shape: {df.shape}")
     except FileNotFoundError:
         print(f"Error: Could not find file {csv_file}")
@@ -153,7 +154,7 @@ def plot_combined_comparison(csv_file, output_dir="plots", figsize=(15, 5)):
     Create a combined plot showing all three metrics side by side.
     """
     try:
-        df = pd.read_csv(csv_file)
+        df = read_regionprops_table(csv_file)
     except Exception as e:
         print(f"Error reading CSV: {e}")
         return
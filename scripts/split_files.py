@@ -8,18 +8,65 @@ from skimage import io
 import matplotlib.pyplot as plt
 from numpy.linalg import inv
 from sklearn.model_selection import train_test_split
+import click
 from skimage.segmentation import clear_border
+from turmoric.mask_store import MaskStore, is_mask_store
+from turmoric.tiled import TILE_NAME_FORMAT, iter_tiles, write_tiles
 
-def split_files(input_folder, output_folder):
+
+QUADRANT_NAME_FORMAT = '{name}_quad{number}'
+
+
+def split_quadrants(mask):
+    """
+    Split a mask into four quadrants and clear objects touching each quadrant's border.
+    """
+    return [data for _, data in iter_tiles(mask, grid=(2, 2), clear_border=True)]
+
+
+def _name_format(grid, tile_size, overlap):
+    # Keep the historical _quad1.._quad4 names for the default split
+    if grid == (2, 2) and tile_size is None and not overlap:
+        return QUADRANT_NAME_FORMAT
+    return TILE_NAME_FORMAT
+
+
+def split_store(input_store, output_store, grid=(2, 2), tile_size=None, overlap=0):
+    """
+    Split every mask of a MaskStore into tiles appended to another MaskStore.
+    """
+    name_format = _name_format(grid, tile_size, overlap)
+    with MaskStore(input_store) as source, MaskStore(output_store, mode='a') as target:
+        for name in source.keys():
+            try:
+                write_tiles(source.read(name), target, name, grid, tile_size,
+                            overlap, name_format=name_format)
+            except Exception as e:
+                print(f"Error processing {name}: {e}")
+
+
+def split_files(input_folder, output_folder, grid=(2, 2), tile_size=None,
+                overlap=0, store=False):
     """
-    
+    Split each .npy mask into tiles (by default four quadrants) and clear the
+    objects touching the border of each tile. Tiles are saved as .npy files
+    next to each other in output_folder, or appended to a single MaskStore at
+    output_folder if `store` is True or input_folder is a MaskStore.
     """
+    if tile_size is not None:
+        grid = None
+    if is_mask_store(input_folder):
+        split_store(input_folder, output_folder, grid, tile_size, overlap)
+        return
+
     if not os.path.isdir(input_folder):
         print(f"Error: Input folder '{input_folder}' does not exist.")
         return
 
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
+    name_format = _name_format(grid, tile_size, overlap)
+    target = MaskStore(output_folder, mode='a') if store else None
 
     # Walk through all files and subfolders
     for root, _, files in os.walk(input_folder):
@@ -31,42 +78,51 @@ def split_files(input_folder, output_folder):
                 # Create corresponding output subfolder
                 relative_path = os.path.relpath(root, input_folder)
                 output_subfolder = os.path.join(output_folder, relative_path)
-                os.makedirs(output_subfolder, exist_ok=True)
-
-                # Full output path
-                output_path_1 = os.path.join(output_subfolder, file.replace(".npy", "_quad1.npy"))
-                output_path_2 = os.path.join(output_subfolder, file.replace(".npy", "_quad2.npy"))
-                output_path_3 = os.path.join(output_subfolder, file.replace(".npy", "_quad3.npy"))
-                output_path_4 = os.path.join(output_subfolder, file.replace(".npy", "_quad4.npy"))
+                name = os.path.normpath(os.path.join(relative_path,
+                                                     file[:-len(".npy")]))
 
                 try:
-                    file_to_split = np.load(input_path)
-                    quada, quadb = np.array_split(file_to_split, 2)
-                    quad1, quad2 = np.array_split(quada, 2, axis=1)
-                    quad3, quad4 = np.array_split(quadb, 2, axis=1)
-                    
-                    quad1 = clear_border(quad1)
-                    quad2 = clear_border(quad2)
-                    quad3 = clear_border(quad3)
-                    quad4 = clear_border(quad4)
-
-                    
-                    np.save(output_path_1, quad1)
-                    np.save(output_path_2, quad2)
-                    np.save(output_path_3, quad3)
-                    np.save(output_path_4, quad4)
-                
+                    # Tiles are views of the memory-mapped mask
+                    mask = np.load(input_path, mmap_mode='r')
+                    if target is not None:
+                        write_tiles(mask, target, name, grid, tile_size,
+                                    overlap, name_format=name_format)
+                        continue
+
+                    os.makedirs(output_subfolder, exist_ok=True)
+                    for tile, data in iter_tiles(mask, grid, tile_size, overlap,
+                                                 clear_border=True):
+                        tile_name = name_format.format(
+                            name=file[:-len(".npy")], row=tile.row,
+                            col=tile.col, number=tile.number)
+                        np.save(os.path.join(output_subfolder,
+                                             tile_name + ".npy"), data)
+
                 except Exception as e:
                     print(f"Error processing {input_path}: {e}")
 
-# Example usage
-if __name__ == "__main__":
-    import sys
+    if target is not None:
+        target.close()
+
+
+@click.command()
+@click.argument('input_folder', type=click.Path(exists=True))
+@click.argument('output_folder', type=click.Path())
+@click.option("-g", "--grid", type=(int, int), default=(2, 2),
+              help="Number of tile rows and columns. Defaults to quadrants.")
+@click.option("-t", "--tile-size", type=click.INT, default=None,
+              help="Split into square tiles of this size instead of a grid.")
+@click.option("-o", "--overlap", type=click.INT, default=0,
+              help="Pixels by which tiles extend into their neighbours.")
+@click.option("-s", "--store", is_flag=True, default=False,
+              help="Append all tiles to a single mask store in "
+                   "OUTPUT_FOLDER instead of one .npy per tile.")
+def main(input_folder, output_folder, grid, tile_size, overlap, store):
+    """
+    Split the masks in INPUT_FOLDER into tiles saved in OUTPUT_FOLDER.
+    """
+    split_files(input_folder, output_folder, grid, tile_size, overlap, store)
 
-    if len(sys.argv) != 3:
-        print("Usage: python split_files.py <input_folder> <output_folder>")
-        sys.exit(1)
 
-    input_folder = sys.argv[1]
-    output_folder = sys.argv[2]
-    split_files(input_folder, output_folder)
+if __name__ == "__main__":
+    main()
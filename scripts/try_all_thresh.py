@@ -7,9 +7,13 @@ from pathlib import Path
 @click.argument('input_folder', type=click.Path(exists=True, readable=True,
                                                 path_type=Path))
 @click.argument('output_folder', type=click.Path(exists=False, path_type=Path))
-def apply_all_thresholds(input_folder, output_folder):
+@click.option("-r", "--render", type=click.Choice(['all', 'sample', 'none']), default='all')
+@click.option("--sample-every", type=click.INT, default=10)
+@click.option("--store-masks", is_flag=True, default=False)
+def apply_all_thresholds(input_folder, output_folder, render, sample_every, store_masks):
 
-    apply_all_thresh(input_folder, output_folder)
+    apply_all_thresh(input_folder, output_folder, render=render,
+                     sample_every=sample_every, store_masks=store_masks)
 
 
 if __name__ == "__main__":
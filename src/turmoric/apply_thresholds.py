@@ -1,10 +1,19 @@
 import os
+import time
 import numpy as np
-from skimage import io, filters, morphology
+import pandas as pd
+from skimage import io, filters, morphology, exposure
 from scipy import ndimage
-from turmoric.utils import recursively_get_all_filepaths
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from turmoric.utils import iter_filepaths, run_batch, BatchSummary, FileResult
+from turmoric.cache import CacheManifest, MANIFEST_FILE, function_key, remove_file
+from turmoric.image_process import read_image, validate_tif_channel
+from turmoric.instrumentation import Instrumentation, instrumented, stage
+from turmoric.mask_store import MaskStore, pack_mask
 import matplotlib.pyplot as plt
-from typing import Callable
+from typing import Callable, Optional
+from concurrent.futures import Executor
 from skimage.filters import threshold_isodata
 from skimage.filters import threshold_li
 from skimage.filters import threshold_mean
@@ -13,17 +22,430 @@ from skimage.filters import threshold_otsu
 from skimage.filters import threshold_triangle
 from skimage.filters import threshold_yen
 from collections import OrderedDict
-from collections.abc import Iterable
 
 
-def apply_all_thresh(input_folder: str, output_folder: str, channel: int=1, figsize: tuple=(10, 8)) -> None:
+THRESHOLD_METHODS = ('Isodata', 'Li', 'Mean', 'Minimum', 'Otsu', 'Triangle', 'Yen')
+MASKS_FOLDER = 'threshold_masks'
+THRESHOLDS_FILE = 'thresholds.csv'
+THUMBNAILS_FILE = 'thumbnails.npy'
+
+_REFERENCE_METHODS = OrderedDict(
+    {
+        'Isodata': threshold_isodata,
+        'Li': threshold_li,
+        'Mean': threshold_mean,
+        'Minimum': threshold_minimum,
+        'Otsu': threshold_otsu,
+        'Triangle': threshold_triangle,
+        'Yen': threshold_yen,
+    }
+)
+
+
+def _threshold_triangle_from_histogram(counts: np.ndarray, bin_centers: np.ndarray) -> float:
+    """
+    Triangle threshold computed from a precomputed histogram.
+
+    Mirrors `skimage.filters.threshold_triangle`, which only accepts an image.
+    """
+    nbins = len(counts)
+    arg_peak_height = np.argmax(counts)
+    peak_height = counts[arg_peak_height]
+    arg_low_level, arg_high_level = np.flatnonzero(counts)[[0, -1]]
+    if arg_low_level == arg_high_level:
+        return bin_centers[arg_low_level]
+
+    # Flip so that the long tail of the histogram is always on the right
+    flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+    if flip:
+        counts = counts[::-1]
+        arg_low_level = nbins - arg_high_level - 1
+        arg_peak_height = nbins - arg_peak_height - 1
+
+    width = arg_peak_height - arg_low_level
+    x1 = np.arange(width)
+    y1 = counts[x1 + arg_low_level]
+
+    # Normalize to get the distance of each histogram point to the peak-tail line
+    norm = np.sqrt(peak_height**2 + width**2)
+    peak_height = peak_height / norm
+    width = width / norm
+    length = peak_height * x1 - width * y1
+    arg_level = np.argmax(length) + arg_low_level
+
+    if flip:
+        arg_level = nbins - arg_level - 1
+
+    return bin_centers[arg_level]
+
+
+def _threshold_li_from_histogram(counts: np.ndarray, bin_centers: np.ndarray,
+                                 tolerance: Optional[float]=None) -> float:
+    """
+    Li threshold computed from a precomputed histogram.
+
+    For integer images with one bin per intensity (as returned by
+    `skimage.exposure.histogram`) this reproduces `skimage.filters.threshold_li`
+    exactly. For binned float histograms it is an estimate that can be refined on
+    the raw values with `threshold_li(image, initial_guess=...)`.
+    """
+    image_min = bin_centers[0]
+    centers = bin_centers - image_min
+    weights = counts.astype('float32', copy=False)
+    if tolerance is None:
+        tolerance = 0.5 if np.issubdtype(bin_centers.dtype, np.integer) else np.min(np.diff(centers)) / 2
+
+    t_next = np.sum(counts * centers) / np.sum(counts)
+    t_curr = -2 * tolerance
+    while abs(t_next - t_curr) > tolerance:
+        t_curr = t_next
+        foreground = centers > t_curr
+        background = ~foreground
+        mean_fore = np.average(centers[foreground], weights=weights[foreground])
+        mean_back = np.average(centers[background], weights=weights[background])
+        if mean_back == 0:
+            break
+        t_next = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+
+    return t_next + image_min
+
+
+def _compute_thresholds(image: np.ndarray, nbins: int=256) -> tuple:
+    """
+    Compute all global thresholds from a single intensity histogram.
+
+    Returns
+    -------
+    thresholds : OrderedDict
+        Method name to threshold value for every method that succeeded.
+    errors : OrderedDict
+        Method name to the exception raised by every method that failed.
+    """
+    thresholds = OrderedDict()
+    errors = OrderedDict()
+
+    flat = image.reshape(-1)
+    if flat.size == 0 or np.all(flat == flat[0]):
+        # Degenerate histogram, defer to skimage's own special cases
+        for name, func in _REFERENCE_METHODS.items():
+            try:
+                thresholds[name] = func(image)
+            except Exception as e:
+                errors[name] = e
+        return thresholds, errors
+
+    counts, bin_centers = exposure.histogram(flat, nbins, source_range='image')
+    hist = (counts, bin_centers)
+    is_integer = np.issubdtype(image.dtype, np.integer)
+
+    def li():
+        estimate = _threshold_li_from_histogram(counts, bin_centers)
+        if is_integer:
+            return estimate
+        # Refine on the raw values, starting from the histogram estimate
+        if bin_centers[0] < estimate < bin_centers[-1]:
+            return threshold_li(image, initial_guess=estimate)
+        return threshold_li(image)
+
+    def mean():
+        if is_integer:
+            return np.sum(counts * bin_centers.astype(np.int64)) / flat.size
+        return np.mean(image)
+
+    engine = OrderedDict(
+        {
+            'Isodata': lambda: threshold_isodata(hist=hist),
+            'Li': li,
+            'Mean': mean,
+            'Minimum': lambda: threshold_minimum(hist=hist),
+            'Otsu': lambda: threshold_otsu(hist=hist),
+            'Triangle': lambda: _threshold_triangle_from_histogram(counts, bin_centers),
+            'Yen': lambda: threshold_yen(hist=hist),
+        }
+    )
+    for name, func in engine.items():
+        try:
+            thresholds[name] = func()
+        except Exception as e:
+            errors[name] = e
+    return thresholds, errors
+
+
+def compute_all_thresholds(image: np.ndarray, nbins: int=256) -> dict:
+    """
+    Compute the Isodata, Li, Mean, Minimum, Otsu, Triangle and Yen thresholds of an image.
+
+    The intensity histogram is computed once and shared by all histogram-based
+    methods, instead of each `skimage.filters.threshold_*` call building its own.
+    No figures are created.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D grayscale image (e.g. a single channel of a `.tif`).
+    nbins : int, optional
+        Number of histogram bins for float images. Ignored for integer images, which
+        get one bin per intensity value (default is 256).
+
+    Returns
+    -------
+    thresholds : dict
+        Mapping of method name (see `THRESHOLD_METHODS`) to threshold value. Methods that
+        fail on this image (e.g. Minimum on a histogram without two peaks) map to NaN.
+
+    Notes
+    -----
+    - For integer images the values are identical to the corresponding
+      `skimage.filters.threshold_*` functions.
+    - Li is refined on the raw pixel values for float images, starting from the
+      histogram estimate, so it can converge to a slightly different value than
+      `threshold_li` started from the image mean.
+
+    Examples
+    --------
+    >>> from skimage import data
+    >>> thresholds = compute_all_thresholds(data.camera())
+    >>> binary_otsu = data.camera() > thresholds['Otsu']
+    """
+    thresholds, errors = _compute_thresholds(image, nbins=nbins)
+    return {name: thresholds.get(name, np.nan) for name in THRESHOLD_METHODS}
+
+
+def _thumbnail_step(shape: tuple, thumbnail_size: Optional[int]) -> int:
+    """
+    Integer stride that brings the longest side of `shape` down to at most `thumbnail_size`.
+    """
+    if thumbnail_size is None:
+        return 1
+    return max(1, int(np.ceil(max(shape[:2]) / thumbnail_size)))
+
+
+def _read_2d_image(file: str, channel: int, position: Optional[int]=None) -> np.ndarray:
+    """
+    Read one channel of an image with `read_image` and check that it is 2D.
+
+    Without a `position`, `.nd2` files return every stage position and time point,
+    which a global threshold would silently treat as one image.
+    """
+    image = read_image(file, channel, position=position)
+    if image.ndim != 2:
+        raise ValueError(f"Image {file} has shape {image.shape} after selecting the channel, "
+                         f"but thresholding needs a 2D image. Set 'position' to select one "
+                         f"stage position of a multi-position file.")
+    return image
+
+
+def _render_threshold_comparison(image: np.ndarray, masks: dict, errors: dict, title: str,
+                                 output_path: str, figsize: tuple=(10, 8)) -> None:
+    """
+    Draw the original image and one panel per thresholding method and save the figure.
+
+    `image` and `masks` are expected to be thumbnails already; methods listed in
+    `errors` are drawn as a text panel with the exception name.
+    """
+    fig, ax = plt.subplots(nrows=4, ncols=2, figsize=figsize, sharex=True, sharey=True)
+    ax = ax.flatten()
+    ax[0].imshow(image)
+    ax[0].set_title('Original Image')
+    ax[0].axis('off')
+
+    i = 1
+    for name in THRESHOLD_METHODS:
+        ax[i].set_title(f'{name}')
+        if name in masks:
+            ax[i].imshow(masks[name])
+            ax[i].axis('off')
+        else:
+            ax[i].text(
+                0.5,
+                0.5,
+                f"{errors[name]}",
+                ha="center",
+                va="center",
+                transform=ax[i].transAxes,
+            )
+        i += 1
+
+    ax[-1].axis('off')  # Hide the last unused subplot
+    fig.suptitle(title, fontsize=16)
+    fig.savefig(output_path)
+    plt.close(fig)
+
+
+def save_threshold_masks(store: MaskStore, name: str, image: np.ndarray, thresholds: dict) -> list:
+    """
+    Append the binary masks of all thresholding methods for one image to a `MaskStore`.
+
+    Each mask is bit-packed along its rows, so the seven masks of an image take less
+    space than a single boolean array, and the masks of every image share the two
+    files of the store. Methods that failed on the image have no mask, and a mask
+    stored for them by an earlier run is removed.
+
+    Parameters
+    ----------
+    store : MaskStore
+        Store opened with `mode='a'`.
+    name : str
+        Name of the image. Its masks are stored as `<name>/<method>`.
+    image : ndarray
+        2D grayscale image that was thresholded.
+    thresholds : dict
+        Method name to threshold value for the methods that succeeded.
+
+    Returns
+    -------
+    list of str
+        Names of the appended masks.
+
+    Examples
+    --------
+    >>> with MaskStore('results/threshold_masks', mode='a') as store:
+    ...     save_threshold_masks(store, 'slice1/image1', microglia_im, thresholds)
+    """
+    names = []
+    for method in THRESHOLD_METHODS:
+        if method in thresholds:
+            store.append(f'{name}/{method}', image > thresholds[method])
+            names.append(f'{name}/{method}')
+        elif f'{name}/{method}' in store:
+            store.remove(f'{name}/{method}')
+    return names
+
+
+def _append_thumbnail(path: str, thumbnail: np.ndarray) -> int:
+    """
+    Append a thumbnail to the thumbnail file of a mask store and return its byte offset.
+
+    Thumbnails are written back to back in `.npy` format, so each one is read with
+    `np.load` after seeking to its offset.
+    """
+    with open(path, 'ab') as f:
+        offset = f.tell()
+        np.save(f, thumbnail)
+    return offset
+
+
+def _read_thumbnail(path: str, offset: int) -> np.ndarray:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return np.load(f)
+
+
+def _threshold_row(output_folder: str, name: str) -> pd.Series:
+    """
+    Row of `name` in the `thresholds.csv` written by `apply_all_thresh`.
+    """
+    table = pd.read_csv(os.path.join(output_folder, THRESHOLDS_FILE))
+    rows = table[table['name'] == name]
+    if rows.empty:
+        raise KeyError(f"No thresholds for image {name!r} in {output_folder}.")
+    return rows.iloc[-1]
+
+
+def load_threshold_masks(output_folder: str, name: str) -> tuple:
+    """
+    Load the masks and threshold values of one image stored by `apply_all_thresh`.
+
+    Parameters
+    ----------
+    output_folder : str
+        Output folder of `apply_all_thresh(..., store_masks=True)`.
+    name : str
+        Name of the image: its path relative to the input folder, without the
+        extension (the `name` column of `thresholds.csv`).
+
+    Returns
+    -------
+    masks : OrderedDict
+        Method name to 2D boolean mask, for the methods that succeeded.
+    thresholds : OrderedDict
+        Method name to threshold value, NaN for methods that failed.
+
+    Examples
+    --------
+    >>> masks, thresholds = load_threshold_masks('results', 'slice1/image1')
+    >>> masks['Otsu'].sum(), thresholds['Otsu']
+    """
+    row = _threshold_row(output_folder, name)
+    thresholds = OrderedDict((method, float(row[method])) for method in THRESHOLD_METHODS)
+    masks = OrderedDict()
+    with MaskStore(os.path.join(output_folder, MASKS_FOLDER)) as store:
+        for method in THRESHOLD_METHODS:
+            if f'{name}/{method}' in store:
+                masks[method] = store.read(f'{name}/{method}')
+    return masks, thresholds
+
+
+def render_threshold_comparison(output_folder: str, name: str, output_path: Optional[str]=None,
+                                figsize: tuple=(10, 8)) -> str:
+    """
+    Render the threshold comparison panel of one image on demand from the mask store.
+
+    The panel is drawn from the thumbnail that `apply_all_thresh(..., store_masks=True)`
+    saved next to the masks, at the thumbnail resolution chosen then, and only the
+    matching rows of each mask are unpacked. The original image is not read again,
+    so it no longer needs to exist, and rendering cost depends on the thumbnail size
+    rather than the size of the image.
+
+    Parameters
+    ----------
+    output_folder : str
+        Output folder of `apply_all_thresh(..., store_masks=True)`.
+    name : str
+        Name of the image, as in `load_threshold_masks`.
+    output_path : str, optional
+        Path of the figure to write. Defaults to `<image>_all_thresh.tif` in
+        `output_folder`, as written by `apply_all_thresh`.
+    figsize : tuple of int, optional
+        Size of the matplotlib figure (default is (10, 8)).
+
+    Returns
+    -------
+    output_path : str
+        Path of the written figure.
+
+    Examples
+    --------
+    >>> apply_all_thresh('data/tifs', 'results', render='none', store_masks=True)
+    >>> render_threshold_comparison('results', 'slice1/image1')
+    """
+    row = _threshold_row(output_folder, name)
+    if pd.isna(row.get('thumbnail_offset', np.nan)):
+        raise KeyError(f"Image {name!r} was last processed without store_masks=True.")
+    if output_path is None:
+        output_path = os.path.join(output_folder, os.path.basename(name) + '_all_thresh.tif')
+
+    store_path = os.path.join(output_folder, MASKS_FOLDER)
+    thumbnail = _read_thumbnail(os.path.join(store_path, THUMBNAILS_FILE), int(row['thumbnail_offset']))
+    step = int(row['thumbnail_step'])
+    masks = OrderedDict()
+    errors = OrderedDict()
+    with MaskStore(store_path) as store:
+        for method in THRESHOLD_METHODS:
+            if f'{name}/{method}' in store:
+                masks[method] = store.read(f'{name}/{method}', rows=slice(None, None, step))[:, ::step]
+            else:
+                errors[method] = 'Failed'
+
+    title = f"Thresholding Comparison for {os.path.basename(row['filename'])}"
+    _render_threshold_comparison(thumbnail, masks, errors, title, output_path, figsize=figsize)
+    return output_path
+
+
+def apply_all_thresh(input_folder: str, output_folder: str, channel: int=1, figsize: tuple=(10, 8),
+                     render: str='all', sample_every: int=10, store_masks: bool=False,
+                     thumbnail_size: Optional[int]=512, file_types: tuple=('.tif',),
+                     position: Optional[int]=None) -> Optional[pd.DataFrame]:
     """
     Apply multiple thresholding algorithms to .tif images and save comparison plots.
 
-    This function loads all `.tif` images found recursively in the input folder.
+    This function loads all `.tif` images (or other `file_types`) found recursively in
+    the input folder.
     For each image, it extracts the specified channel (if multi-channel), applies a suite
-    of thresholding methods using `skimage.filters.try_all_threshold`, and saves the resulting
-    comparison figure to the output folder.
+    of thresholding methods (see `compute_all_thresholds`), and saves the resulting
+    comparison figure to the output folder. Figures can be restricted to a sample of
+    the images, or skipped entirely, in which case the masks and threshold values can
+    be written to a compact store instead.
 
     Parameters
     ----------
@@ -35,18 +457,48 @@ def apply_all_thresh(input_folder: str, output_folder: str, channel: int=1, figs
         Index of the image channel to process if the image is multi-channel (default is 1).
     figsize : tuple of int, optional
         Size of the matplotlib figure for the thresholding comparison plot (default is (10, 8)).
+    render : {'all', 'sample', 'none'}, optional
+        Which images get a comparison figure: every image (default), every
+        `sample_every`-th image, or none.
+    sample_every : int, optional
+        Sampling interval used when `render='sample'` (default is 10).
+    store_masks : bool, optional
+        If True, append the bit-packed masks of every method for every image to a
+        single `MaskStore` in `output_folder/threshold_masks` (see
+        `save_threshold_masks`), together with the thumbnail of every image. Panels
+        for these images can be rendered later with `render_threshold_comparison`.
+    thumbnail_size : int or None, optional
+        Longest side, in pixels, of the images drawn in each panel. Images are downsampled
+        by striding before plotting, and stored at this size with `store_masks`. None
+        draws the full-resolution image (default is 512).
+    file_types : tuple of str, optional
+        File endings of the images to process, each with a reader registered in
+        `turmoric.image_process` (default is `('.tif',)`). Pass `('.nd2',)` to threshold
+        ND2 acquisitions directly, without converting them with `nd2_to_tif`.
+    position : int, optional
+        Stage position to read from `.nd2` files (see `read_image`). Required for
+        files with more than one position, which otherwise fail with a ValueError.
 
     Returns
     -------
-    None
-        This function does not return anything. It saves output images to the specified folder.
+    thresholds_df : pandas.DataFrame or None
+        With `store_masks` or `render='none'`, one row per image with `filename` and
+        `name` columns and one column per method holding the threshold value (NaN if
+        the method failed). With `store_masks`, `channel`, `position`,
+        `thumbnail_offset` and `thumbnail_step` columns record how the image was read
+        and where its thumbnail is stored. The rows are also merged into
+        `thresholds.csv` in the output folder, replacing earlier rows of the same
+        images, so that repeated runs into one folder keep the rows of every image in
+        the mask store. Otherwise None, and only the figures are written.
 
     Notes
     -----
-    - Requires `recursively_get_all_filepaths` function to retrieve file paths recursively.
-    - Uses `skimage.io.imread` to read images and `skimage.filters.try_all_threshold` to apply
-      thresholding methods.
+    - Collects file paths recursively with `iter_filepaths`.
+    - Uses `read_image` to read images and `compute_all_thresholds` to compute all
+      thresholds from a single histogram per image.
     - Output images are saved with filenames ending in `_all_thresh.tif`.
+    - Images are named by their path relative to `input_folder`, without the
+      extension, in the mask store and in `thresholds.csv`.
 
     Examples
     --------
@@ -57,80 +509,75 @@ def apply_all_thresh(input_folder: str, output_folder: str, channel: int=1, figs
 
     This will process all `.tif` images in 'data/microscopy_images', apply thresholding to channel 0,
     and save the comparison plots in 'results/thresholding_plots'.
+
+    >>> apply_all_thresh(input_dir, output_dir, render='sample', sample_every=50, store_masks=True)
+
+    This stores the masks of every image and renders one comparison plot per 50 images.
     """
+    if render not in ('all', 'sample', 'none'):
+        raise ValueError(f"render must be 'all', 'sample' or 'none', got {render!r}.")
 
-    def thresh(func):
-        """
-        A wrapper function to return a thresholded image.
-        """
+    os.makedirs(output_folder, exist_ok=True)
+    record_thresholds = store_masks or render == 'none'
+    store = MaskStore(os.path.join(output_folder, MASKS_FOLDER), mode='a') if store_masks else None
+    thumbnails_path = os.path.join(output_folder, MASKS_FOLDER, THUMBNAILS_FILE)
 
-        def wrapper(im):
-            return im > func(im)
+    rows = []
+    try:
+        file_list = iter_filepaths(input_folder, file_types, case_sensitive=True)
+        for index, file in enumerate(file_list):
+            microglia_im = _read_2d_image(file, channel, position=position)
+            thresholds, errors = _compute_thresholds(microglia_im)
 
-        try:
-            wrapper.__orifunc__ = func.__orifunc__
-        except AttributeError:
-            wrapper.__orifunc__ = func.__module__ + '.' + func.__name__
-        return wrapper
+            name = os.path.splitext(os.path.relpath(file, input_folder))[0]
+            step = _thumbnail_step(microglia_im.shape, thumbnail_size)
+            thumbnail = microglia_im[::step, ::step]
+            if record_thresholds:
+                row = {'filename': file, 'name': name,
+                       **{method: thresholds.get(method, np.nan) for method in THRESHOLD_METHODS}}
+                rows.append(row)
+            if store is not None:
+                save_threshold_masks(store, name, microglia_im, thresholds)
+                row.update(channel=channel, position=position,
+                           thumbnail_offset=_append_thumbnail(thumbnails_path, thumbnail),
+                           thumbnail_step=step)
 
-    # Global algorithms.
-    methods = OrderedDict(
-        {
-            'Isodata': thresh(threshold_isodata),
-            'Li': thresh(threshold_li),
-            'Mean': thresh(threshold_mean),
-            'Minimum': thresh(threshold_minimum),
-            'Otsu': thresh(threshold_otsu),
-            'Triangle': thresh(threshold_triangle),
-            'Yen': thresh(threshold_yen),
-        }
-    )
-    os.makedirs(output_folder, exist_ok=True)
+            if render == 'none' or (render == 'sample' and index % sample_every != 0):
+                continue
+
+            base_name = os.path.basename(file)
+            masks = OrderedDict((method, thumbnail > value) for method, value in thresholds.items())
+            error_names = {method: type(error).__name__ for method, error in errors.items()}
+            output_path = os.path.join(output_folder, os.path.splitext(base_name)[0] + '_all_thresh.tif')
+            _render_threshold_comparison(thumbnail, masks, error_names,
+                                         f'Thresholding Comparison for {base_name}',
+                                         output_path, figsize=figsize)
+    finally:
+        if store is not None:
+            store.close()
+
+    if not record_thresholds:
+        return
+    columns = ['filename', 'name', *THRESHOLD_METHODS]
+    if store_masks:
+        columns += ['channel', 'position', 'thumbnail_offset', 'thumbnail_step']
+    thresholds_df = pd.DataFrame(rows, columns=columns)
+
+    # Like the mask store, the table accumulates over runs and later rows win
+    table = thresholds_df
+    thresholds_path = os.path.join(output_folder, THRESHOLDS_FILE)
+    if os.path.isfile(thresholds_path):
+        previous = pd.read_csv(thresholds_path)
+        if not thresholds_df.empty:
+            previous = pd.concat([previous, thresholds_df], ignore_index=True)
+        table = previous.drop_duplicates(subset='name', keep='last')
+    table.to_csv(thresholds_path, index=False)
+    return thresholds_df
 
-    file_list = recursively_get_all_filepaths(input_folder, ".tif")
-    for file in file_list:
-        im = io.imread(file)
-        microglia_im = im[:, :, channel] if im.ndim == 3 else im
-        # fig, ax = filters.try_all_threshold(microglia_im,
-        #                                     figsize=figsize,
-        #                                     verbose=False)
-
-        fig, ax = plt.subplots(nrows=4, ncols=2, figsize=figsize, sharex=True, sharey=True)
-        ax = ax.flatten()
-        ax[0].imshow(microglia_im)
-        ax[0].set_title('Original Image')
-        ax[0].axis('off')
-
-        i = 1
-        for name, func in methods.items():
-            ax[i].set_title(f'{name}')
-            try:
-                ax[i].imshow(func(microglia_im))
-                ax[i].axis('off')
-            except Exception as e:
-                ax[i].text(
-                    0.5,
-                    0.5,
-                    f"{type(e).__name__}",
-                    ha="center",
-                    va="center",
-                    transform=ax[i].transAxes,
-                )
-            i += 1
-
-        ax[-1].axis('off')  # Hide the last unused subplot
-        fig.suptitle(f'Thresholding Comparison for {os.path.basename(file)}', fontsize=16)
-        output_path = os.path.join(output_folder,
-                                   os.path.basename(file).replace(
-                                       '.tif', '_all_thresh.tif'))
-        fig.savefig(output_path)
-        plt.close(fig)
-    return
-
-
-def apply_li_threshold(file: str, channel: int=1) -> np.ndarray[bool]:
-    """
-    Apply Li thresholding to an .tif image and returns a binary mask.
+
+def apply_li_threshold(file: str, channel: int=1, position: Optional[int]=None) -> np.ndarray[bool]:
+    """
+    Apply Li thresholding to an .tif or .nd2 image and returns a binary mask.
 
     This function reads an image from the specified file path, selects the specified
     channel, and applies Li's thresholding method to generate a binary image. Pixels
@@ -143,6 +590,9 @@ def apply_li_threshold(file: str, channel: int=1) -> np.ndarray[bool]:
     channel : int, optional
         Index of the color channel to use if the image is RGB or multi-channel.
         Default is 1 (typically the green channel in RGB images).
+    position : int, optional
+        Stage position of an `.nd2` file. Only the frames of this position are read.
+        Defaults to None (all positions).
 
     Returns
     -------
@@ -171,94 +621,374 @@ def apply_li_threshold(file: str, channel: int=1) -> np.ndarray[bool]:
 
     """
 
-    # Check if the file exists
-    if not os.path.isfile(file):
-        raise FileNotFoundError(f"File {file} does not exist.")
-    # Check if the file is a .tif image
-    if not file.lower().endswith('.tif'):
-        raise ValueError(f"File {file} is not a .tif image.")
-    # Check if the channel is valid
-    if not isinstance(channel, int) or channel < 0:
-        raise ValueError("Channel must be a non-negative integer.")
-    # Check if the file is a valid image
-    try:
-        im = io.imread(file)
-    except Exception as e:
-        raise ValueError(f"Could not read image {file}: {e}")
-    # Check if the image is multi-channel
-    if im.ndim not in [2, 3]:
-        raise ValueError(f"Image {file} is not a valid 2D or 3D image.")
-    # Check if the channel is valid for the image
-    if im.ndim == 3 and (channel < 0 or channel >= im.shape[2]):
-        raise ValueError(f"Channel {channel} is out of bounds for image {file}.")
-    # Check if the image is grayscale
-    if im.ndim == 2 and channel != 0:
-        raise ValueError(f"Image {file} is grayscale, channel must be 0.")
-    # Check if the image is RGB
-    if im.ndim == 3 and im.shape[2] != 3:
-        raise ValueError(f"Image {file} is not RGB, channel must be 0, 1 or 2.")
-    # Check if the image is RGBA
-    if im.ndim == 3 and im.shape[2] != 4:
-        raise ValueError(f"Image {file} is not RGBA, channel must be 0, 1, 2 or 3.")   
-    # Read the image
-    im = io.imread(file)
-
-    microglia_im = im[:, :, channel] if im.ndim == 3 else im
+    if file.lower().endswith(('.tif', '.tiff')):
+        # Validate the file and channel from the TIFF header, then read the pixels once
+        metadata = validate_tif_channel(file, channel)
+        # Check if the image is grayscale
+        if len(metadata['shape']) == 2 and channel != 0:
+            raise ValueError(f"Image {file} is grayscale, channel must be 0.")
+
+    # Other file types are read, and their channel validated, by their registered reader
+    microglia_im = _read_2d_image(file, channel, position=position)
 
     # Apply Li threshold
-    thresh_li = filters.threshold_li(microglia_im)
-    binary_li = microglia_im > thresh_li
+    with stage('li_threshold', file) as record:
+        binary_li = create_li_mask(microglia_im)
+        record.pixels = microglia_im.size
 
     return binary_li
 
 
+def _merge_components(count: int, links: list) -> np.ndarray:
+    """
+    Merge labels `0..count` that are linked by pairs of label arrays.
+
+    Returns the index of the merged component that contains each label.
+    """
+    rows = np.concatenate([np.asarray(a, dtype=np.int64) for a, _ in links] or [np.zeros(0, np.int64)])
+    cols = np.concatenate([np.asarray(b, dtype=np.int64) for _, b in links] or [np.zeros(0, np.int64)])
+    graph = csr_matrix((np.ones(rows.size, dtype=np.int8), (rows, cols)),
+                       shape=(count + 1, count + 1))
+    return connected_components(graph, directed=False)[1]
+
+
+def _diagonal_links(labels: np.ndarray) -> list:
+    """
+    Pairs of different 4-connected labels that touch diagonally.
+    """
+    links = []
+    for a, b in ((labels[:-1, :-1], labels[1:, 1:]), (labels[:-1, 1:], labels[1:, :-1])):
+        linked = (a != b) & (a > 0) & (b > 0)
+        links.append((a[linked], b[linked]))
+    return links
+
+
+def _select_microglia_components(sizes: np.ndarray, first: np.ndarray, border: np.ndarray,
+                                 group4: np.ndarray, group8: np.ndarray, thresh: float,
+                                 large_object_size: int, min_object_size: int) -> np.ndarray:
+    """
+    Decide which foreground components form the microglia mask.
+
+    Components are described by per-label statistics, so the decision does not depend
+    on how the image was labelled (whole or tile by tile). Label 0 is the background.
+
+    Parameters
+    ----------
+    sizes : ndarray of int
+        Number of pixels of each label.
+    first : ndarray of int
+        Raster index of the first pixel of each label. Must be smallest for label 0.
+    border : ndarray of int
+        Labels that touch the image border.
+    group4, group8 : ndarray of int
+        Index of the 4- and 8-connected component that contains each label.
+    thresh, large_object_size, min_object_size
+        See `create_microglia_mask`.
+
+    Returns
+    -------
+    keep : ndarray of bool
+        Lookup table over labels, True for the labels in the mask.
+
+    Notes
+    -----
+    8-connected components are numbered by their first pixel in raster order, so their
+    ids match those of `skimage.measure.label` in the legacy pipeline.
+    """
+    n_groups = int(group8.max()) + 1
+    group_first = np.full(n_groups, np.iinfo(np.int64).max)
+    np.minimum.at(group_first, group8, first)
+    order = np.argsort(group_first, kind='stable')
+    ids = np.empty(n_groups, dtype=np.int64)
+    ids[order] = np.arange(n_groups)
+
+    on_border = np.zeros(n_groups, dtype=bool)
+    on_border[group8[border]] = True
+    on_border[group8[0]] = True
+    group_sizes = np.bincount(group8, weights=sizes, minlength=n_groups)
+
+    # clear_border, then keep only objects below the large-object size whose id
+    # exceeds the threshold (the legacy pipeline compared label ids to `thresh`)
+    kept = ~on_border & (group_sizes < large_object_size) & (ids > thresh)
+
+    # The survivors are relabelled in raster order and filtered by id once more
+    new_ids = np.empty(n_groups, dtype=np.int64)
+    new_ids[order] = np.cumsum(kept[order])
+    kept &= new_ids > thresh
+
+    # remove_small_objects on the boolean mask uses 4-connectivity
+    sizes4 = np.bincount(group4, weights=sizes)[group4]
+    keep = kept[group8] & (sizes4 >= min_object_size)
+    keep[0] = False
+    return keep
+
+
+def _microglia_components(labels: np.ndarray, count: int, thresh: float,
+                          large_object_size: int, min_object_size: int) -> np.ndarray:
+    """
+    Decide which 4-connected labels of a whole thresholded image form the microglia mask.
+
+    `labels` are 4-connected and numbered in raster order, as returned by
+    `scipy.ndimage.label`, so the label itself orders first pixels. 8-connected
+    components are the unions of labels that touch diagonally.
+    """
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)
+    border = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    group8 = _merge_components(count, _diagonal_links(labels))
+    return _select_microglia_components(sizes, np.arange(count + 1), border,
+                                        np.arange(count + 1), group8, thresh,
+                                        large_object_size, min_object_size)
+
+
+def _fill_holes(mask: np.ndarray) -> np.ndarray:
+    """
+    Fill the holes of a binary mask in place.
+
+    Equivalent to `scipy.ndimage.binary_fill_holes`, but the background is labelled
+    once (4-connected) inside the bounding box of the foreground instead of being
+    flooded by iterated dilations. Background components that do not reach the
+    border of the box are holes.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return mask
+    cols = np.flatnonzero(mask.any(axis=0))
+    box = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+    background, count = ndimage.label(~box)
+    outside = np.zeros(count + 1, dtype=bool)
+    outside[np.concatenate([background[0], background[-1],
+                            background[:, 0], background[:, -1]])] = True
+    box |= ~outside[background]
+    return mask
+
+
+def create_li_mask(image: np.ndarray) -> np.ndarray[bool]:
+    """
+    Threshold a single-channel image at its Li threshold.
+
+    This is the thresholding step of `apply_li_threshold`, for images that are
+    already in memory.
+
+    Parameters
+    ----------
+    image : ndarray
+        Single-channel image.
+
+    Returns
+    -------
+    binary_li : ndarray of bool
+        True where `image` is above `skimage.filters.threshold_li(image)`.
+
+    Examples
+    --------
+    >>> binary_li = create_li_mask(read_image("slice1.nd2", channel=1, position=0))
+    """
+    return image > filters.threshold_li(image)
+
+
+def create_microglia_mask(image: np.ndarray,
+                          threshold_method: Callable[[np.ndarray], float]=filters.threshold_li,
+                          large_object_size: int=50000,
+                          min_object_size: int=500) -> np.ndarray[bool]:
+    """
+    Segment microglia in a single-channel image.
+
+    The image is thresholded. Objects touching the image border and objects with
+    `large_object_size` pixels or more are discarded. Objects with fewer than
+    `min_object_size` pixels (4-connected) are removed, and holes in the remaining
+    objects are filled.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D single-channel image.
+    threshold_method : callable, optional
+        Function returning a global threshold for `image`. Defaults to
+        `skimage.filters.threshold_li`.
+    large_object_size : int, optional
+        Objects (8-connected) with at least this many pixels are treated as tissue or
+        debris and removed. Defaults to 50000.
+    min_object_size : int, optional
+        Objects (4-connected) with fewer pixels are removed. Defaults to 500.
+
+    Returns
+    -------
+    binary_mask : ndarray of bool
+        Mask with the same shape as `image`.
+
+    Notes
+    -----
+    - The output is bit-identical to the multi-pass pipeline previously in
+      `scripts/apply_single_threshold.py` (label, `clear_border`, two
+      `remove_small_objects` calls, relabelling and `binary_fill_holes`). That
+      includes its quirk of also dropping objects whose label id does not exceed the
+      threshold value.
+    - The foreground is labelled once. Component sizes, border contact and ids
+      are derived from that single labelling. Holes are found with a single
+      labelling of the background within the bounding box of the kept objects.
+
+    Examples
+    --------
+    >>> microglia_im = load_tif_file('image.tif', channel=1, channel_axis=0)
+    >>> binary_mask = create_microglia_mask(microglia_im)
+    """
+    image = np.asarray(image)
+    if image.ndim != 2:
+        raise ValueError(f"Expected a 2D image, got shape {image.shape}.")
+
+    thresh = threshold_method(image)
+    labels, count = ndimage.label(image > thresh)
+    keep = _microglia_components(labels, count, thresh, large_object_size, min_object_size)
+    return _fill_holes(keep[labels])
+
+
+def _threshold_and_save(file: str, output_path: str,
+                        threshold_function: Callable[[str], np.ndarray]) -> str:
+    """
+    Threshold a single file and save the binary image to `output_path`.
+
+    Module-level so that it can be sent to worker processes by `run_batch`.
+    """
+    with stage('threshold', file) as record:
+        binary_image = threshold_function(file)
+        record.pixels = binary_image.size
+    with stage('write', file) as record:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        np.save(output_path, binary_image)
+        record.bytes_written = os.path.getsize(output_path)
+    return output_path
+
+
+def _threshold_and_pack(file: str, threshold_function: Callable[[str], np.ndarray]) -> tuple:
+    """
+    Threshold a single file and return the bit-packed mask and its shape.
+
+    Packing in the worker sends eight times fewer bytes back to the process that
+    appends to the mask store.
+    """
+    with stage('threshold', file) as record:
+        binary_image = threshold_function(file)
+        record.pixels = binary_image.size
+    with stage('pack', file):
+        return pack_mask(binary_image)
+
+
+def _remove_from_store(store: MaskStore) -> Callable[[str], None]:
+    def remove(name):
+        if name in store:
+            store.remove(name)
+    return remove
+
+
 def apply_threshold_recursively(input_folder: str,
                                 output_folder: str='./thresh_output/',
-                                threshold_function: Callable[[str], np.ndarray]=apply_li_threshold) -> None:
+                                threshold_function: Callable[[str], np.ndarray]=apply_li_threshold,
+                                workers: Optional[int]=None,
+                                executor: Optional[Executor]=None,
+                                max_in_flight: Optional[int]=None,
+                                mask_store: Optional[str]=None,
+                                cache: bool=False,
+                                hash_contents: bool=False,
+                                file_types: tuple=('.tif',),
+                                instrumentation: Optional[Instrumentation]=None) -> BatchSummary:
      
     """
-    Recursively applies a thresholding function to all `.tif` images in a directory
-    and saves the resulting binary images as `.npy` files.
+    Recursively applies a thresholding function to all `.tif` images in a directory
+    and saves the resulting binary images as `.npy` files.
 
-    Parameters
-    ----------
-    input_folder : str
-        Path to the input directory containing `.tif` image files.
-    output_folder : str, optional
-        Path to the output directory where thresholded `.npy` files will be saved.
-        Defaults to './thresh_output/'.
-    threshold_funcion : callable, optional
-        A function that takes a file path as input and returns a binary NumPy array.
-        Defaults to `apply_li_threshold`.
+    Parameters
+    ----------
+    input_folder : str
+        Path to the input directory containing `.tif` image files.
+    output_folder : str, optional
+        Path to the output directory where thresholded `.npy` files will be saved.
+        The subfolder structure of `input_folder` is mirrored. Defaults to './thresh_output/'.
+    threshold_function : callable, optional
+        A function that takes a file path as input and returns a binary NumPy array.
+        Defaults to `apply_li_threshold`. Must be picklable (defined at module level)
+        when running with `workers` or a process-based `executor`.
+    workers : int, optional
+        Number of worker processes used to threshold files in parallel. `None` or `1`
+        (default) processes files serially in the current process.
+    executor : concurrent.futures.Executor, optional
+        An existing executor to run the work on instead of creating a process pool.
+        It is not shut down when the function returns.
+    max_in_flight : int, optional
+        Maximum number of files submitted to the pool at once. Defaults to twice the
+        number of workers.
+    mask_store : str, optional
+        If given, masks are appended to the `MaskStore` at this path instead of being
+        saved as one `.npy` per image. Each mask is keyed by the path of its `.tif`
+        relative to `input_folder`, without the extension.
+    cache : bool, optional
+        Skip files whose mask is already up to date. A manifest (`cache_manifest.json`
+        in `output_folder`, or in `mask_store`) records the size and modification time
+        of every input together with the identity of `threshold_function` and its
+        `functools.partial` arguments. Only new or changed inputs, or inputs last
+        processed with a different function, are thresholded again. Outputs of inputs
+        that no longer exist are deleted. Defaults to False.
+    hash_contents : bool, optional
+        With `cache`, compare inputs by a SHA-256 digest of their contents instead of
+        size and modification time, so copied or touched files are not recomputed.
+    file_types : tuple of str, optional
+        File endings of the images to threshold (default is `('.tif',)`). With
+        `('.nd2',)` and the default `apply_li_threshold`, ND2 acquisitions are
+        thresholded directly, skipping the intermediate `.tif` of `nd2_to_tif`. The
+        `threshold_function` must be able to read every type, e.g. through
+        `turmoric.image_process.read_image`. Multi-position `.nd2` files need a
+        position, e.g. `partial(apply_li_threshold, position=0)`, or they fail.
+    instrumentation : Instrumentation, optional
+        Records the time of every file and of its `'threshold'` (including the
+        `'read'` and `'li_threshold'` stages of `apply_li_threshold`), `'write'` or
+        `'pack'` stages, and of the `'store_append'` of each mask to `mask_store`
+        (see `turmoric.instrumentation`).
 
-    Returns
-    -------
-    None
-            This function does not return a value. It saves the binary images as `.npy` files
-            in the specified output directory.
+    Returns
+    -------
+    BatchSummary
+        Per-file results in input order. `summary.succeeded` and `summary.failed` list
+        the files that were saved and the ones that raised, together with their timings
+        and error tracebacks. `summary.cached` lists the files skipped by the cache.
+        Returns None if the input folder does not exist.
 
-    
     Raises
-    ------
-    Prints error messages if:
-        - The input folder does not exist.
-        - Any file fails to process due to an exception.
+    ------
+    Prints an error message if the input folder does not exist. Errors raised while
+    processing individual files are collected in the returned summary instead.
 
-    Notes
-    -----
-    - The function assumes that `recursively_get_all_filepaths` is defined elsewhere and
-      returns a list of `.tif` file paths.
-    - The thresholding function should return a binary NumPy array.
+    Notes
+    -----
+    - Image paths are collected with `iter_filepaths`, matching `file_types`
+      case-sensitively.
+    - Masks are named after their image with the extension replaced by `.npy`.
+    - The thresholding function should return a binary NumPy array.
+    - See `turmoric.utils.run_batch` for the execution model.
 
-    Examples
-    --------
-    >>> def dummy_threshold(file_path):
-    ...     import numpy as np
-    ...     return np.ones((100, 100), dtype=bool)  # Dummy binary image
-    ...
-    >>> apply_threshold_recursively('path/to/tif_images',
-    ...                              output_folder='path/to/output',
-    ...                              threshold_funcion=dummy_threshold)
+    Examples
+    --------
+    >>> def dummy_threshold(file_path):
+    ...     import numpy as np
+    ...     return np.ones((100, 100), dtype=bool)  # Dummy binary image
+    ...
+    >>> summary = apply_threshold_recursively('path/to/tif_images',
+    ...                                       output_folder='path/to/output',
+    ...                                       threshold_function=dummy_threshold,
+    ...                                       workers=8)
+    >>> print(summary)
+    >>> [result.file for result in summary.failed]
+
+    Re-running with the cache only thresholds new or modified images:
+
+    >>> from functools import partial
+    >>> summary = apply_threshold_recursively('path/to/tif_images', 'path/to/output',
+    ...                                       partial(apply_li_threshold, channel=2),
+    ...                                       cache=True)
+
+    ND2 acquisitions can be thresholded without converting them to `.tif` first:
+
+    >>> summary = apply_threshold_recursively('path/to/nd2_files', 'path/to/output',
+    ...                                       file_types=('.nd2',), workers=8)
 
     """
     if not os.path.isdir(input_folder):
@@ -268,13 +998,58 @@ def apply_threshold_recursively(input_folder: str,
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
 
-    file_list = recursively_get_all_filepaths(input_folder, ".tif")
+    file_list = list(iter_filepaths(input_folder, file_types, case_sensitive=True))
+    start = time.perf_counter()
+    names = [os.path.relpath(file, input_folder) for file in file_list]
+
+    store = MaskStore(mask_store, mode='a') if mask_store is not None else None
+    manifest = None
+    if cache:
+        manifest = CacheManifest(os.path.join(mask_store or output_folder, MANIFEST_FILE),
+                                 function_key(threshold_function, mask_store=store is not None),
+                                 hash_contents=hash_contents)
+        output_exists = store.__contains__ if store is not None else os.path.exists
+        manifest.evict(names, remove=(_remove_from_store(store) if store is not None
+                                      else remove_file))
 
-    for file in file_list:
+    # Cached files keep their slot so results stay in input order
+    results = [None] * len(file_list)
+    todo = []
+    for index, (file, name) in enumerate(zip(file_list, names)):
+        if manifest is not None and manifest.is_fresh(name, file, output_exists):
+            results[index] = FileResult(file=file, value=manifest.output(name), cached=True)
+        else:
+            todo.append(index)
+
+    if store is not None:
+        jobs = ((file_list[index], threshold_function) for index in todo)
+        worker = _threshold_and_pack
+    else:
+        jobs = ((file_list[index],
+                 os.path.join(output_folder, os.path.splitext(names[index])[0] + '.npy'),
+                 threshold_function)
+                for index in todo)
+        worker = _threshold_and_save
+
+    with instrumented(instrumentation):
         try:
-            binary_image = threshold_function(file)
-            output_path = os.path.join(output_folder,
-                                       file.replace('.tif', '.npy'))
-            np.save(output_path, binary_image)
-        except Exception as e:
-            print(f"Error processing {file}: {e}")
+            for index, result in zip(todo, run_batch(worker, jobs, workers=workers, executor=executor,
+                                                     max_in_flight=max_in_flight,
+                                                     instrumentation=instrumentation)):
+                if result.ok:
+                    if store is not None:
+                        name = os.path.splitext(names[index])[0]
+                        with stage('store_append', result.file) as record:
+                            store.append_packed(name, *result.value)
+                            record.bytes_written = result.value[0].nbytes
+                        result.value = name
+                    if manifest is not None:
+                        manifest.record(names[index], result.file, result.value)
+                results[index] = result
+        finally:
+            if manifest is not None:
+                manifest.save()
+            if store is not None:
+                store.close()
+
+    return BatchSummary(results=results, elapsed=time.perf_counter() - start)
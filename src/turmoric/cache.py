@@ -0,0 +1,236 @@
+import os
+import json
+import hashlib
+import inspect
+import functools
+from typing import Callable, Iterable, Optional
+
+"""
+Manifest of already-computed outputs for incremental re-runs.
+
+A manifest maps each input file (by its path relative to the input folder) to a
+fingerprint of the file and the output it produced. An entry is fresh when:
+
+- the input still has the same size and modification time, or, with
+  `hash_contents=True`, the same SHA-256 digest;
+- the entry was computed under the same key, i.e. the same function and
+  parameters (see `function_key`);
+- the output still exists.
+
+Fresh inputs are skipped. Changed inputs are recomputed. Outputs of inputs that
+disappeared are evicted.
+"""
+
+MANIFEST_FILE = 'cache_manifest.json'
+MANIFEST_VERSION = 1
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(file: str) -> str:
+    """
+    SHA-256 hex digest of a file's contents, read in 1 MiB blocks.
+    """
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def function_key(func: Callable, **params) -> str:
+    """
+    Identify a function and its parameters for use as a cache key.
+
+    The key combines the qualified name of `func`, a hash of its source code (so
+    editing the function invalidates the cache), the arguments bound by
+    `functools.partial` and any extra keyword `params`.
+
+    Parameters
+    ----------
+    func : callable
+        The function that produces the cached outputs. May be a `functools.partial`.
+    **params
+        Additional parameters that change the output, e.g. `channel=1`. Values must be
+        JSON-serializable or have a stable `repr`.
+
+    Returns
+    -------
+    key : str
+        A hex digest that changes whenever the function or a parameter changes.
+
+    Examples
+    --------
+    >>> function_key(apply_li_threshold, channel=1)
+    '5c0e...'
+    """
+    args = ()
+    while isinstance(func, functools.partial):
+        params = {**func.keywords, **params}
+        args = func.args + args
+        func = func.func
+
+    name = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = ''
+
+    identity = json.dumps({'name': name,
+                           'source': hashlib.sha256(source.encode()).hexdigest(),
+                           'args': args,
+                           'params': params}, sort_keys=True, default=repr)
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+class CacheManifest:
+    """
+    JSON manifest recording which inputs have up-to-date outputs.
+
+    Parameters
+    ----------
+    path : str
+        Path of the manifest file. It is created by `save` if it does not exist.
+    key : str
+        Identity of the computation, typically from `function_key`. Entries recorded
+        under a different key are treated as stale.
+    hash_contents : bool, optional
+        Compare inputs by SHA-256 digest instead of size and modification time. The
+        digest is only computed when the size or modification time changed, so a
+        `touch` or copy does not trigger recomputation. Defaults to False.
+
+    Examples
+    --------
+    >>> manifest = CacheManifest('out/cache_manifest.json', function_key(apply_li_threshold))
+    >>> todo = [f for f in files if not manifest.is_fresh(os.path.relpath(f, root), f)]
+    >>> manifest.record('a/image1.tif', 'a/image1.tif', 'out/a/image1.npy')
+    >>> manifest.evict(current_names)
+    >>> manifest.save()
+    """
+
+    def __init__(self, path: str, key: str, hash_contents: bool=False):
+        self.path = str(path)
+        self.key = key
+        self.hash_contents = hash_contents
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.entries = manifest.get('entries', {})
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def _fingerprint(self, file: str, previous: Optional[dict]=None) -> dict:
+        stat = os.stat(file)
+        fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if self.hash_contents:
+            if (previous is not None and 'sha256' in previous
+                    and previous['size'] == stat.st_size
+                    and previous['mtime_ns'] == stat.st_mtime_ns):
+                fingerprint['sha256'] = previous['sha256']
+            else:
+                fingerprint['sha256'] = file_digest(file)
+        return fingerprint
+
+    def is_fresh(self, name: str, file: str,
+                 output_exists: Optional[Callable[[str], bool]]=os.path.exists) -> bool:
+        """
+        Return True if `file` has an up-to-date output recorded under `name`.
+
+        Parameters
+        ----------
+        name : str
+            Key of the input in the manifest, usually its path relative to the input folder.
+        file : str
+            Path of the input file.
+        output_exists : callable, optional
+            Checks that the recorded output is still there. Defaults to `os.path.exists`.
+            Pass None to skip the check.
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry.get('key') != self.key:
+            return False
+        if output_exists is not None and not output_exists(entry['output']):
+            return False
+
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return False
+        previous = entry['fingerprint']
+        if previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if not self.hash_contents or 'sha256' not in previous or previous['size'] != stat.st_size:
+            return False
+
+        # Same contents under a new timestamp: refresh the entry instead of recomputing
+        fingerprint = self._fingerprint(file)
+        if fingerprint['sha256'] != previous['sha256']:
+            return False
+        entry['fingerprint'] = fingerprint
+        return True
+
+    def output(self, name: str) -> Optional[str]:
+        """
+        Output recorded for `name`, or None.
+        """
+        entry = self.entries.get(name)
+        return None if entry is None else entry['output']
+
+    def record(self, name: str, file: str, output: str) -> None:
+        """
+        Record that `file` was processed into `output` under the current key.
+        """
+        self.entries[name] = {'fingerprint': self._fingerprint(file, self.entries.get(name, {}).get('fingerprint')),
+                              'key': self.key,
+                              'output': output}
+
+    def evict(self, names: Iterable[str], remove: Optional[Callable[[str], None]]=None) -> list:
+        """
+        Drop all entries whose name is not in `names`.
+
+        Parameters
+        ----------
+        names : iterable of str
+            Names of the inputs that still exist.
+        remove : callable, optional
+            Called with the output of every evicted entry, e.g. to delete the file.
+
+        Returns
+        -------
+        evicted : list of str
+            Outputs of the evicted entries.
+        """
+        names = set(names)
+        evicted = []
+        for name in [name for name in self.entries if name not in names]:
+            output = self.entries.pop(name)['output']
+            if remove is not None:
+                remove(output)
+            evicted.append(output)
+        return evicted
+
+    def save(self) -> None:
+        """
+        Write the manifest atomically, so an interrupted run never leaves it truncated.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'entries': self.entries}, f)
+        os.replace(temp_path, self.path)
+
+
+def remove_file(path: str) -> None:
+    """
+    Delete `path` if it exists. Usable as the `remove` callback of `CacheManifest.evict`.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -2,10 +2,15 @@ import os
 import numpy as np
 import pandas as pd
 from skimage.measure import label, regionprops_table
-from turmoric.utils import recursively_get_all_filepaths
+from concurrent.futures import Executor
+from typing import Callable, Optional
+from turmoric.apply_thresholds import apply_li_threshold
+from turmoric.utils import iter_filepaths, run_batch
+from turmoric.mask_store import MaskStore, is_mask_store, INDEX_FILE
+from turmoric.instrumentation import Instrumentation, instrumented, stage
 
 
-def apply_regionprops(file: str, properties_list: list) -> pd.DataFrame:
+def apply_regionprops(file: str, properties_list: list, store: MaskStore=None) -> pd.DataFrame:
     """
     Compute region properties from a binary mask stored in a .npy file.
 
@@ -20,7 +25,11 @@ def apply_regionprops(file: str, properties_list: list) -> pd.DataFrame:
     properties_list : list of str
         List of region properties to compute. These should be valid property names
         accepted by `skimage.measure.regionprops_table`, such as 'area', 'centroid',
-        'eccentricity', etc.
+        'eccentricity', etc., or the derived 'circularity' (`4 pi area / perimeter**2`,
+        NaN for regions without a perimeter) and 'aspect_ratio'
+        (`major_axis_length / minor_axis_length`).
+    store : MaskStore, optional
+        If given, `file` is the name of a mask in this store instead of a `.npy` path.
 
     Returns
     -------
@@ -35,6 +44,10 @@ def apply_regionprops(file: str, properties_list: list) -> pd.DataFrame:
     - For valid property names, see the documentation for `skimage.measure.regionprops_table`.
     - The binary mask should be a 2D array where foreground regions are marked with 1s.
     - Connected components are labeled using 8-connectivity by default.
+    - The properties in `FAST_PROPERTIES` (area, bbox, centroid, perimeter, axis
+      lengths and the metrics derived from them) are measured for all regions at
+      once with array reductions. Only the other properties, such as 'convex_area'
+      or 'solidity', are computed region by region by skimage.
     - This function is useful for batch processing of image masks in segmentation tasks.
     
     Examples
@@ -44,27 +57,375 @@ def apply_regionprops(file: str, properties_list: list) -> pd.DataFrame:
     """
 
     # Load the binary mask
-    binary_mask = np.load(file)
+    with stage('read', file) as record:
+        if store is not None:
+            binary_mask = store.read(file)
+        else:
+            binary_mask = np.load(file)
+        record.bytes_read = binary_mask.nbytes
 
+    return measure_mask(binary_mask, properties_list, file)
+
+
+def measure_mask(binary_mask: np.ndarray, properties_list: list, filename: str='') -> pd.DataFrame:
+    """
+    Label a binary mask in memory and tabulate the properties of its regions.
+
+    This is the measuring step of `apply_regionprops`, for masks that are not
+    stored in a file.
+
+    Parameters
+    ----------
+    binary_mask : ndarray
+        2D binary mask.
+    properties_list : list of str
+        Region properties to compute, as in `apply_regionprops`.
+    filename : str, optional
+        Value of the `'filename'` column.
+
+    Returns
+    -------
+    props_df : pandas.DataFrame
+        One row per connected region, plus the `'filename'` column.
+
+    Examples
+    --------
+    >>> props_df = measure_mask(create_microglia_mask(image), ['area', 'perimeter'], 'slice1.tif')
+    """
     # Label connected regions in the binary mask
-    label_image = label(binary_mask)
+    with stage('label', filename) as record:
+        label_image = label(binary_mask)
+        record.pixels = label_image.size
 
     # Measure properties
-    props = regionprops_table(label_image, properties=properties_list)
+    with stage('regionprops', filename) as record:
+        props = _regionprops_table(label_image, properties_list)
+        record.pixels = label_image.size
 
     # Create a DataFrame for the current file
     props_df = pd.DataFrame(props)
-    props_df['filename'] = file  # Add filename column
+    props_df['filename'] = filename  # Add filename column
 
     return props_df
 
 
-def apply_regionprops_recursively(input_folder: str, properties_list: tuple=(
-                                'area', 'bbox_area', 'centroid', 'convex_area',
-                                'eccentricity', 'equivalent_diameter',
-                                'euler_number', 'extent', 'filled_area',
-                                'major_axis_length', 'minor_axis_length',
-                                'orientation', 'perimeter', 'solidity')) -> pd.DataFrame:
+# Properties measured for all regions at once by `_fast_regionprops`, by the
+# name they are requested with. Aliases follow `regionprops_table`.
+FAST_PROPERTIES = {
+    'label': 'label', 'area': 'area', 'bbox': 'bbox', 'centroid': 'centroid',
+    'area_bbox': 'area_bbox', 'bbox_area': 'area_bbox',
+    'axis_major_length': 'axis_major_length', 'major_axis_length': 'axis_major_length',
+    'axis_minor_length': 'axis_minor_length', 'minor_axis_length': 'axis_minor_length',
+    'equivalent_diameter_area': 'equivalent_diameter_area',
+    'equivalent_diameter': 'equivalent_diameter_area',
+    'extent': 'extent', 'perimeter': 'perimeter',
+    # Derived shape metrics, not known to regionprops_table
+    'circularity': 'circularity', 'aspect_ratio': 'aspect_ratio',
+}
+
+# Weights of the border pixel configurations in `skimage.measure.perimeter`, indexed
+# by 1 for the pixel itself + 2 per border 4-neighbor + 10 per border diagonal neighbor
+_PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+_PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+_PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+_PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+
+def _fast_regionprops(label_image: np.ndarray, properties: list) -> dict:
+    """
+    Measure the `FAST_PROPERTIES` of every region of a 2D label image at once.
+
+    Each property is a `np.bincount` or `ufunc.at` reduction over the foreground
+    pixels, instead of one `RegionProperties` object per region. The columns are
+    named and typed as by `regionprops_table`. Regions must not touch, as in the
+    output of `skimage.measure.label`, for the perimeter to match skimage's.
+    """
+    wanted = {FAST_PROPERTIES[name] for name in properties}
+    width = label_image.shape[1]
+    index = np.flatnonzero(label_image)
+    region = label_image.ravel()[index].astype(np.intp)
+    n_labels = int(region.max()) if region.size else 0
+    counts = np.bincount(region, minlength=n_labels + 1)
+    present = counts[1:] > 0  # regionprops skips missing labels
+    area = counts[1:][present].astype(np.float64)
+    rows, cols = np.divmod(index, width)
+    values = {'label': np.flatnonzero(present) + 1, 'area': area}
+
+    def per_region(weights):
+        return np.bincount(region, weights=weights, minlength=n_labels + 1)[1:][present]
+
+    if wanted & {'centroid', 'axis_major_length', 'axis_minor_length', 'aspect_ratio'}:
+        centroid_row, centroid_col = per_region(rows) / area, per_region(cols) / area
+        values['centroid'] = (centroid_row, centroid_col)
+
+        if wanted & {'axis_major_length', 'axis_minor_length', 'aspect_ratio'}:
+            # Eigenvalues of the inertia tensor, from the second central moments
+            position = np.cumsum(present) - 1  # label -> row of the table
+            d_row = rows - centroid_row[position[region - 1]]
+            d_col = cols - centroid_col[position[region - 1]]
+            mu20 = per_region(d_row * d_row) / area
+            mu02 = per_region(d_col * d_col) / area
+            mu11 = per_region(d_row * d_col) / area
+            mean = (mu20 + mu02) / 2
+            spread = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+            values['axis_major_length'] = 4 * np.sqrt(mean + spread)
+            values['axis_minor_length'] = 4 * np.sqrt(np.clip(mean - spread, 0, None))
+
+    if wanted & {'bbox', 'area_bbox', 'extent'}:
+        bounds = np.empty((4, n_labels + 1), dtype=np.int64)
+        bounds[:2], bounds[2:] = np.iinfo(np.int64).max, -1
+        for bound, coordinates, reduce in ((0, rows, np.minimum), (1, cols, np.minimum),
+                                           (2, rows, np.maximum), (3, cols, np.maximum)):
+            reduce.at(bounds[bound], region, coordinates)
+        bbox = bounds[:, 1:][:, present]
+        bbox[2:] += 1
+        values['bbox'] = tuple(bbox)
+        values['area_bbox'] = ((bbox[2] - bbox[0]) * (bbox[3] - bbox[1])).astype(np.float64)
+        values['extent'] = area / values['area_bbox']
+
+    if wanted & {'perimeter', 'circularity'}:
+        # skimage.measure.perimeter with 4-connectivity, evaluated at the foreground
+        # pixels of a zero-padded mask only
+        padded_width = width + 2
+        foreground = np.pad(label_image > 0, 1).view(np.uint8).ravel()
+        pixel = (rows + 1) * padded_width + cols + 1
+        interior = (foreground[pixel - 1] & foreground[pixel + 1]
+                    & foreground[pixel - padded_width] & foreground[pixel + padded_width])
+        border = pixel[interior == 0]
+        is_border = np.zeros_like(foreground)
+        is_border[border] = 1
+        edges = sum(is_border[border + offset].astype(np.intp)
+                    for offset in (-1, 1, -padded_width, padded_width))
+        corners = sum(is_border[border + offset].astype(np.intp)
+                      for offset in (-padded_width - 1, -padded_width + 1,
+                                     padded_width - 1, padded_width + 1))
+        codes = 1 + 2 * edges + 10 * corners
+        histogram = np.bincount(region[interior == 0] * 50 + codes,
+                                minlength=(n_labels + 1) * 50).reshape(n_labels + 1, 50)
+        values['perimeter'] = (histogram[1:] @ _PERIMETER_WEIGHTS)[present]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'equivalent_diameter_area' in wanted:
+            values['equivalent_diameter_area'] = np.sqrt(4 * area / np.pi)
+        if 'circularity' in wanted:
+            # Regions of a pixel or two have no perimeter and no defined circularity
+            perimeter = values['perimeter']
+            values['circularity'] = np.where(perimeter > 0, 4 * np.pi * area / perimeter ** 2, np.nan)
+        if 'aspect_ratio' in wanted:
+            minor = values['axis_minor_length']
+            values['aspect_ratio'] = np.where(minor > 0, values['axis_major_length'] / minor, np.nan)
+
+    table = {}
+    for name in properties:
+        value = values[FAST_PROPERTIES[name]]
+        if isinstance(value, tuple):
+            table.update({f'{name}-{axis}': column for axis, column in enumerate(value)})
+        else:
+            table[name] = value
+    return table
+
+
+def _regionprops_table(label_image: np.ndarray, properties_list: list) -> dict:
+    """
+    `regionprops_table`, with the `FAST_PROPERTIES` of 2D images measured by `_fast_regionprops`.
+
+    Only the remaining properties (convex hull, moments, ...) go through skimage.
+    Columns keep the order of `properties_list`.
+    """
+    properties_list = list(properties_list)
+    fast = [name for name in properties_list if name in FAST_PROPERTIES]
+    if label_image.ndim != 2 or not fast:
+        return regionprops_table(label_image, properties=properties_list)
+    slow = [name for name in properties_list if name not in FAST_PROPERTIES]
+
+    columns = _fast_regionprops(label_image, fast)
+    if slow:
+        columns.update(regionprops_table(label_image, properties=slow))
+    order = [column for name in properties_list for column in columns
+             if column == name or column.startswith(f'{name}-')]
+    return {column: columns[column] for column in order}
+
+
+CATEGORICAL_COLUMNS = ('filename', 'treatment')
+
+DEFAULT_PROPERTIES = ('area', 'bbox_area', 'centroid', 'convex_area',
+                      'eccentricity', 'equivalent_diameter',
+                      'euler_number', 'extent', 'filled_area',
+                      'major_axis_length', 'minor_axis_length',
+                      'orientation', 'perimeter', 'solidity')
+
+
+def _encode_categoricals(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the repeated string columns (`CATEGORICAL_COLUMNS`) of a table to pandas categoricals.
+    """
+    columns = [column for column in CATEGORICAL_COLUMNS
+               if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if columns:
+        df = df.assign(**{column: df[column].astype('category') for column in columns})
+    return df
+
+
+class _TableWriter:
+    """
+    Append DataFrames to a `.csv` or `.parquet` file one at a time.
+
+    Parquet output requires `pyarrow`. The `filename` and `treatment` columns are
+    dictionary-encoded, so each distinct path is stored once per row group rather
+    than once per row. The schema (and the CSV column order) is taken from the
+    first DataFrame written.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.format = os.path.splitext(self.path)[1].lower().lstrip('.')
+        if self.format not in ('csv', 'parquet'):
+            raise ValueError(f"Output file must end in .csv or .parquet, got {self.path}.")
+        if self.format == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError("Writing .parquet files requires pyarrow "
+                                  "(pip install pyarrow).")
+        self._columns = None
+        self._writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.format == 'csv':
+            if self._columns is None:
+                self._columns = list(df.columns)
+                df.to_csv(self.path, index=False)
+            else:
+                df.reindex(columns=self._columns).to_csv(self.path, mode='a', header=False,
+                                                         index=False)
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        df = _encode_categoricals(df)
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # Fix the dictionary index width so later batches with more
+            # categories still fit the schema
+            schema = pa.schema([
+                pa.field(f.name, pa.dictionary(pa.int32(), pa.string()))
+                if pa.types.is_dictionary(f.type) else f
+                for f in table.schema])
+            self._writer = pq.ParquetWriter(self.path, schema)
+        else:
+            df = df.reindex(columns=self._writer.schema.names)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        self._writer.write_table(table.cast(self._writer.schema))
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif self._columns is None and self.format == 'csv':
+            open(self.path, 'w').close()
+
+
+def write_regionprops_table(df: pd.DataFrame, output_path: str) -> str:
+    """
+    Write a region properties table to `.csv` or `.parquet`.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Table of region properties, e.g. from `apply_regionprops_recursively`.
+    output_path : str
+        Destination file. The format is chosen from the extension. Parquet output
+        requires `pyarrow` and stores the `filename` and `treatment` columns
+        dictionary-encoded.
+
+    Returns
+    -------
+    output_path : str
+        Path of the written file.
+
+    Examples
+    --------
+    >>> df = apply_regionprops_recursively('/data/masks', ('area', 'perimeter'))
+    >>> write_regionprops_table(df, 'regionprops.parquet')
+    'regionprops.parquet'
+    """
+    writer = _TableWriter(output_path)
+    try:
+        writer.write(df)
+    finally:
+        writer.close()
+    return str(output_path)
+
+
+def read_regionprops_table(path: str, columns: Optional[list]=None) -> pd.DataFrame:
+    """
+    Read a region properties table written as `.csv` or `.parquet`.
+
+    Parameters
+    ----------
+    path : str
+        Path of the table. Parquet files require `pyarrow`.
+    columns : list of str, optional
+        Only read these columns. For Parquet files the other columns are not
+        decoded at all.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The table, with the `filename` and `treatment` columns (if present) as
+        pandas categoricals.
+
+    Examples
+    --------
+    >>> df = read_regionprops_table('regionprops.parquet', columns=['area', 'treatment'])
+    >>> df.groupby('treatment', observed=True)['area'].mean()
+    """
+    if str(path).lower().endswith('.parquet'):
+        df = pd.read_parquet(path, columns=columns)
+    else:
+        df = pd.read_csv(path, usecols=columns,
+                         dtype={column: 'category' for column in CATEGORICAL_COLUMNS})
+    return _encode_categoricals(df)
+
+
+_open_stores = {}
+
+
+def _regionprops_job(file: str, properties_list: tuple, store_path: str=None) -> pd.DataFrame:
+    """
+    Compute the region properties of one mask file or mask store entry.
+
+    Module-level so it can run in worker processes. Mask stores are opened once per
+    process and reopened only when their index changes.
+    """
+    store = None
+    if store_path is not None:
+        stat = os.stat(os.path.join(store_path, INDEX_FILE))
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = _open_stores.get(store_path)
+        if cached is None or cached[0] != key:
+            if cached is not None:
+                cached[1].close()
+            cached = _open_stores[store_path] = (key, MaskStore(store_path))
+        store = cached[1]
+    return apply_regionprops(file, properties_list, store=store)
+
+
+def _add_treatment(result, treatment: str):
+    """
+    Add a constant 'treatment' column to the table of a successful `FileResult`.
+    """
+    if result.ok:
+        result.value['treatment'] = treatment
+    return result
+
+
+def apply_regionprops_recursively(input_folder: str, properties_list: tuple=DEFAULT_PROPERTIES,
+                                workers: Optional[int]=None,
+                                executor: Optional[Executor]=None,
+                                output_path: Optional[str]=None,
+                                treatment: Optional[str]=None,
+                                instrumentation: Optional[Instrumentation]=None):
     """
     Recursively applies region properties extraction to all `.npy` files in a directory.
 
@@ -76,19 +437,39 @@ def apply_regionprops_recursively(input_folder: str, properties_list: tuple=(
     Parameters
     ----------
     input_folder : str
-        Path to the root directory containing `.npy` binary mask files.
+        Path to the root directory containing `.npy` binary mask files, or to a
+        `MaskStore` (see `turmoric.mask_store`), in which case every mask in the store
+        is processed and the 'filename' column holds the mask names.
     properties_list : tuple of str, optional
         A tuple of region properties to compute for each labeled region in the binary masks.
         Default includes a comprehensive set of geometric properties such as 'area',
         'centroid', 'eccentricity', etc. Valid property names must be accepted by
         `skimage.measure.regionprops_table`.
+    workers : int, optional
+        Number of worker processes used to label and measure masks in parallel. `None`
+        or `1` (default) processes masks serially in the current process.
+    executor : concurrent.futures.Executor, optional
+        An existing executor to run the work on instead of creating a process pool.
+    output_path : str, optional
+        Path of a `.csv` or `.parquet` file (the latter requires `pyarrow`). When given,
+        each mask's table is appended to this file as soon as it is ready, in input
+        order, and the path is returned instead of a DataFrame. Only a bounded number
+        of per-mask tables is held in memory at a time. Parquet files store the
+        `filename` and `treatment` columns dictionary-encoded (see
+        `read_regionprops_table`).
+    treatment : str, optional
+        If given, a 'treatment' column with this value is added to every row.
+    instrumentation : Instrumentation, optional
+        Records the time of every mask and of its `'read'`, `'label'` and
+        `'regionprops'` stages, and of the `'write_table'` of each table to
+        `output_path` or the final `'concat'` (see `turmoric.instrumentation`).
 
     Returns
     -------
-    pandas.DataFrame
+    pandas.DataFrame or str
         A concatenated DataFrame containing region properties from all processed files.
         Each row corresponds to a labeled region and includes a 'filename' column indicating
-        the source file.
+        the source file. If `output_path` is given, the path of the written file.
 
     Raises
     ------
@@ -101,8 +482,10 @@ def apply_regionprops_recursively(input_folder: str, properties_list: tuple=(
     -----
     - Binary masks must be stored as `.npy` files containing 2D NumPy arrays.
     - If a file cannot be processed, an error message is printed and processing continues.
-    - Requires `recursively_get_all_filepaths` to collect `.npy` file paths.
+    - `.npy` file paths are collected lazily with `iter_filepaths`, so the first masks
+      are processed while the folder is still being walked.
     - Uses `apply_regionprops` to compute the region properties and returns a DataFrame.
+    - Masks are distributed over workers with `turmoric.utils.run_batch`.
 
     Examples
     --------
@@ -112,25 +495,167 @@ def apply_regionprops_recursively(input_folder: str, properties_list: tuple=(
     >>> df = apply_regionprops_recursively('/data/images', properties_list=('area', 'centroid'))
     >>> df[['area', 'centroid-0', 'centroid-1']].plot.scatter(x='centroid-0', y='centroid-1', c='area', colormap='viridis')
     >>> plt.show()
+
+    >>> apply_regionprops_recursively('/data/masks', workers=16, output_path='regionprops.parquet')
+    'regionprops.parquet'
     """
    
     if not os.path.isdir(input_folder):
         print(f"Error: Input folder '{input_folder}' does not exist.")
         return
 
-    all_dataframes = []  # List to store individual DataFrames
+    if is_mask_store(input_folder):
+        with MaskStore(input_folder) as store:
+            jobs = [(name, properties_list, input_folder) for name in store.keys()]
+    else:
+        # Recursively walk through input folder and collect .npy files
+        jobs = ((file, properties_list)
+                for file in iter_filepaths(input_folder, "li_thresh.npy", case_sensitive=True))
+
+    results = run_batch(_regionprops_job, jobs, workers=workers, executor=executor,
+                        instrumentation=instrumentation)
+    if treatment is not None:
+        results = (_add_treatment(result, treatment) for result in results)
+    return _collect_tables(results, output_path, instrumentation)
 
-    # Recursively walk through input folder and process .npy files
-    for root, _, files in os.walk(input_folder):
-        for file in files:
-            if file.endswith("li_thresh.npy"):
-                file_path = os.path.join(root, file)
 
-                try:
-                    df = apply_regionprops(file_path, properties_list)
-                    all_dataframes.append(df)
+def _collect_tables(results, output_path: Optional[str]=None,
+                    instrumentation: Optional[Instrumentation]=None):
+    """
+    Concatenate the tables of successful `FileResult`s, or append them to `output_path`.
+
+    Errors are printed and skipped. Returns the DataFrame, or the path when writing.
+    """
+    with instrumented(instrumentation):
+        if output_path is not None:
+            writer = _TableWriter(output_path)
+            try:
+                for result in results:
+                    if result.ok:
+                        with stage('write_table', result.file):
+                            writer.write(result.value)
+                    else:
+                        print(f"Error processing {result.file}: {result.error}")
+            finally:
+                with stage('close_table', output_path) as record:
+                    writer.close()
+                    if os.path.exists(output_path):
+                        record.bytes_written = os.path.getsize(output_path)
+            return str(output_path)
+
+        all_dataframes = []  # List to store individual DataFrames
+        for result in results:
+            if result.ok:
+                all_dataframes.append(result.value)
+            else:
+                print(f"Error processing {result.file}: {result.error}")
+
+        with stage('concat'):
+            return pd.concat(all_dataframes, ignore_index=True)
+
+
+def _threshold_and_measure(file: str, threshold_function: Callable[[str], np.ndarray],
+                           properties_list: tuple, mask_path: Optional[str]=None) -> pd.DataFrame:
+    """
+    Threshold one image and measure its mask without leaving the worker.
+
+    Module-level so it can run in worker processes. Only the table is returned; the
+    mask is written to `mask_path` if given.
+    """
+    with stage('threshold', file) as record:
+        binary_mask = threshold_function(file)
+        record.pixels = binary_mask.size
+    if mask_path is not None:
+        with stage('write', file) as record:
+            os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+            np.save(mask_path, binary_mask)
+            record.bytes_written = os.path.getsize(mask_path)
+    return measure_mask(binary_mask, properties_list, file)
+
+
+def measure_directory(input_folder: str,
+                      threshold_function: Callable[[str], np.ndarray]=apply_li_threshold,
+                      properties_list: tuple=DEFAULT_PROPERTIES,
+                      workers: Optional[int]=None,
+                      executor: Optional[Executor]=None,
+                      file_types: tuple=('.tif',),
+                      mask_folder: Optional[str]=None,
+                      output_path: Optional[str]=None,
+                      treatment: Optional[str]=None,
+                      instrumentation: Optional[Instrumentation]=None):
+    """
+    Threshold every image in a directory and measure its regions in a single pass.
+
+    Each image is thresholded, labeled and measured by the same worker, so the
+    binary masks never go to disk unless `mask_folder` is given. This replaces
+    `apply_threshold_recursively` followed by `apply_regionprops_recursively` when
+    the masks themselves are not needed.
+
+    Parameters
+    ----------
+    input_folder : str
+        Path to the root directory of the images. Subfolders are searched recursively.
+    threshold_function : callable, optional
+        A function that takes a file path and returns a binary NumPy array. Defaults to
+        `apply_li_threshold`. Must be picklable (defined at module level, or a
+        `functools.partial` of one) when running with `workers` or a process-based
+        `executor`.
+    properties_list : tuple of str, optional
+        Region properties to compute, as accepted by `skimage.measure.regionprops_table`.
+        Defaults to `DEFAULT_PROPERTIES`.
+    workers : int, optional
+        Number of worker processes handling images in parallel. `None` or `1` (default)
+        processes images serially in the current process.
+    executor : concurrent.futures.Executor, optional
+        An existing executor to run the work on instead of creating a process pool.
+    file_types : tuple of str, optional
+        File endings of the images to process (default is `('.tif',)`), matched
+        case-sensitively as in `apply_threshold_recursively`. The
+        `threshold_function` must be able to read every type.
+    mask_folder : str, optional
+        If given, each mask is also saved as `<image>_li_thresh.npy` in this folder,
+        mirroring the subfolders of `input_folder`, so that it can be read back by
+        `apply_regionprops_recursively`.
+    output_path : str, optional
+        Path of a `.csv` or `.parquet` file to append each image's table to as soon as
+        it is ready, as in `apply_regionprops_recursively`. The path is returned
+        instead of a DataFrame.
+    treatment : str, optional
+        If given, a 'treatment' column with this value is added to every row.
+    instrumentation : Instrumentation, optional
+        Records the time of every image and of its `'threshold'`, `'write'`, `'label'`
+        and `'regionprops'` stages (see `turmoric.instrumentation`).
+
+    Returns
+    -------
+    pandas.DataFrame or str
+        The region properties of all images, with a 'filename' column holding the
+        path of the source image. If `output_path` is given, the path of the written
+        file. Returns None if the input folder does not exist.
+
+    Examples
+    --------
+    >>> df = measure_directory('/data/images', properties_list=('area', 'perimeter'), workers=8)
+    >>> df.groupby('filename')['area'].mean()
+
+    >>> threshold = functools.partial(apply_li_threshold, channel=0)
+    >>> measure_directory('/data/images', threshold, output_path='regionprops.parquet')
+    'regionprops.parquet'
+    """
+    if not os.path.isdir(input_folder):
+        print(f"Error: Input folder '{input_folder}' does not exist.")
+        return
 
-                except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
+    def mask_path(file):
+        if mask_folder is None:
+            return None
+        stem = os.path.splitext(os.path.relpath(file, input_folder))[0]
+        return os.path.join(mask_folder, stem + '_li_thresh.npy')
 
-    return pd.concat(all_dataframes, ignore_index=True)
+    jobs = ((file, threshold_function, properties_list, mask_path(file))
+            for file in iter_filepaths(input_folder, tuple(file_types), case_sensitive=True))
+    results = run_batch(_threshold_and_measure, jobs, workers=workers, executor=executor,
+                        instrumentation=instrumentation)
+    if treatment is not None:
+        results = (_add_treatment(result, treatment) for result in results)
+    return _collect_tables(results, output_path, instrumentation)
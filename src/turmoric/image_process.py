@@ -2,7 +2,19 @@ import os
 import skimage
 import numpy as np
 from nd2 import ND2File
+import json
+import time
+import shutil
+import tempfile
 import tifffile
+from collections import defaultdict
+from concurrent.futures import Executor
+from typing import Callable, Iterator, Optional
+from turmoric.utils import BatchSummary, FileResult, iter_filepaths, run_batch
+from turmoric.instrumentation import Instrumentation, instrumented, stage
+
+JOURNAL_FILE = 'conversion_journal.jsonl'
+NORMALIZE_CHUNK_SIZE = 1 << 20
 
 def load_npy_file(path: str, file_name: str) -> np.ndarray:
     """
@@ -62,7 +74,41 @@ Examples
 
     return image_data
 
-def normalize_npy_data(npy_image_data: np.ndarray) -> np.ndarray:
+def _row_blocks(shape: tuple, chunk_size: int) -> Iterator[tuple]:
+    """
+    Split an array along its first axis into blocks of at most `chunk_size` elements.
+
+    Blocks hold at least one row, so rows larger than `chunk_size` form their own block.
+    """
+    if len(shape) == 0:
+        yield ()
+        return
+    row_size = int(np.prod(shape[1:], dtype=np.int64))
+    rows = max(1, chunk_size // max(row_size, 1))
+    for r0 in range(0, shape[0], rows):
+        yield (slice(r0, r0 + rows),)
+
+
+def _min_max(data: np.ndarray, chunk_size: int) -> tuple:
+    """
+    Minimum and maximum of an array in a single pass over its blocks.
+
+    Each block is reduced twice while it is still in cache, so a memory-mapped array
+    is read from disk only once.
+    """
+    lo = hi = None
+    for block in _row_blocks(data.shape, chunk_size):
+        chunk = data[block]
+        if chunk.size == 0:
+            continue
+        chunk_lo, chunk_hi = chunk.min(), chunk.max()
+        lo = chunk_lo if lo is None else min(lo, chunk_lo)
+        hi = chunk_hi if hi is None else max(hi, chunk_hi)
+    return lo, hi
+
+
+def normalize_npy_data(npy_image_data: np.ndarray, out: Optional[np.ndarray]=None,
+                       chunk_size: int=NORMALIZE_CHUNK_SIZE) -> np.ndarray:
     """
     Normalize NumPy image data array to uint8 format.
 
@@ -70,27 +116,39 @@ def normalize_npy_data(npy_image_data: np.ndarray) -> np.ndarray:
     normalized 8-bit unsigned integer format (`uint8`), suitable for image 
     processing and visualization. It handles boolean arrays by mapping 
     `True` to 255 and `False` to 0. For non-uint8 numeric arrays, it scales 
-    the values to the [0, 255] range.If the input is not already `uint8`, it
-    is linearly scaled to the range [0, 255].
+    the values to the [0, 255] range. `uint8` arrays are returned unchanged
+    (or copied into `out`).
 
     Parameters
     ----------
     npy_image_data : np.ndarray
         A NumPy array containing image data. Can be of dtype `bool`, 
         `float`, `int`, etc. The array must be 2D or compatible with
-        image-like data.
+        image-like data. May be a memory-mapped array (e.g. from
+        `np.load(..., mmap_mode='r')`).
+    out : np.ndarray, optional
+        A `uint8` array with the shape of `npy_image_data` that receives the result,
+        e.g. a buffer reused across images or a memory-mapped output file. By default
+        a new array is allocated.
+    chunk_size : int, optional
+        Number of elements processed at a time. Temporaries never exceed one chunk,
+        so memory use is independent of the image size. Defaults to 2**20.
 
     Returns
     -------
     normalized_image_data : np.ndarray
         A NumPy array of dtype `uint8` with values scaled to the range [0, 255].
+        This is `out` if it was given.
 
     Notes
     -----
     - Boolean arrays are multiplied by 255 to convert to `uint8`.
     - For non-boolean arrays, the data is scaled as:
-        `(array - array.min()) / (array.max() - array.min()) * 255`
-    - A small epsilon (`1e-8`) is added to the denominator to prevent division by zero.
+        `floor((array - array.min()) * 255 / (array.max() - array.min()))`
+      The minimum and maximum are found in a single pass over the data.
+    - Integer arrays are scaled in exact integer arithmetic, floating-point arrays in
+      `float32`. No full-size `float64` copy of the image is made.
+    - Constant arrays are mapped to 0.
 
     Examples
     --------
@@ -111,18 +169,63 @@ def normalize_npy_data(npy_image_data: np.ndarray) -> np.ndarray:
     >>> normalized_mask
     array([[255,   0],
            [  0, 255]], dtype=uint8)
+
+    # Reuse one output buffer for a memory-mapped label image
+    >>> labels = np.load('labels.npy', mmap_mode='r')
+    >>> buffer = np.empty(labels.shape, dtype=np.uint8)
+    >>> normalize_npy_data(labels, out=buffer)
     """
+    if out is None:
+        if npy_image_data.dtype == np.uint8:
+            return npy_image_data
+        out = np.empty(npy_image_data.shape, dtype=np.uint8)
+    elif out.dtype != np.uint8 or out.shape != npy_image_data.shape:
+        raise ValueError(f"out must be a uint8 array of shape {npy_image_data.shape}, "
+                         f"got {out.dtype} array of shape {out.shape}.")
+
+    if npy_image_data.dtype == np.uint8:
+        np.copyto(out, npy_image_data)
+        return out
     if npy_image_data.dtype == np.bool_:
         # Convert boolean to uint8 (True -> 255, False -> 0)
-        normalized_image_data = (npy_image_data * 255).astype(np.uint8)
-    else:
-        # Normalize and scale image data to uint8 if it's not already
-        if npy_image_data.dtype != np.uint8:
-            normalized_image_data = (
-                255 * (npy_image_data - npy_image_data.min()) / (npy_image_data.ptp() + 1e-8)
-            ).astype(np.uint8)
+        np.multiply(npy_image_data, 255, out=out, dtype=np.uint8)
+        return out
+
+    lo, hi = _min_max(npy_image_data, chunk_size)
+    if lo is None or hi == lo:
+        out[...] = 0
+        return out
+
+    # Integers are scaled exactly as long as (max - min) * 255 fits in int64. Differences
+    # are taken modulo 2**64, so they are exact for any signed or unsigned input.
+    ptp = int(hi) - int(lo) if npy_image_data.dtype.kind in 'iu' else None
+    use_integers = ptp is not None and ptp <= np.iinfo(np.int64).max // 255
+    work_dtype = np.int64 if use_integers else np.float32
+    offset = np.array(lo).astype(np.int64) if use_integers else np.float32(lo)
+    # Range as computed in float32, so that the maximum is divided by itself and maps to 255
+    span = np.float32(hi) - np.float32(lo)
+    if not use_integers and span == 0:
+        out[...] = 0
+        return out
+
+    work = np.empty(min(npy_image_data.size, max(chunk_size, 1)), dtype=work_dtype)
+    for block in _row_blocks(npy_image_data.shape, chunk_size):
+        chunk = npy_image_data[block]
+        if chunk.size <= work.size:
+            buffer = work[:chunk.size].reshape(chunk.shape)
+        else:
+            # A single row larger than `chunk_size`
+            buffer = np.empty(chunk.shape, dtype=work_dtype)
+        np.subtract(chunk, offset, out=buffer, dtype=work_dtype, casting='unsafe')
+        if use_integers:
+            buffer *= 255
+            buffer //= ptp
+        else:
+            buffer /= span
+            buffer *= 255
+        np.copyto(out[block], buffer, casting='unsafe')
 
-    return normalized_image_data
+    return out
 
 def save_npy_as_tif():
     # Construct the output TIFF file path
@@ -137,12 +240,13 @@ def save_npy_as_tif():
         # io.imsave(tiff_path, image_data)
     pass
     
-def nd2_to_tif(path: str, file_name: str) -> None:
+def nd2_to_tif(path: str, file_name: str, instrumentation: Optional[Instrumentation]=None) -> None:
     """
     Convert an `.nd2` microscopy image file to a `.tif` file.
 
     This function reads a Nikon ND2 image file from the specified path and converts it
-    to a TIFF file using `tifffile.imwrite`. The output `.tif` file is saved in the
+    to a TIFF file frame by frame with `nd2_to_tif_streaming`, so the acquisition is
+    never loaded into memory at once. The output `.tif` file is saved in the
     same directory with the same base name.
 
     Parameters
@@ -151,6 +255,9 @@ def nd2_to_tif(path: str, file_name: str) -> None:
         Directory containing the `.nd2` file.
     file_name : str
         Name of the `.nd2` file to convert.
+    instrumentation : Instrumentation, optional
+        Records the time, bytes and pixels of the `'convert'` stage (see
+        `turmoric.instrumentation`).
 
     Returns
     -------
@@ -172,13 +279,794 @@ def nd2_to_tif(path: str, file_name: str) -> None:
     """
     nd2_path = os.path.join(path, file_name)
     tif_path = os.path.join(path, file_name.replace(".nd2", ".tif"))
-    
-    with ND2File(nd2_path) as nd2_file:
-        nd2_data = nd2_file.asarray()
 
-        tifffile.imwrite(tif_path, nd2_data)
+    with instrumented(instrumentation):
+        nd2_to_tif_streaming(nd2_path, tif_path, tile=None, ome=False)
 
-    
- 
-def load_tif_file():
-    pass
\ No newline at end of file
+
+def _iter_segments(frames, frame_shape: tuple, is_rgb: bool, tile: Optional[tuple]):
+    """
+    Split a stream of ND2 frames into the pages, or the tiles of each page, in TIFF order.
+
+    Edge tiles are zero-padded to the full tile shape, as TIFF requires.
+    """
+    plane_shape = frame_shape[-3:] if is_rgb else frame_shape[-2:]
+    for frame in frames:
+        for plane in np.asarray(frame).reshape((-1,) + plane_shape):
+            if tile is None:
+                yield plane
+                continue
+            for r0 in range(0, plane_shape[0], tile[0]):
+                for c0 in range(0, plane_shape[1], tile[1]):
+                    segment = plane[r0:r0 + tile[0], c0:c0 + tile[1]]
+                    if segment.shape[:2] != tuple(tile):
+                        padded = np.zeros(tuple(tile) + segment.shape[2:], dtype=segment.dtype)
+                        padded[:segment.shape[0], :segment.shape[1]] = segment
+                        segment = padded
+                    yield segment
+
+
+def nd2_to_tif_streaming(nd2_path: str, tif_path: str, compression: Optional[str]=None,
+                         tile: Optional[tuple]=(512, 512), ome: bool=True,
+                         include_unstructured_metadata: bool=False, return_frames: bool=False):
+    """
+    Convert an `.nd2` file to a BigTIFF one frame at a time.
+
+    Unlike reading the whole acquisition with `ND2File.asarray()`, frames are read
+    lazily with `ND2File.read_frame` and written to the TIFF as they are read. Memory
+    use is one frame, whatever the number of positions, time points or z-planes.
+
+    Parameters
+    ----------
+    nd2_path : str
+        Path of the `.nd2` file.
+    tif_path : str
+        Path of the `.tif` file to write.
+    compression : str, optional
+        TIFF compression, e.g. `'zlib'`, `'zstd'` or `'lzw'`. Defaults to None
+        (uncompressed).
+    tile : tuple of int, optional
+        Tile shape `(rows, columns)`, multiples of 16. Defaults to `(512, 512)`. Pass
+        None to write contiguous pages, which `tifffile.memmap` (and
+        `open_tif_channel`) can memory-map when uncompressed.
+    ome : bool, optional
+        Embed the OME-XML metadata of the acquisition (channels, pixel sizes, plane
+        positions and timings) generated by the `nd2` reader. Requires `ome-types`.
+        Defaults to True.
+    include_unstructured_metadata : bool, optional
+        With `ome`, also embed all of the raw ND2 metadata as structured annotations.
+    return_frames : bool, optional
+        Also return the number of frames converted, counted while they are written,
+        so callers need not open the `.nd2` again. Defaults to False.
+
+    Returns
+    -------
+    tif_path : str
+        Path of the written file.
+    frames : int
+        Number of frames, if `return_frames` is True.
+
+    Notes
+    -----
+    - Pages follow the order of `ND2File.asarray()`. Without `ome`, the file holds a
+      single series equal to `ND2File.asarray()`, with its axes (e.g. `'TZCYX'`)
+      recorded in the TIFF metadata.
+    - OME-TIFF describes one 5D image per stage position, so with `ome` a
+      multi-position acquisition is written as one series per position (read them
+      with `tifffile.imread(tif_path, series=p)`).
+
+    Examples
+    --------
+    >>> nd2_to_tif_streaming("timelapse.nd2", "timelapse.ome.tif", compression='zlib')
+    'timelapse.ome.tif'
+    """
+    with stage('convert', nd2_path) as record:
+        with ND2File(nd2_path) as nd2_file:
+            sizes = dict(nd2_file.sizes)
+            pixels = int(np.prod([size for axis, size in sizes.items() if axis != 'S']))
+            record.pixels = pixels
+            record.bytes_read = pixels * np.dtype(nd2_file.dtype).itemsize * sizes.get('S', 1)
+            loop_indices = list(nd2_file.loop_indices)
+            n_positions = sizes.pop('P', 1) if ome else 1
+
+            # Group frames by position so that each position becomes one OME series
+            groups = {}
+            for frame_number, index in enumerate(loop_indices):
+                position = index.get('P', 0) if ome else 0
+                groups.setdefault(position, []).append(frame_number)
+
+            description = None
+            if ome and not nd2_file.is_legacy:
+                metadata = nd2_file.ome_metadata(include_unstructured=include_unstructured_metadata,
+                                                 tiff_file_name=os.path.basename(tif_path))
+                description = metadata.to_xml(exclude_unset=True).encode('utf-8')
+
+            frame_axes = 'CYXS' if nd2_file.is_rgb else 'CYX'
+            frame_shape = tuple(size for axis, size in sizes.items() if axis in frame_axes)
+            shape = tuple(sizes.values())
+            axes = ''.join(sizes).upper().replace('U', 'Q')
+            pixel_size = nd2_file.voxel_size().x or 1
+            options = dict(
+                shape=shape,
+                dtype=nd2_file.dtype,
+                photometric='rgb' if nd2_file.is_rgb else 'minisblack',
+                compression=compression,
+                tile=tuple(tile) if tile is not None else None,
+                resolution=(1 / pixel_size, 1 / pixel_size),
+                resolutionunit=tifffile.RESUNIT.MICROMETER,
+                description=description,
+                metadata=None if description is not None else {'axes': axes},
+            )
+
+            with tifffile.TiffWriter(tif_path, bigtiff=True,
+                                     ome=False if description is not None else None) as tif:
+                for position in range(n_positions):
+                    frames = (nd2_file.read_frame(frame_number) for frame_number in groups[position])
+                    tif.write(_iter_segments(frames, frame_shape, nd2_file.is_rgb, options['tile']),
+                              **options)
+        record.bytes_written = os.path.getsize(tif_path)
+
+    return (tif_path, len(loop_indices)) if return_frames else tif_path
+
+
+def convert_nd2(nd2_path: str, tif_path: str, options: Optional[dict]=None) -> dict:
+    """
+    Convert one `.nd2` file to a `.tif` atomically and report its throughput.
+
+    The TIFF is written under its final name inside a hidden temporary directory
+    next to `tif_path` (so the OME-XML refers to the right file name), then moved
+    into place with `os.replace`. A crash never leaves a partial `tif_path`.
+    Module-level so that it can be sent to worker processes by `run_batch`.
+
+    Parameters
+    ----------
+    nd2_path : str
+        Path to the `.nd2` file.
+    tif_path : str
+        Path of the `.tif` file to write.
+    options : dict, optional
+        Keyword arguments of `nd2_to_tif_streaming`, such as `compression`, `tile`
+        and `ome`.
+
+    Returns
+    -------
+    dict
+        `output` (the path of the `.tif`), `bytes` (size of the `.nd2`), `frames`,
+        `seconds` and `worker` (process id).
+
+    Examples
+    --------
+    >>> convert_nd2('slice1.nd2', 'tifs/slice1.tif', {'compression': 'zlib'})['frames']
+    12
+    """
+    start = time.perf_counter()
+    output_dir = os.path.dirname(os.path.abspath(tif_path))
+    os.makedirs(output_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix='.nd2_to_tif-', dir=output_dir)
+    try:
+        temp_path, frames = nd2_to_tif_streaming(nd2_path, os.path.join(temp_dir, os.path.basename(tif_path)),
+                                                 return_frames=True, **(options or {}))
+        os.replace(temp_path, tif_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {'output': tif_path,
+            'bytes': os.path.getsize(nd2_path),
+            'frames': frames,
+            'seconds': time.perf_counter() - start,
+            'worker': os.getpid()}
+
+
+def _read_journal(path: str) -> dict:
+    """
+    Load the entries of a conversion journal, keyed by input name. Later lines win.
+
+    A truncated last line, as left by a crash mid-write, is ignored.
+    """
+    entries = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entries[entry['input']] = entry
+    return entries
+
+
+def _is_converted(entry: Optional[dict], nd2_path: str, tif_path: str) -> bool:
+    if entry is None or not os.path.isfile(tif_path):
+        return False
+    try:
+        stat = os.stat(nd2_path)
+    except OSError:
+        return False
+    return entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+
+def batch_nd2_to_tif(input_folder: str, output_folder: Optional[str]=None,
+                     workers: Optional[int]=None, executor: Optional[Executor]=None,
+                     resume: bool=True, compression: Optional[str]=None,
+                     tile: Optional[tuple]=(512, 512), ome: bool=True,
+                     instrumentation: Optional[Instrumentation]=None) -> BatchSummary:
+    """
+    Convert every `.nd2` file below a folder to `.tif`, in parallel and resumably.
+
+    Parameters
+    ----------
+    input_folder : str
+        Folder searched recursively for `.nd2` files.
+    output_folder : str, optional
+        Folder receiving the `.tif` files, mirroring the subfolders of `input_folder`.
+        Defaults to writing each `.tif` next to its `.nd2`, like `nd2_to_tif`.
+    workers : int, optional
+        Number of worker processes. `None` or `1` (default) converts files serially.
+    executor : concurrent.futures.Executor, optional
+        An existing executor to run the conversions on. It is not shut down when the
+        function returns.
+    resume : bool, optional
+        Skip files that the journal records as converted, as long as the `.nd2` has
+        the same size and modification time and the `.tif` still exists. With False,
+        every file is converted and the journal is started afresh. Defaults to True.
+    compression, tile, ome
+        Passed to `nd2_to_tif_streaming`.
+    instrumentation : Instrumentation, optional
+        Records the time of every file and the bytes and pixels of its `'convert'`
+        stage (see `turmoric.instrumentation`).
+
+    Returns
+    -------
+    BatchSummary
+        Per-file results in input order. The value of each converted file is a dict
+        with the `'output'` path, the `'bytes'` and `'frames'` read, the `'seconds'`
+        spent and the process id of the `'worker'`. Files skipped on resume are marked
+        `cached`. See `conversion_throughput` for a per-worker report.
+        Returns None if the input folder does not exist.
+
+    Notes
+    -----
+    - Each file is written to a temporary file in the output folder and renamed into
+      place once complete, so outputs are either absent or whole.
+    - Completed conversions are appended to a JSON-lines journal,
+      `conversion_journal.jsonl` in the output folder, which is flushed after every
+      file. An interrupted run therefore resumes from the first unconverted file.
+    - Temporary directories (`.nd2_to_tif-*`) of a run that was killed can be deleted.
+
+    Examples
+    --------
+    >>> summary = batch_nd2_to_tif('raw/', 'tif/', workers=8, compression='zlib')
+    >>> print(summary)
+    >>> for worker, stats in conversion_throughput(summary).items():
+    ...     print(worker, f"{stats['mb_per_s']:.1f} MB/s", f"{stats['frames_per_s']:.1f} frames/s")
+    """
+    if not os.path.isdir(input_folder):
+        print(f"Error: Input folder '{input_folder}' does not exist.")
+        return
+
+    output_root = input_folder if output_folder is None else output_folder
+    os.makedirs(output_root, exist_ok=True)
+    journal_path = os.path.join(output_root, JOURNAL_FILE)
+    journal = _read_journal(journal_path) if resume else {}
+
+    start = time.perf_counter()
+    file_list = list(iter_filepaths(input_folder, '.nd2', sort=True))
+    names = [os.path.relpath(file, input_folder) for file in file_list]
+    outputs = [os.path.join(output_root, os.path.splitext(name)[0] + '.tif') for name in names]
+
+    # Resumed files keep their slot so results stay in input order
+    results = [None] * len(file_list)
+    todo = []
+    for index, (file, name) in enumerate(zip(file_list, names)):
+        entry = journal.get(name)
+        if _is_converted(entry, file, outputs[index]):
+            results[index] = FileResult(file=file, value=entry['output'], cached=True)
+        else:
+            todo.append(index)
+
+    options = {'compression': compression, 'tile': tile, 'ome': ome}
+    jobs = ((file_list[index], outputs[index], options) for index in todo)
+    with open(journal_path, 'a' if resume else 'w') as journal_file:
+        for index, result in zip(todo, run_batch(convert_nd2, jobs, workers=workers,
+                                                 executor=executor,
+                                                 instrumentation=instrumentation)):
+            if result.ok:
+                stat = os.stat(result.file)
+                journal_file.write(json.dumps({'input': names[index],
+                                               'output': outputs[index],
+                                               'size': stat.st_size,
+                                               'mtime_ns': stat.st_mtime_ns,
+                                               'bytes': result.value['bytes'],
+                                               'frames': result.value['frames'],
+                                               'seconds': result.value['seconds']}) + '\n')
+                journal_file.flush()
+            results[index] = result
+
+    return BatchSummary(results=results, elapsed=time.perf_counter() - start)
+
+
+def conversion_throughput(summary: BatchSummary) -> dict:
+    """
+    Aggregate the throughput of a `batch_nd2_to_tif` run per worker process.
+
+    Parameters
+    ----------
+    summary : BatchSummary
+        Result of `batch_nd2_to_tif`. Failed and resumed files are ignored.
+
+    Returns
+    -------
+    dict
+        Maps each worker's process id to a dict with the number of `'files'`,
+        `'frames'` and `'megabytes'` (10**6 bytes of `.nd2` input) it converted, the
+        `'seconds'` it spent, and its `'mb_per_s'` and `'frames_per_s'`.
+    """
+    totals = defaultdict(lambda: {'files': 0, 'frames': 0, 'megabytes': 0.0, 'seconds': 0.0})
+    for result in summary.succeeded:
+        if result.cached:
+            continue
+        stats = totals[result.value['worker']]
+        stats['files'] += 1
+        stats['frames'] += result.value['frames']
+        stats['megabytes'] += result.value['bytes'] / 1e6
+        stats['seconds'] += result.value['seconds']
+
+    for stats in totals.values():
+        seconds = stats['seconds'] or float('nan')
+        stats['mb_per_s'] = stats['megabytes'] / seconds
+        stats['frames_per_s'] = stats['frames'] / seconds
+    return dict(totals)
+
+
+def read_tif_metadata(file: str) -> dict:
+    """
+    Read the shape, dtype and axes of a `.tif` image without decoding its pixels.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.tif` file.
+
+    Returns
+    -------
+    metadata : dict
+        Dictionary with keys `'shape'` (tuple of int), `'dtype'` (numpy dtype) and
+        `'axes'` (tifffile axes string, e.g. `'YXS'` or `'CYX'`) describing the first
+        image series in the file, which is what `tifffile.imread` returns.
+
+    Raises
+    ------
+    ValueError
+        If the file cannot be parsed as a TIFF.
+
+    Examples
+    --------
+    >>> read_tif_metadata("microglia_image.tif")
+    {'shape': (1024, 1024, 3), 'dtype': dtype('uint8'), 'axes': 'YXS'}
+    """
+    try:
+        with tifffile.TiffFile(file) as tif:
+            series = tif.series[0]
+            return {'shape': tuple(series.shape), 'dtype': series.dtype, 'axes': series.axes}
+    except Exception as e:
+        raise ValueError(f"Could not read image {file}: {e}")
+
+
+def validate_tif_channel(file: str, channel: int, channel_axis: int=-1) -> dict:
+    """
+    Check that a `.tif` or `.tiff` file exists, is a 2D or 3D image and has the requested channel.
+
+    Only the TIFF header is read, so validation is cheap even on networked storage.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.tif` file.
+    channel : int
+        Index of the channel that will be selected from a multi-channel image.
+    channel_axis : int, optional
+        Axis holding the channels of a 3D image (default is -1, channels last).
+
+    Returns
+    -------
+    metadata : dict
+        The metadata returned by `read_tif_metadata`.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the file does not exist.
+    ValueError
+        If the file is not a `.tif`, cannot be read, is not 2D or 3D, or if `channel`
+        is not a valid channel index for the image.
+    """
+    # Check if the file exists
+    if not os.path.isfile(file):
+        raise FileNotFoundError(f"File {file} does not exist.")
+    # Check if the file is a .tif image
+    if not file.lower().endswith(('.tif', '.tiff')):
+        raise ValueError(f"File {file} is not a .tif image.")
+    # Check if the channel is valid
+    if not isinstance(channel, int) or channel < 0:
+        raise ValueError("Channel must be a non-negative integer.")
+
+    metadata = read_tif_metadata(file)
+    shape = metadata['shape']
+    # Check if the image is multi-channel
+    if len(shape) not in [2, 3]:
+        raise ValueError(f"Image {file} is not a valid 2D or 3D image.")
+    # Check if the channel is valid for the image
+    if len(shape) == 3 and channel >= shape[channel_axis]:
+        raise ValueError(f"Channel {channel} is out of bounds for image {file}.")
+    return metadata
+
+
+def _read_page_sample(page, sample: int) -> np.ndarray:
+    """
+    Decode a single sample (channel) of a TIFF page strip by strip or tile by tile.
+
+    For planar (`planarconfig=separate`) pages only the strips of the requested sample
+    are read from disk. For interleaved pages every strip is decoded, but only the
+    requested sample is kept, so peak memory is one strip plus the output plane.
+    """
+    keyframe = page.keyframe
+    separate, _, length, width, contig = keyframe.shaped
+    fh = page.parent.filehandle
+
+    if separate > 1:
+        per_sample = len(page.dataoffsets) // separate
+        indices = range(sample * per_sample, (sample + 1) * per_sample)
+        sample_index = 0
+    else:
+        indices = range(len(page.dataoffsets))
+        sample_index = sample
+
+    decodeargs = {'_fullsize': keyframe.is_tiled}
+    if keyframe.compression in {6, 7, 34892, 33007}:  # JPEG
+        decodeargs['jpegtables'] = page.jpegtables
+        decodeargs['jpegheader'] = keyframe.jpegheader
+
+    out = np.zeros((length, width), dtype=keyframe.dtype)
+    offsets = [page.dataoffsets[i] for i in indices]
+    bytecounts = [page.databytecounts[i] for i in indices]
+    for data in fh.read_segments(offsets, bytecounts, indices=list(indices),
+                                 lock=fh.lock, sort=True):
+        segment, (_, _, row, col, _), shape = keyframe.decode(*data, **decodeargs)
+        if segment is None:
+            continue  # empty segments stay zero
+        rows = min(shape[1], length - row)
+        cols = min(shape[2], width - col)
+        out[row:row + rows, col:col + cols] = segment[0, :rows, :cols, sample_index]
+    return out
+
+
+def read_tif_channel(file: str, channel: int, channel_axis: int=-1) -> np.ndarray:
+    """
+    Decode a single channel of a multi-channel `.tif` without loading the other channels.
+
+    The result is identical to `np.take(tifffile.imread(file), channel, axis=channel_axis)`,
+    but only the data of the requested channel is kept in memory:
+
+    - channels stored as separate pages (e.g. `'CYX'` stacks) read a single page;
+    - planar samples (`planarconfig=separate`) read only that sample's strips or tiles;
+    - interleaved samples (e.g. RGB `'YXS'`) are sliced from a memory map when the file
+      is uncompressed, or decoded one strip or tile at a time otherwise.
+
+    Any other layout falls back to decoding the whole image.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.tif` file.
+    channel : int
+        Index of the channel to read.
+    channel_axis : int, optional
+        Axis of the image (as returned by `tifffile.imread`) that holds the channels
+        (default is -1, channels last).
+
+    Returns
+    -------
+    image : ndarray
+        2D array with the selected channel.
+
+    Examples
+    --------
+    >>> microglia_im = read_tif_channel("stack.tif", channel=1, channel_axis=0)
+    """
+    with tifffile.TiffFile(file) as tif:
+        series = tif.series[0]
+        shape = tuple(series.shape)
+        axis = channel_axis % len(shape)
+        pages = series.pages
+
+        if len(shape) == 3 and axis == 0 and len(pages) == shape[0] and len(pages) > 1:
+            # One page per channel
+            return pages[channel].asarray()
+
+        if len(shape) == 3 and len(pages) == 1 and series.axes[axis] == 'S':
+            page = pages[0]
+            if page.is_memmappable and page.planarconfig == 1:
+                # Uncompressed interleaved samples, copy the channel out of a memory map
+                memmap = tifffile.memmap(file, mode='r')
+                image = np.array(np.take(memmap, channel, axis=axis))
+                del memmap
+                return image
+            return _read_page_sample(page, channel)
+
+        image = series.asarray()
+    return np.take(image, channel, axis=axis)
+
+
+def open_tif_channel(file: str, channel: int=None, channel_axis: int=-1) -> np.ndarray:
+    """
+    Open a single channel of a `.tif` for random access without decoding it.
+
+    For uncompressed files the result is a read-only view of a memory map, so slicing
+    a region (e.g. a tile of a whole-slide scan) only reads that region from disk.
+    Compressed files cannot be memory-mapped; the channel is then decoded with
+    `read_tif_channel` and held in memory.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.tif` file.
+    channel : int, optional
+        Index of the channel of a 3D image. Ignored for 2D images.
+    channel_axis : int, optional
+        Axis holding the channels of a 3D image (default is -1, channels last).
+
+    Returns
+    -------
+    image : numpy.memmap or ndarray
+        2D array-like with the selected channel.
+
+    Examples
+    --------
+    >>> microglia_im = open_tif_channel("whole_slice.tif", channel=1, channel_axis=0)
+    >>> tile = np.asarray(microglia_im[:4096, :4096])
+    """
+    with tifffile.TiffFile(file) as tif:
+        series = tif.series[0]
+        shape = tuple(series.shape)
+        pages = series.pages
+        axis = channel_axis % len(shape)
+        if len(shape) == 3 and axis == 0 and len(pages) == shape[0] and len(pages) > 1:
+            # One page per channel
+            if pages[channel].is_memmappable:
+                return tifffile.memmap(file, page=channel, mode='r')
+        elif series.dataoffset is not None:
+            memmap = tifffile.memmap(file, mode='r')
+            if len(shape) == 2:
+                return memmap
+            index = [slice(None)] * 3
+            index[axis] = channel
+            return memmap[tuple(index)]
+
+    if len(shape) == 2:
+        return tifffile.imread(file)
+    return read_tif_channel(file, channel, channel_axis)
+
+
+def load_tif_file(file: str, channel: int=None, channel_axis: int=-1, validate: bool=True) -> np.ndarray:
+    """
+    Read a `.tif` image once and optionally select a single channel.
+
+    This is the common image-loading step of the thresholding functions. The file is
+    validated from its TIFF metadata (see `validate_tif_channel`) before any pixels are
+    decoded, and the pixel data is then read exactly once. When a channel is requested,
+    only that channel is decoded (see `read_tif_channel`).
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.tif` file.
+    channel : int, optional
+        Index of the channel to return if the image is multi-channel. 2D images are
+        returned as-is. If None (default), the full array is returned.
+    channel_axis : int, optional
+        Axis holding the channels of a 3D image (default is -1, channels last). Use 0
+        for channel-first stacks such as those written by `nd2_to_tif`.
+    validate : bool, optional
+        Validate the file and channel from the TIFF metadata before decoding (default True).
+
+    Returns
+    -------
+    image : ndarray
+        The decoded image, or the selected 2D channel.
+
+    Examples
+    --------
+    >>> microglia_im = load_tif_file("microglia_image.tif", channel=1)
+    >>> microglia_im.shape
+    (1024, 1024)
+    """
+    if validate:
+        metadata = validate_tif_channel(file, 0 if channel is None else channel, channel_axis)
+    else:
+        metadata = read_tif_metadata(file)
+
+    try:
+        if channel is None or len(metadata['shape']) != 3:
+            return tifffile.imread(file)
+        # Only decode the requested channel
+        return read_tif_channel(file, channel, channel_axis)
+    except Exception as e:
+        raise ValueError(f"Could not read image {file}: {e}")
+
+
+def read_nd2_channel(file: str, channel: int=None, position: int=None) -> np.ndarray:
+    """
+    Read a channel and stage position of an `.nd2` file without converting it to `.tif`.
+
+    Only the frames of the requested position are read from disk (with
+    `ND2File.read_frame`), and only the requested channel of each frame is kept.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.nd2` file.
+    channel : int, optional
+        Index along the `'C'` dimension. If None (default), all channels are returned.
+        Images without a `'C'` dimension only accept channel 0 or None.
+    position : int, optional
+        Index along the `'P'` (stage position) dimension. If None (default), all
+        positions are returned, as by `ND2File.asarray()`. Files without a `'P'`
+        dimension only accept position 0 or None.
+
+    Returns
+    -------
+    image : ndarray
+        Array with the dimensions of `ND2File.asarray()` minus the selected ones, e.g.
+        `(Y, X)` for a single-frame acquisition or `(T, Y, X)` for a time series.
+
+    Raises
+    ------
+    ValueError
+        If the channel or position is out of range.
+
+    Examples
+    --------
+    >>> microglia_im = read_nd2_channel("slice1.nd2", channel=1, position=3)
+    """
+    with ND2File(file) as nd2_file:
+        sizes = dict(nd2_file.sizes)
+        for axis, index, name in (('C', channel, 'Channel'), ('P', position, 'Position')):
+            if index is not None and not 0 <= index < sizes.get(axis, 1):
+                raise ValueError(f"{name} {index} is out of range for image {file} "
+                                 f"with {sizes.get(axis, 1)} {name.lower()}s.")
+
+        frames = [frame_number for frame_number, index in enumerate(nd2_file.loop_indices)
+                  if position is None or index.get('P', 0) == position]
+        if position is not None:
+            sizes.pop('P', None)
+
+        frame_axes = [axis for axis in sizes if axis in 'CYXS']
+        channel_axis = frame_axes.index('C') if channel is not None and 'C' in frame_axes else None
+        if channel_axis is not None:
+            del sizes['C']
+        loop_shape = tuple(size for axis, size in sizes.items() if axis not in 'CYXS')
+        frame_shape = tuple(size for axis, size in sizes.items() if axis in 'CYXS')
+
+        image = np.empty(loop_shape + frame_shape, dtype=nd2_file.dtype)
+        planes = image.reshape((-1,) + frame_shape)
+        for plane, frame_number in zip(planes, frames):
+            frame = np.asarray(nd2_file.read_frame(frame_number))
+            plane[...] = frame if channel_axis is None else np.take(frame, channel, axis=channel_axis)
+    return image
+
+
+def _read_tif(file: str, channel: int=None, channel_axis: int=-1, position: int=None) -> np.ndarray:
+    """
+    Reader of the `.tif` files in the registry, see `load_tif_file`.
+
+    `position` selects a series of multi-series files, such as the one-series-per-position
+    OME-TIFFs written by `nd2_to_tif_streaming`.
+    """
+    if not position:
+        return load_tif_file(file, channel, channel_axis, validate=False)
+    try:
+        image = tifffile.imread(file, series=position)
+    except Exception as e:
+        raise ValueError(f"Could not read series {position} of image {file}: {e}")
+    if channel is None or image.ndim < 3:
+        return image
+    return np.take(image, channel, axis=channel_axis)
+
+
+def _read_nd2(file: str, channel: int=None, channel_axis: int=-1, position: int=None) -> np.ndarray:
+    """
+    Reader of the `.nd2` files in the registry, see `read_nd2_channel`.
+
+    The channel axis is known from the ND2 metadata, so `channel_axis` is ignored.
+    """
+    return read_nd2_channel(file, channel, position)
+
+
+READERS = {'.tif': _read_tif, '.tiff': _read_tif, '.nd2': _read_nd2}
+
+
+def register_reader(extension: str, reader: Callable=None):
+    """
+    Register a function that reads images of a file type for `read_image`.
+
+    Parameters
+    ----------
+    extension : str
+        File ending handled by the reader, e.g. `'.czi'`. Matched case-insensitively.
+    reader : callable, optional
+        Called as `reader(file, channel=None, channel_axis=-1, position=None)` and
+        returning an ndarray. The reader should select the channel and position while
+        reading, rather than after loading the whole file. It replaces any reader
+        already registered for `extension`. If omitted, `register_reader` returns a
+        decorator.
+
+    Returns
+    -------
+    callable
+        The reader, so that `register_reader` can be used as a decorator.
+
+    Examples
+    --------
+    >>> @register_reader('.czi')
+    ... def read_czi(file, channel=None, channel_axis=-1, position=None):
+    ...     ...
+    """
+    if reader is None:
+        return lambda reader: register_reader(extension, reader)
+    READERS[extension.lower()] = reader
+    return reader
+
+
+def get_reader(file: str) -> Callable:
+    """
+    Return the registered reader for `file`, chosen by the longest matching extension.
+
+    Raises
+    ------
+    ValueError
+        If no reader is registered for the file type.
+    """
+    name = file.lower()
+    matches = [extension for extension in READERS if name.endswith(extension)]
+    if not matches:
+        raise ValueError(f"No reader registered for {file}. "
+                         f"Supported file types are {', '.join(sorted(READERS))}.")
+    return READERS[max(matches, key=len)]
+
+
+def read_image(file: str, channel: int=None, channel_axis: int=-1, position: int=None) -> np.ndarray:
+    """
+    Read an image of any registered file type, selecting a channel and position.
+
+    This is the common entry point of the thresholding functions, so that `.nd2`
+    acquisitions can be thresholded directly instead of being converted to `.tif`
+    first. See `register_reader` to add file types.
+
+    Parameters
+    ----------
+    file : str
+        Path to the image.
+    channel : int, optional
+        Index of the channel to return. If None (default), all channels are returned.
+    channel_axis : int, optional
+        Axis holding the channels of 3D `.tif` images (default is -1, channels last).
+        Ignored by `.nd2` files, whose channel axis is recorded in their metadata.
+    position : int, optional
+        Stage position of an `.nd2` file, or series of a multi-series `.tif`. If None
+        (default), `.nd2` files return all positions and `.tif` files their first series.
+
+    Returns
+    -------
+    image : ndarray
+        The decoded image.
+
+    Examples
+    --------
+    >>> microglia_im = read_image("slice1.nd2", channel=1, position=0)
+    >>> microglia_im = read_image("slice1.tif", channel=1, channel_axis=0)
+    """
+    with stage('read', file) as record:
+        image = get_reader(file)(file, channel=channel, channel_axis=channel_axis, position=position)
+        record.bytes_read = image.nbytes
+        record.pixels = image.size
+    return image
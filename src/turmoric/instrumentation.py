@@ -0,0 +1,463 @@
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import tracemalloc
+import contextvars
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, asdict, field
+from typing import Iterable, Iterator, List, Optional, Union
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+Per-file and per-stage timing of the batch functions.
+
+Library code marks its stages with `stage`:
+
+    with stage('read', file) as record:
+        image = ...
+        record.pixels = image.size
+
+Outside an instrumented run this does nothing but create the record. When a
+function is called with an `Instrumentation`, every stage run under it, in this
+process or in the worker processes of `run_batch`, produces a `StageRecord`
+with its wall time, bytes read and written, pixels and the peak memory of the
+process. Records are passed to a sink:
+
+- `LoggingSink` logs one `key=value` line per record (the default);
+- `JSONLinesSink` appends one JSON object per line to a file;
+- `MemorySink` keeps the records in a list, e.g. for tests.
+
+Stages nest: a record holds the name of its enclosing stage in `parent`, and
+each file processed by `run_batch` is wrapped in a `'file'` stage. cProfile
+and tracemalloc can be switched on for chosen stages.
+
+>>> with Instrumentation(JSONLinesSink('timings.jsonl'), profile=('regionprops',)) as instrumentation:
+...     apply_regionprops_recursively('masks/', workers=8, instrumentation=instrumentation)
+>>> summarize_stages('timings.jsonl')
+"""
+
+PROFILE_DIR = 'profiles'
+
+
+@dataclass
+class StageRecord:
+    """
+    Measurements of one run of a stage.
+
+    Attributes
+    ----------
+    stage : str
+        Name of the stage, e.g. `'read'`, `'threshold'` or `'regionprops'`.
+    file : str, optional
+        Input file (or mask name) the stage worked on. Inherited from the enclosing
+        stage if not given.
+    seconds : float
+        Wall time of the stage.
+    bytes_read, bytes_written : int, optional
+        Bytes of the arrays read and of the files written by the stage.
+    pixels : int, optional
+        Number of pixels (array elements) processed.
+    peak_memory : int, optional
+        Peak resident memory of the process in bytes at the end of the stage. This is
+        a high-water mark over the life of the process, not of the stage alone.
+    traced_peak : int, optional
+        Peak of the memory allocated during the stage, if tracemalloc was enabled for it.
+    profile : str, optional
+        Path of the cProfile statistics of the stage, if profiling was enabled for it.
+    parent : str, optional
+        Name of the enclosing stage.
+    run : str, optional
+        Label of the `Instrumentation` that emitted the record.
+    pid : int
+        Process that ran the stage.
+    error : str, optional
+        Name of the exception raised in the stage, if any.
+    """
+    stage: str
+    file: Optional[str] = None
+    seconds: float = 0.0
+    bytes_read: Optional[int] = None
+    bytes_written: Optional[int] = None
+    pixels: Optional[int] = None
+    peak_memory: Optional[int] = None
+    traced_peak: Optional[int] = None
+    profile: Optional[str] = None
+    parent: Optional[str] = None
+    run: Optional[str] = None
+    pid: int = field(default_factory=os.getpid)
+    error: Optional[str] = None
+
+    @property
+    def megapixels_per_s(self) -> Optional[float]:
+        if self.pixels is None or self.seconds <= 0:
+            return None
+        return self.pixels / self.seconds / 1e6
+
+    @property
+    def megabytes_per_s(self) -> Optional[float]:
+        if (self.bytes_read is None and self.bytes_written is None) or self.seconds <= 0:
+            return None
+        return ((self.bytes_read or 0) + (self.bytes_written or 0)) / self.seconds / 1e6
+
+    def to_dict(self) -> dict:
+        record = asdict(self)
+        record['megapixels_per_s'] = self.megapixels_per_s
+        record['megabytes_per_s'] = self.megabytes_per_s
+        return record
+
+
+@dataclass(frozen=True)
+class _StageOptions:
+    """
+    Picklable per-stage switches, sent to worker processes with each file.
+    """
+    profile: Union[bool, frozenset] = frozenset()
+    trace_memory: Union[bool, frozenset] = frozenset()
+    profile_dir: str = PROFILE_DIR
+
+    def profiles(self, name: str) -> bool:
+        return self.profile is True or name in self.profile
+
+    def traces(self, name: str) -> bool:
+        return self.trace_memory is True or name in self.trace_memory
+
+
+class _Collector:
+    def __init__(self, options: _StageOptions):
+        self.options = options
+        self.records: List[StageRecord] = []
+        self.stack: List[StageRecord] = []
+        self.profiling = False
+
+
+_collector = contextvars.ContextVar('turmoric_stage_collector', default=None)
+
+
+@contextmanager
+def collect_stages(options: Optional[_StageOptions]=None) -> Iterator[List[StageRecord]]:
+    """
+    Collect the records of the stages run in the current thread inside the block.
+
+    Yields the list that receives the records, in the order the stages finish.
+    `run_batch` uses this in each worker; `Instrumentation.collect` uses it in
+    the calling process.
+    """
+    collector = _Collector(options or _StageOptions())
+    token = _collector.set(collector)
+    try:
+        yield collector.records
+    finally:
+        _collector.reset(token)
+
+
+def _peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _dump_profile(profiler: cProfile.Profile, profile_dir: str, record: StageRecord) -> str:
+    os.makedirs(profile_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(record.file))[0] if record.file else 'run'
+    path = os.path.join(profile_dir, f"{record.stage}-{name}-{record.pid}-{time.time_ns()}.prof")
+    profiler.dump_stats(path)
+    return path
+
+
+@contextmanager
+def stage(name: str, file: Optional[str]=None) -> Iterator[StageRecord]:
+    """
+    Time a stage of the processing of a file.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    file : str, optional
+        File the stage works on. Defaults to the file of the enclosing stage.
+
+    Yields
+    ------
+    StageRecord
+        The record of the stage. Set its `bytes_read`, `bytes_written` and `pixels`
+        inside the block. The timings are filled in when the block exits.
+
+    Notes
+    -----
+    Records are only kept inside an instrumented run (see `Instrumentation` and
+    `collect_stages`). Otherwise the record is discarded and nothing is measured.
+
+    Examples
+    --------
+    >>> with stage('write', file) as record:
+    ...     np.save(output_path, mask)
+    ...     record.bytes_written = os.path.getsize(output_path)
+    """
+    record = StageRecord(stage=name, file=str(file) if file is not None else None)
+    collector = _collector.get()
+    if collector is None:
+        yield record
+        return
+
+    options = collector.options
+    if collector.stack:
+        record.parent = collector.stack[-1].stage
+        if record.file is None:
+            record.file = collector.stack[-1].file
+    collector.stack.append(record)
+
+    profiler = None
+    if options.profiles(name) and not collector.profiling:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            collector.profiling = True
+        except ValueError:  # another profiler is active
+            profiler = None
+    tracing = options.traces(name) and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            collector.profiling = False
+            record.profile = _dump_profile(profiler, options.profile_dir, record)
+        if tracing:
+            record.traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        record.peak_memory = _peak_rss()
+        collector.stack.pop()
+        collector.records.append(record)
+
+
+class LoggingSink:
+    """
+    Log each record as one line of `key=value` pairs.
+
+    Parameters
+    ----------
+    logger : logging.Logger, optional
+        Logger to write to. Defaults to the `turmoric.instrumentation` logger.
+    level : int, optional
+        Level of the log lines. Defaults to `logging.INFO`.
+    """
+
+    def __init__(self, logger: Optional[logging.Logger]=None, level: int=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.level = level
+
+    def emit(self, record: StageRecord) -> None:
+        fields = record.to_dict()
+        for key in ('seconds', 'megapixels_per_s', 'megabytes_per_s'):
+            if fields[key] is not None:
+                fields[key] = f"{fields[key]:.4f}"
+        self.logger.log(self.level, ' '.join(f"{key}={value}" for key, value in fields.items()
+                                             if value is not None))
+
+    def close(self) -> None:
+        pass
+
+
+class JSONLinesSink:
+    """
+    Append each record as a JSON object on its own line, flushed immediately.
+
+    Parameters
+    ----------
+    path : str
+        File to write. Read it back with `read_stage_records`.
+    mode : {'a', 'w'}, optional
+        Append to (default) or overwrite an existing file.
+    """
+
+    def __init__(self, path: str, mode: str='a'):
+        self.path = path
+        self._file = open(path, mode)
+
+    def emit(self, record: StageRecord) -> None:
+        self._file.write(json.dumps(record.to_dict()) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class MemorySink:
+    """
+    Keep the records in the `records` list.
+    """
+
+    def __init__(self):
+        self.records: List[StageRecord] = []
+
+    def emit(self, record: StageRecord) -> None:
+        self.records.append(record)
+
+    def close(self) -> None:
+        pass
+
+    def stages(self, name: str) -> List[StageRecord]:
+        """
+        The records of the stage `name`.
+        """
+        return [record for record in self.records if record.stage == name]
+
+
+def _stage_names(stages: Union[bool, Iterable[str]]) -> Union[bool, frozenset]:
+    if isinstance(stages, bool):
+        return stages
+    return frozenset([stages] if isinstance(stages, str) else stages)
+
+
+class Instrumentation:
+    """
+    Route the stage records of instrumented functions to a sink.
+
+    Pass an instance as the `instrumentation` argument of
+    `apply_threshold_recursively`, `apply_regionprops_recursively`,
+    `batch_nd2_to_tif`, `nd2_to_tif` or `VampireModelTrainer`.
+
+    Parameters
+    ----------
+    sink : object, optional
+        Object with `emit(record)` and `close()` methods, such as `LoggingSink`
+        (default), `JSONLinesSink` or `MemorySink`.
+    profile : bool or iterable of str, optional
+        Stages to run under cProfile, or True for all stages. The statistics of each
+        profiled stage are written to `profile_dir` (see `StageRecord.profile`). Nested
+        stages of a profiled stage are included in its profile.
+    trace_memory : bool or iterable of str, optional
+        Stages whose peak allocated memory is traced with tracemalloc, or True for all
+        stages. Tracing slows allocations down noticeably.
+    profile_dir : str, optional
+        Folder receiving the `.prof` files. Defaults to `'profiles'`.
+    run : str, optional
+        Label stored in the `run` field of every record, e.g. the date of a nightly run.
+
+    Examples
+    --------
+    >>> sink = MemorySink()
+    >>> apply_threshold_recursively('images/', 'masks/', workers=4,
+    ...                             instrumentation=Instrumentation(sink, trace_memory=('threshold',)))
+    >>> summarize_stages(sink.records)
+    """
+
+    def __init__(self, sink=None, profile: Union[bool, Iterable[str]]=(),
+                 trace_memory: Union[bool, Iterable[str]]=(), profile_dir: str=PROFILE_DIR,
+                 run: Optional[str]=None):
+        self.sink = sink if sink is not None else LoggingSink()
+        self.options = _StageOptions(profile=_stage_names(profile),
+                                     trace_memory=_stage_names(trace_memory),
+                                     profile_dir=os.path.abspath(profile_dir))
+        self.run = run
+
+    def emit(self, records: Iterable[StageRecord]) -> None:
+        """
+        Send records to the sink, labelled with `run`.
+        """
+        for record in records:
+            if record.run is None:
+                record.run = self.run
+            self.sink.emit(record)
+
+    @contextmanager
+    def collect(self) -> Iterator[None]:
+        """
+        Record the stages run in the current thread inside the block, and emit them
+        when the block exits.
+        """
+        with collect_stages(self.options) as records:
+            try:
+                yield
+            finally:
+                self.emit(records)
+
+    def close(self) -> None:
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def instrumented(instrumentation: Optional[Instrumentation]):
+    """
+    `instrumentation.collect()`, or a context that does nothing if it is None.
+    """
+    return instrumentation.collect() if instrumentation is not None else nullcontext()
+
+
+def read_stage_records(path: str) -> pd.DataFrame:
+    """
+    Load the records written by a `JSONLinesSink` into a DataFrame.
+    """
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summarize_stages(records) -> pd.DataFrame:
+    """
+    Aggregate stage records per stage.
+
+    Parameters
+    ----------
+    records : list of StageRecord, pandas.DataFrame or str
+        Records, e.g. `MemorySink.records`, a DataFrame from `read_stage_records`, or
+        the path of a `JSONLinesSink` file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per stage, sorted by total time, with the number of runs (`count`),
+        the total and mean `seconds`, the summed `bytes_read`, `bytes_written` and
+        `pixels`, the largest `peak_memory`, the number of `errors` and the overall
+        `megapixels_per_s`. Nested stages are also counted in their parent stage.
+
+    Examples
+    --------
+    >>> summarize_stages('timings.jsonl')[['count', 'seconds', 'megapixels_per_s']]
+    """
+    if isinstance(records, (str, os.PathLike)):
+        df = read_stage_records(records)
+    elif isinstance(records, pd.DataFrame):
+        df = records
+    else:
+        df = pd.DataFrame([record.to_dict() for record in records])
+    if df.empty:
+        return pd.DataFrame()
+    numeric = ['seconds', 'bytes_read', 'bytes_written', 'pixels', 'peak_memory']
+    df = df.assign(**{column: pd.to_numeric(df[column]) for column in numeric})
+
+    grouped = df.groupby('stage')
+    summary = pd.DataFrame({
+        'count': grouped.size(),
+        'seconds': grouped['seconds'].sum(),
+        'mean_seconds': grouped['seconds'].mean(),
+        'bytes_read': grouped['bytes_read'].sum(min_count=1),
+        'bytes_written': grouped['bytes_written'].sum(min_count=1),
+        'pixels': grouped['pixels'].sum(min_count=1),
+        'peak_memory': grouped['peak_memory'].max(),
+        'errors': grouped['error'].count(),
+    })
+    summary['megapixels_per_s'] = summary['pixels'] / summary['seconds'] / 1e6
+    return summary.sort_values('seconds', ascending=False)
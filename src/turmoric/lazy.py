@@ -0,0 +1,224 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import Callable, Optional, Union
+from turmoric.apply_thresholds import create_li_mask, create_microglia_mask
+from turmoric.cell_analysis import DEFAULT_PROPERTIES, measure_mask, write_regionprops_table
+from turmoric.image_process import load_tif_file, read_tif_metadata
+from turmoric.utils import iter_filepaths
+
+"""
+Lazy threshold -> regionprops pipeline built on `dask`.
+
+Each input image becomes a dask array, and channel selection, thresholding and
+region measurement become tasks of one graph. The graph is run on any dask
+scheduler:
+
+- `'threads'` (default) or `'processes'` use the cores of the local node;
+- a `dask.distributed.Client` can spill intermediates to disk and scale beyond
+  one node.
+
+Images and masks are released as soon as their measurements are computed.
+
+`dask` is an optional dependency (pip install dask). `.nd2` inputs also need
+`nd2`.
+"""
+
+THRESHOLD_METHODS = ('li', 'microglia')
+
+
+def _require_dask():
+    try:
+        import dask
+        import dask.array as da
+    except ImportError:
+        raise ImportError("The lazy pipeline requires dask (pip install dask).")
+    return dask, da
+
+
+def imread_lazy(file: str, channel: Optional[int]=None, channel_axis: int=-1):
+    """
+    Wrap a `.tif` or `.nd2` image as a dask array without reading any pixels.
+
+    Parameters
+    ----------
+    file : str
+        Path to a `.tif` or `.nd2` file.
+    channel : int, optional
+        Channel to select. For `.tif` files it is taken along `channel_axis` of 3D
+        images. For `.nd2` files it is taken along the `'C'` dimension, if present.
+    channel_axis : int, optional
+        Axis holding the channels of a 3D `.tif` (default is -1, channels last).
+
+    Returns
+    -------
+    dask.array.Array
+        The lazily-read image. `.tif` images are a single chunk decoded with
+        `load_tif_file`, so only the requested channel is read. `.nd2` images are
+        chunked per frame by the `nd2` reader.
+
+    Examples
+    --------
+    >>> image = imread_lazy('slice1.nd2', channel=1)
+    >>> image.max().compute()
+    """
+    dask, da = _require_dask()
+
+    if file.lower().endswith('.nd2'):
+        import nd2
+        image = nd2.imread(file, dask=True, xarray=True)
+        if channel is not None and 'C' in image.dims:
+            image = image.isel(C=channel)
+        return image.data
+
+    metadata = read_tif_metadata(file)
+    shape = list(metadata['shape'])
+    if channel is not None and len(shape) == 3:
+        del shape[channel_axis % 3]
+    else:
+        channel = None
+    task = dask.delayed(load_tif_file, pure=True)(file, channel, channel_axis, False)
+    return da.from_delayed(task, shape=tuple(shape), dtype=metadata['dtype'])
+
+
+def threshold_lazy(image, method: Union[str, Callable[[np.ndarray], np.ndarray]]='li'):
+    """
+    Express the thresholding of a 2D dask array as a lazy task.
+
+    Parameters
+    ----------
+    image : dask.array.Array
+        2D image, e.g. from `imread_lazy`.
+    method : {'li', 'microglia'} or callable, optional
+        `'li'` thresholds at the Li threshold like `apply_li_threshold`, `'microglia'`
+        runs `create_microglia_mask`. A callable takes and returns a 2D ndarray and
+        must be picklable for the `'processes'` scheduler. Defaults to `'li'`.
+
+    Returns
+    -------
+    dask.array.Array
+        The boolean mask. Thresholds are global, so the image is merged into a single
+        chunk first.
+    """
+    if image.ndim != 2:
+        raise ValueError(f"Expected a 2D image, got shape {image.shape}. "
+                         "Select a channel and a single frame first.")
+    if isinstance(method, str):
+        if method not in THRESHOLD_METHODS:
+            raise ValueError(f"method must be one of {THRESHOLD_METHODS} or a callable, got {method!r}.")
+        method = create_li_mask if method == 'li' else create_microglia_mask
+    return image.rechunk(image.shape).map_blocks(method, dtype=bool)
+
+
+def regionprops_lazy(mask, properties_list: tuple=DEFAULT_PROPERTIES, filename: str=''):
+    """
+    Express the labelling and measurement of a lazy mask as a delayed DataFrame.
+
+    Parameters
+    ----------
+    mask : dask.array.Array
+        2D boolean mask, e.g. from `threshold_lazy`.
+    properties_list : tuple of str, optional
+        Properties accepted by `skimage.measure.regionprops_table`.
+    filename : str, optional
+        Value of the `'filename'` column.
+
+    Returns
+    -------
+    dask.delayed.Delayed
+        Computes to the same DataFrame as `apply_regionprops` on the saved mask.
+    """
+    dask, _ = _require_dask()
+    return dask.delayed(measure_mask, pure=True)(mask, list(properties_list), filename)
+
+
+def build_pipeline(files: list, channel: Optional[int]=1, channel_axis: int=-1,
+                   method: Union[str, Callable]='li',
+                   properties_list: tuple=DEFAULT_PROPERTIES) -> list:
+    """
+    Build the lazy read -> threshold -> regionprops graph for a list of images.
+
+    Returns one delayed DataFrame per file. See `run_lazy_pipeline` for the
+    parameters.
+    """
+    tables = []
+    for file in files:
+        image = imread_lazy(file, channel, channel_axis)
+        mask = threshold_lazy(image, method)
+        tables.append(regionprops_lazy(mask, properties_list, file))
+    return tables
+
+
+def run_lazy_pipeline(input_folder: str, output_path: Optional[str]=None, channel: Optional[int]=1,
+                      channel_axis: int=-1, method: Union[str, Callable]='li',
+                      properties_list: tuple=DEFAULT_PROPERTIES,
+                      file_types: tuple=('.tif', '.nd2'), scheduler='threads',
+                      num_workers: Optional[int]=None) -> Union[pd.DataFrame, str]:
+    """
+    Threshold every image below a folder and measure its regions as one dask graph.
+
+    Parameters
+    ----------
+    input_folder : str
+        Folder searched recursively for images.
+    output_path : str, optional
+        If given, the table is written to this `.csv` or `.parquet` file (see
+        `write_regionprops_table`) and its path is returned.
+    channel : int, optional
+        Channel to threshold (see `imread_lazy`). Default is 1.
+    channel_axis : int, optional
+        Axis holding the channels of 3D `.tif` images. Use 0 for stacks written by
+        `nd2_to_tif`. Default is -1.
+    method : {'li', 'microglia'} or callable, optional
+        Thresholding step (see `threshold_lazy`). Default is `'li'`.
+    properties_list : tuple of str, optional
+        Region properties to measure. Defaults to those of
+        `apply_regionprops_recursively`.
+    file_types : tuple of str, optional
+        File endings to include (case-insensitive). Default is `('.tif', '.nd2')`.
+    scheduler : str or dask.distributed.Client, optional
+        `'threads'` (default), `'processes'`, `'synchronous'` or a distributed client.
+    num_workers : int, optional
+        Number of threads or processes of the local schedulers. Defaults to the
+        number of cores.
+
+    Returns
+    -------
+    pandas.DataFrame or str
+        One row per region with a `'filename'` column, or `output_path` if given.
+        Returns None if the input folder does not exist.
+
+    Raises
+    ------
+    ImportError
+        If `dask` is not installed.
+
+    Notes
+    -----
+    Unlike `apply_regionprops_recursively`, an error in any image aborts the whole
+    computation, as is usual for a dask graph.
+
+    Examples
+    --------
+    >>> df = run_lazy_pipeline('experiment/', channel=1, channel_axis=0,
+    ...                        method='microglia', scheduler='processes')
+    >>> run_lazy_pipeline('experiment/', 'regionprops.parquet', num_workers=32)
+    'regionprops.parquet'
+    """
+    dask, _ = _require_dask()
+
+    if not os.path.isdir(input_folder):
+        print(f"Error: Input folder '{input_folder}' does not exist.")
+        return
+
+    files = list(iter_filepaths(input_folder, file_types, sort=True))
+    tables = build_pipeline(files, channel, channel_axis, method, properties_list)
+    compute_kwargs = {'scheduler': scheduler}
+    if num_workers is not None:
+        compute_kwargs['num_workers'] = num_workers
+    tables = dask.compute(*tables, **compute_kwargs)
+
+    props_df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    if output_path is not None:
+        return write_regionprops_table(props_df, output_path)
+    return props_df
@@ -1,9 +1,539 @@
-# imports
+import os
+import sys
+import json
+import time
+import argparse
+import graphlib
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Union
+from turmoric.apply_thresholds import create_li_mask, create_microglia_mask
+from turmoric.cache import CacheManifest, function_key, remove_file
+from turmoric.cell_analysis import (DEFAULT_PROPERTIES, measure_mask, read_regionprops_table,
+                                    write_regionprops_table)
+from turmoric.image_process import convert_nd2, read_image
+from turmoric.instrumentation import Instrumentation, JSONLinesSink, instrumented, stage
+from turmoric.utils import BatchSummary, FileResult, iter_filepaths, run_batch
 
-def main():
-    # main program code here
-    return
+"""
+Run the whole pipeline from one configuration file.
+
+The pipeline is a graph of stages:
+
+    convert    .nd2 -> .tif stack                  per file
+    threshold  image -> binary mask                per file
+    measure    mask -> table of region properties  per file
+    aggregate  tables -> one table                 once
+    plot       table -> figures per treatment      once
+
+`convert` and `threshold` both read the raw image, so the threshold of an
+`.nd2` does not wait for, nor re-read, its `.tif`. `measure` follows
+`threshold`, `aggregate` follows `measure` and `plot` follows `aggregate`.
+
+A configuration names the stages to run and their options, e.g.:
+
+    {
+        "input_folder": "raw",
+        "output_folder": "results",
+        "workers": 8,
+        "timings": "results/timings.jsonl",
+        "stages": {
+            "convert": {"compression": "zlib"},
+            "threshold": {"channel": 1, "method": "microglia"},
+            "measure": {"properties": ["area", "perimeter"]},
+            "aggregate": {"output": "regionprops.parquet"},
+            "plot": {"metrics": ["area", "perimeter", "circularity"]}
+        }
+    }
+
+Relative paths are relative to the configuration file. Multi-position `.nd2`
+files are thresholded one stage position at a time, chosen with the `position`
+option of `threshold`; without it they are reported as failed. The per-file
+stages of one image run one after the other in a single worker, which passes
+the mask to `measure` in memory. Masks are only written with
+`"save_masks": true`. Images are processed concurrently on `workers` processes.
+
+Every stage records what it produced. A rerun skips the stages whose outputs
+are up to date, i.e. whose input and options, and the options of the stages
+before them, have not changed (see `turmoric.cache`). Outputs are written to
+the output folder:
+
+    tifs/<image>.tif              convert
+    masks/<image>_li_thresh.npy   threshold, with save_masks
+    tables/<image>.csv            measure
+    regionprops.csv               aggregate (see its "output" option)
+    plots/                        plot
+
+Run it with:
+
+    python -m turmoric.main pipeline.json --workers 8
+"""
+
+STAGES = {
+    'convert': (),
+    'threshold': (),
+    'measure': ('threshold',),
+    'aggregate': ('measure',),
+    'plot': ('aggregate',),
+}
+PER_FILE_STAGES = ('convert', 'threshold', 'measure')
+
+STAGE_OPTIONS = {
+    'convert': {'compression': None, 'tile': [512, 512], 'ome': True},
+    'threshold': {'channel': 1, 'channel_axis': 0, 'position': None, 'method': 'microglia',
+                  'save_masks': False},
+    'measure': {'properties': list(DEFAULT_PROPERTIES)},
+    'aggregate': {'output': 'regionprops.csv', 'treatment': 'parent'},
+    'plot': {'metrics': ['area', 'perimeter', 'circularity'], 'by': 'treatment'},
+}
+
+THRESHOLD_FUNCTIONS = {'li': create_li_mask, 'microglia': create_microglia_mask}
+
+STATE_DIR = '.turmoric'
+STATE_FILE = 'pipeline_state.json'
+
+
+def load_config(path: str) -> dict:
+    """
+    Read and validate a pipeline configuration.
+
+    Parameters
+    ----------
+    path : str
+        A `.json` file, or a `.yaml`/`.yml` file (requires PyYAML).
+
+    Returns
+    -------
+    dict
+        The configuration with `input_folder`, `output_folder` and `timings` made
+        absolute relative to the configuration file, and the defaults of every enabled
+        stage filled in.
+
+    Raises
+    ------
+    ValueError
+        For unknown stages or options, or a stage whose input stage is not enabled.
+    """
+    with open(path) as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML configurations require PyYAML (pip install pyyaml).")
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for key in ('input_folder', 'output_folder', 'timings'):
+        if config.get(key) is not None:
+            config[key] = os.path.join(base_dir, config[key])
+    return _validate_config(config)
+
+
+def _validate_config(config: dict) -> dict:
+    for key in ('input_folder', 'output_folder', 'stages'):
+        if key not in config:
+            raise ValueError(f"The configuration has no '{key}'.")
+
+    stages = {}
+    for name, options in config['stages'].items():
+        if name not in STAGES:
+            raise ValueError(f"Unknown stage '{name}', choose from {list(STAGES)}.")
+        options = options or {}
+        unknown = set(options) - set(STAGE_OPTIONS[name])
+        if unknown:
+            raise ValueError(f"Unknown options {sorted(unknown)} for stage '{name}', "
+                             f"choose from {list(STAGE_OPTIONS[name])}.")
+        stages[name] = {**STAGE_OPTIONS[name], **options}
+
+    for name in stages:
+        missing = [dependency for dependency in STAGES[name] if dependency not in stages]
+        if missing:
+            raise ValueError(f"Stage '{name}' needs the output of {missing}.")
+    if 'threshold' in stages:
+        if stages['threshold']['method'] not in THRESHOLD_FUNCTIONS:
+            raise ValueError(f"Threshold method must be one of {list(THRESHOLD_FUNCTIONS)}.")
+        # Masks that are not measured are only useful on disk
+        if 'measure' not in stages:
+            stages['threshold']['save_masks'] = True
+
+    default_types = ['.nd2'] if 'convert' in stages else ['.tif']
+    return {**config, 'stages': stages,
+            'file_types': config.get('file_types', default_types),
+            'workers': config.get('workers'),
+            'timings': config.get('timings')}
+
+
+def stage_order(stages) -> list:
+    """
+    Order the enabled stages so that every stage follows the stages it reads from.
+    """
+    graph = {name: [dependency for dependency in STAGES[name] if dependency in stages]
+             for name in stages}
+    return list(graphlib.TopologicalSorter(graph).static_order())
+
+
+def _stage_keys(stages: dict) -> dict:
+    """
+    Cache key of every stage, chained so that changing a stage invalidates the stages after it.
+    """
+    keys = {}
+    if 'convert' in stages:
+        keys['convert'] = function_key(convert_nd2, **stages['convert'])
+    if 'threshold' in stages:
+        options = {key: value for key, value in stages['threshold'].items() if key != 'save_masks'}
+        keys['threshold'] = function_key(THRESHOLD_FUNCTIONS[options.pop('method')], **options)
+    if 'measure' in stages:
+        keys['measure'] = function_key(measure_mask, upstream=keys['threshold'], **stages['measure'])
+    if 'aggregate' in stages:
+        keys['aggregate'] = function_key(_aggregate, upstream=keys['measure'], **stages['aggregate'])
+    if 'plot' in stages:
+        keys['plot'] = function_key(_plot, upstream=keys['aggregate'], **stages['plot'])
+    return keys
+
+
+def _output_paths(name: str, output_folder: str) -> dict:
+    stem = os.path.splitext(name)[0]
+    return {'convert': os.path.join(output_folder, 'tifs', stem + '.tif'),
+            'threshold': os.path.join(output_folder, 'masks', stem + '_li_thresh.npy'),
+            'measure': os.path.join(output_folder, 'tables', stem + '.csv')}
+
+
+def _replace_atomically(path: str, write) -> None:
+    """
+    Call `write(temp_path)` on a hidden file next to `path` and move it into place.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+    write(temp_path)
+    os.replace(temp_path, path)
+
+
+def _run_file(file: str, name: str, todo: tuple, outputs: dict, stages: dict) -> dict:
+    """
+    Run the per-file stages `todo` of one image in one worker.
+
+    The mask goes from `threshold` to `measure` in memory. Returns the outputs
+    written, keyed by stage, and the table of `measure` under `'table'`.
+    Module-level so that it can be sent to worker processes by `run_batch`.
+    """
+    done = {}
+    if 'convert' in todo:
+        done['convert'] = convert_nd2(file, outputs['convert'], stages['convert'])['output']
+
+    mask = None
+    if 'threshold' in todo:
+        options = stages['threshold']
+        image = read_image(file, options['channel'], channel_axis=options['channel_axis'],
+                           position=options['position'])
+        if image.ndim != 2:
+            # e.g. every stage position of an .nd2 when the config sets none
+            raise ValueError(f"Image {file} has shape {image.shape} after selecting the channel, "
+                             f"but thresholding needs a 2D image. Set 'position' in the threshold "
+                             f"stage to select one stage position of a multi-position file.")
+        with stage('threshold', file) as record:
+            mask = THRESHOLD_FUNCTIONS[options['method']](image)
+            record.pixels = image.size
+        if options['save_masks']:
+            with stage('write', file) as record:
+                _replace_atomically(outputs['threshold'], lambda path: np.save(path, mask))
+                record.bytes_written = os.path.getsize(outputs['threshold'])
+            done['threshold'] = outputs['threshold']
+
+    if 'measure' in todo:
+        if mask is None:
+            # Only measure was stale, the saved mask is up to date
+            with stage('read', file) as record:
+                mask = np.load(outputs['threshold'])
+                record.bytes_read = mask.nbytes
+        table = measure_mask(mask, list(stages['measure']['properties']), name)
+        with stage('write_table', file) as record:
+            _replace_atomically(outputs['measure'],
+                                lambda path: write_regionprops_table(table, path))
+            record.bytes_written = os.path.getsize(outputs['measure'])
+        done['measure'] = outputs['measure']
+        done['table'] = table
+    return done
+
+
+def _aggregate(tables: list, input_folder: str, output: str, treatment: Optional[str]) -> pd.DataFrame:
+    """
+    Concatenate the per-image tables, add a treatment column and the derived shape metrics.
+    """
+    if not tables:
+        return pd.DataFrame()
+    if treatment is not None:
+        for name, table in tables:
+            if treatment == 'parent':
+                # Name of the folder holding the image, as in scripts/concat_csvs.py
+                folder = os.path.dirname(name)
+                table['treatment'] = os.path.basename(folder) or os.path.basename(
+                    os.path.normpath(input_folder))
+            else:
+                table['treatment'] = treatment
+    df = pd.concat([table for _, table in tables], ignore_index=True)
+
+    if {'area', 'perimeter'} <= set(df.columns):
+        # Regions of a pixel or two have no perimeter and no defined circularity
+        df['circularity'] = 4 * np.pi * df['area'] / df['perimeter'].where(df['perimeter'] > 0) ** 2
+    if {'major_axis_length', 'minor_axis_length'} <= set(df.columns):
+        df['aspect_ratio'] = df['major_axis_length'] / df['minor_axis_length']
+    write_regionprops_table(df, output)
+    return df
+
+
+def _plot(df: pd.DataFrame, plot_dir: str, metrics: list, by: str) -> list:
+    """
+    Bar plot of the mean and standard deviation of each metric per group, as in
+    scripts/plot_regionprops.py, plus a table of the statistics.
+    """
+    os.makedirs(plot_dir, exist_ok=True)
+    metrics = [metric for metric in metrics if metric in df.columns]
+    if by not in df.columns or not metrics:
+        print(f"Error: Cannot plot {metrics} by '{by}', available columns: {list(df.columns)}")
+        return []
+
+    stats = df.groupby(by, observed=True)[metrics].agg(['mean', 'std', 'count'])
+    stats.to_csv(os.path.join(plot_dir, f'summary_by_{by}.csv'))
+    written = []
+    for metric in metrics:
+        fig, ax = plt.subplots(figsize=(10, 6))
+        groups = [str(group) for group in stats.index]
+        ax.bar(groups, stats[(metric, 'mean')], yerr=stats[(metric, 'std')], capsize=5,
+               alpha=0.8, edgecolor='black')
+        ax.set_xlabel(by.title())
+        ax.set_ylabel(f'Mean {metric.title()}')
+        ax.set_title(f'Mean {metric.title()} by {by.title()}')
+        if len(groups) > 5:
+            ax.tick_params(axis='x', rotation=45)
+        fig.tight_layout()
+        path = os.path.join(plot_dir, f'{metric}_by_{by}.png')
+        fig.savefig(path, dpi=150)
+        plt.close(fig)
+        written.append(path)
+    return written
+
+
+def _read_state(path: str) -> dict:
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _write_state(path: str, state: dict) -> None:
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+    _replace_atomically(path, write)
+
+
+@dataclass
+class PipelineRun:
+    """
+    Outcome of `run_pipeline`.
+
+    Attributes
+    ----------
+    order : list of str
+        The enabled stages in the order they run.
+    ran : dict
+        Number of images processed by each per-file stage, and 1 or 0 for the
+        `aggregate` and `plot` stages. Stages that were up to date count 0.
+    summary : BatchSummary
+        Per-image results of the per-file stages. Images whose stages were all up to
+        date are marked `cached`.
+    table : pandas.DataFrame, optional
+        The aggregated table, if `aggregate` ran or `plot` needed it.
+    """
+    order: list
+    ran: Dict[str, int] = field(default_factory=dict)
+    summary: BatchSummary = field(default_factory=BatchSummary)
+    table: Optional[pd.DataFrame] = None
+
+    def __str__(self) -> str:
+        ran = ', '.join(f"{name}: {self.ran.get(name, 0)}" for name in self.order)
+        return f"Stages run ({ran})\n{self.summary}"
+
+
+def run_pipeline(config: Union[str, dict], workers: Optional[int]=None, force: bool=False,
+                 dry_run: bool=False) -> Optional[PipelineRun]:
+    """
+    Run the stages of a pipeline configuration, skipping those that are up to date.
+
+    Parameters
+    ----------
+    config : str or dict
+        Path of a configuration file (see `load_config` and the module documentation),
+        or a configuration dict with absolute paths.
+    workers : int, optional
+        Number of processes running the per-file stages of different images at once.
+        Overrides the `workers` of the configuration. `None` or `1` runs serially.
+    force : bool, optional
+        Rerun every stage, even if its outputs are up to date. Defaults to False.
+    dry_run : bool, optional
+        Only report how many images each stage would process. Defaults to False.
+
+    Returns
+    -------
+    PipelineRun
+        The stages that ran and the per-image results. Returns None if the input
+        folder does not exist.
+
+    Examples
+    --------
+    >>> run = run_pipeline('pipeline.json', workers=8)
+    >>> print(run)
+    >>> run.table.groupby('treatment')['area'].mean()
+    """
+    config = load_config(config) if isinstance(config, (str, os.PathLike)) else _validate_config(config)
+    input_folder, output_folder = config['input_folder'], config['output_folder']
+    stages = config['stages']
+    workers = workers if workers is not None else config['workers']
+
+    if not os.path.isdir(input_folder):
+        print(f"Error: Input folder '{input_folder}' does not exist.")
+        return
+
+    order = stage_order(stages)
+    keys = _stage_keys(stages)
+    state_dir = os.path.join(output_folder, STATE_DIR)
+    manifests = {name: CacheManifest(os.path.join(state_dir, f'{name}_manifest.json'), keys[name])
+                 for name in PER_FILE_STAGES if name in stages}
+    state_path = os.path.join(state_dir, STATE_FILE)
+    state = {} if force else _read_state(state_path)
+
+    files = list(iter_filepaths(input_folder, tuple(config['file_types']), sort=True))
+    names = [os.path.relpath(file, input_folder) for file in files]
+    outputs = [_output_paths(name, output_folder) for name in names]
+
+    def fresh(stage_name, index):
+        return (not force and stage_name in manifests
+                and manifests[stage_name].is_fresh(names[index], files[index]))
+
+    # Work out which per-file stages each image needs
+    jobs, todo_index = [], []
+    ran = {name: 0 for name in order}
+    for index, file in enumerate(files):
+        todo = []
+        if 'convert' in stages and file.lower().endswith('.nd2') and not fresh('convert', index):
+            todo.append('convert')
+        measure = 'measure' in stages and not fresh('measure', index)
+        if 'threshold' in stages:
+            mask_fresh = stages['threshold']['save_masks'] and fresh('threshold', index)
+            if not mask_fresh and (measure or stages['threshold']['save_masks']):
+                todo.append('threshold')
+        if measure:
+            todo.append('measure')
+        if todo:
+            jobs.append((file, names[index], tuple(todo), outputs[index], stages))
+            todo_index.append(index)
+            for name in todo:
+                ran[name] += 1
+
+    # The aggregate and plot stages rerun when a table changed or disappeared
+    removed = 'measure' in manifests and not set(manifests['measure'].entries) <= set(names)
+    if 'aggregate' in stages:
+        aggregate_output = os.path.join(output_folder, stages['aggregate']['output'])
+        ran['aggregate'] = int(bool(ran['measure'] or removed or not os.path.exists(aggregate_output)
+                                    or state.get('aggregate') != keys['aggregate']))
+    if 'plot' in stages:
+        plot_dir = os.path.join(output_folder, 'plots')
+        ran['plot'] = int(bool(ran['aggregate'] or not os.path.isdir(plot_dir)
+                               or state.get('plot') != keys['plot']))
+
+    if dry_run:
+        return PipelineRun(order=order, ran=ran)
+
+    os.makedirs(output_folder, exist_ok=True)
+    instrumentation = None
+    if config['timings']:
+        os.makedirs(os.path.dirname(os.path.abspath(config['timings'])), exist_ok=True)
+        instrumentation = Instrumentation(JSONLinesSink(config['timings']))
+    start = time.perf_counter()
+    results = [None] * len(files)
+    new_tables = {}
+    try:
+        with instrumented(instrumentation):
+            for index, result in zip(todo_index, run_batch(_run_file, jobs, workers=workers,
+                                                           instrumentation=instrumentation)):
+                if result.ok:
+                    for name, output in result.value.items():
+                        if name in manifests:
+                            manifests[name].record(names[index], files[index], output)
+                    if 'table' in result.value:
+                        new_tables[index] = result.value.pop('table')
+                else:
+                    print(f"Error processing {result.file}: {result.error}")
+                results[index] = result
+            # Images whose stages were all up to date
+            for index, file in enumerate(files):
+                if results[index] is None:
+                    results[index] = FileResult(file=file, cached=True)
+
+            # Drop the outputs of images that were removed since the last run
+            for manifest in manifests.values():
+                manifest.evict(names, remove=remove_file)
+                manifest.save()
+            summary = BatchSummary(results=results, elapsed=time.perf_counter() - start)
+
+            table = None
+            if ran.get('aggregate'):
+                # Tables measured in this run are already in memory
+                tables = []
+                for index, name in enumerate(names):
+                    if index in new_tables:
+                        tables.append((name, new_tables[index]))
+                    elif manifests['measure'].is_fresh(name, files[index]):
+                        tables.append((name, read_regionprops_table(manifests['measure'].output(name))))
+                with stage('aggregate', aggregate_output):
+                    table = _aggregate(tables, input_folder, aggregate_output,
+                                       stages['aggregate']['treatment'])
+                state['aggregate'] = keys['aggregate']
+
+            if ran.get('plot'):
+                if table is None:
+                    table = read_regionprops_table(aggregate_output)
+                with stage('plot', plot_dir):
+                    _plot(table, plot_dir, stages['plot']['metrics'], stages['plot']['by'])
+                state['plot'] = keys['plot']
+            _write_state(state_path, state)
+    finally:
+        if instrumentation is not None:
+            instrumentation.close()
+
+    return PipelineRun(order=order, ran=ran, summary=summary, table=table)
+
+
+def main(argv: Optional[list]=None) -> int:
+    """
+    Command-line entry point: `python -m turmoric.main CONFIG [--workers N] [--force] [--dry-run]`.
+    """
+    parser = argparse.ArgumentParser(prog='python -m turmoric.main',
+                                     description="Run the turmoric pipeline described by a "
+                                                 "configuration file.")
+    parser.add_argument('config', help="Pipeline configuration (.json, or .yaml with PyYAML).")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Processes running images in parallel (overrides the configuration).")
+    parser.add_argument('--force', action='store_true',
+                        help="Rerun every stage, even if its outputs are up to date.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only show how many images each stage would process.")
+    args = parser.parse_args(argv)
+
+    run = run_pipeline(args.config, workers=args.workers, force=args.force, dry_run=args.dry_run)
+    if run is None:
+        return 1
+    if args.dry_run:
+        for name in run.order:
+            print(f"{name}: {run.ran[name]} to run")
+        return 0
+    print(run)
+    return 1 if run.summary.failed else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
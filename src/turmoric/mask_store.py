@@ -0,0 +1,246 @@
+import os
+import json
+import numpy as np
+from typing import Iterator, Optional
+
+"""
+A single-container store for binary masks.
+
+Masks are bit-packed along their rows (`np.packbits(mask, axis=-1)`) and appended
+to one data file, `masks.bin`. An append-only JSON-lines index, `index.jsonl`,
+maps each mask name to its byte offset and shape. Records are written back to
+back, without padding, as byte arrays need no alignment. Reads memory-map the
+data file, so the packed bits are never copied. A store replaces one `.npy`
+file per image. Its data file holds one eighth of the bytes of the boolean
+masks (rows rounded up to whole bytes), and it uses only two files on disk.
+"""
+
+DATA_FILE = 'masks.bin'
+INDEX_FILE = 'index.jsonl'
+
+
+def is_mask_store(path: str) -> bool:
+    """
+    Return True if `path` is a directory containing a mask store.
+    """
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class MaskStore:
+    """
+    Append-only store of bit-packed binary masks with memory-mapped reads.
+
+    Parameters
+    ----------
+    path : str
+        Directory holding the store. It is created when opened with `mode='a'`.
+    mode : {'r', 'a'}, optional
+        `'r'` (default) opens an existing store read-only, `'a'` opens or creates a
+        store for appending.
+
+    Notes
+    -----
+    - Appending a mask under an existing name adds a new record. Later records win,
+      and the old bytes stay in the data file. `remove` likewise only appends a
+      deletion record to the index.
+    - Only the process that appends should open the store with `mode='a'`. Workers
+      should return packed masks to that process (see `pack_mask`).
+    - A truncated last line of the index, as left by a crash during `append`, is
+      ignored, and removed when the store is next opened with `mode='a'`. The mask
+      it described is lost.
+
+    Examples
+    --------
+    >>> with MaskStore('results/masks', mode='a') as store:
+    ...     store.append('slice1/image1', binary_mask)
+    >>> store = MaskStore('results/masks')
+    >>> mask = store.read('slice1/image1')
+    >>> rows = store.read_packed('slice1/image1')[:100]  # zero-copy view
+    """
+
+    def __init__(self, path: str, mode: str='r'):
+        if mode not in ('r', 'a'):
+            raise ValueError(f"mode must be 'r' or 'a', got {mode!r}.")
+        self.path = str(path)
+        self.mode = mode
+        self._data_path = os.path.join(self.path, DATA_FILE)
+        self._index_path = os.path.join(self.path, INDEX_FILE)
+
+        if mode == 'a':
+            os.makedirs(self.path, exist_ok=True)
+            for file in (self._data_path, self._index_path):
+                if not os.path.exists(file):
+                    open(file, 'wb').close()
+        elif not is_mask_store(self.path):
+            raise FileNotFoundError(f"No mask store found at {self.path}.")
+
+        self._index = {}
+        complete = 0
+        with open(self._index_path, 'rb') as f:
+            for line in f:
+                if line.endswith(b'\n'):
+                    complete += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Truncated last line, as left by a crash mid-append
+                    continue
+                if entry.get('deleted'):
+                    self._index.pop(entry['name'], None)
+                else:
+                    self._index[entry['name']] = entry
+        if mode == 'a' and os.path.getsize(self._index_path) > complete:
+            # Drop the partial line so that the next record starts on a line of its own
+            os.truncate(self._index_path, complete)
+
+        self._map = None
+        self._data_file = open(self._data_path, 'ab') if mode == 'a' else None
+        self._index_file = open(self._index_path, 'a') if mode == 'a' else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Flush pending writes and release the memory map.
+        """
+        for file in (self._data_file, self._index_file):
+            if file is not None:
+                file.close()
+        self._data_file = self._index_file = None
+        self._map = None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def keys(self) -> list:
+        """
+        Names of all masks in the store, in the order they were first appended.
+        """
+        return list(self._index)
+
+    def shape(self, name: str) -> tuple:
+        """
+        Shape of the unpacked mask stored under `name`.
+        """
+        return tuple(self._index[name]['shape'])
+
+    def append(self, name: str, mask: np.ndarray) -> None:
+        """
+        Bit-pack a 2D boolean mask and append it under `name`.
+        """
+        self.append_packed(name, *pack_mask(mask))
+
+    def append_packed(self, name: str, packed: np.ndarray, shape: tuple) -> None:
+        """
+        Append a mask that was already packed with `pack_mask`.
+
+        Parameters
+        ----------
+        name : str
+            Key of the mask, typically the path of the source image relative to the
+            input folder.
+        packed : ndarray of uint8
+            Row-packed bits with shape `(shape[0], ceil(shape[1] / 8))`.
+        shape : tuple of int
+            Shape of the unpacked mask.
+        """
+        if self._data_file is None:
+            raise ValueError("Mask store is not open for appending.")
+        packed = np.ascontiguousarray(packed, dtype=np.uint8)
+        if packed.shape != _packed_shape(shape):
+            raise ValueError(f"Packed mask has shape {packed.shape}, expected {_packed_shape(shape)}.")
+
+        offset = self._data_file.tell()
+        self._data_file.write(packed.tobytes())
+        self._data_file.flush()
+
+        entry = {'name': name, 'offset': offset, 'shape': [int(n) for n in shape]}
+        self._index_file.write(json.dumps(entry) + '\n')
+        self._index_file.flush()
+        self._index[name] = entry
+
+    def remove(self, name: str) -> None:
+        """
+        Remove the mask stored under `name` from the index.
+        """
+        if self._index_file is None:
+            raise ValueError("Mask store is not open for appending.")
+        if name not in self._index:
+            raise KeyError(name)
+        self._index_file.write(json.dumps({'name': name, 'deleted': True}) + '\n')
+        self._index_file.flush()
+        del self._index[name]
+
+    def read_packed(self, name: str) -> np.ndarray:
+        """
+        Return the row-packed bits of a mask as a read-only view of the memory-mapped store.
+
+        Slicing rows of the result does not read or copy the rest of the mask.
+        """
+        entry = self._index[name]
+        packed_shape = _packed_shape(entry['shape'])
+        end = entry['offset'] + packed_shape[0] * packed_shape[1]
+        if self._map is None or self._map.size < end:
+            if self._data_file is not None:
+                self._data_file.flush()
+            self._map = np.memmap(self._data_path, dtype=np.uint8, mode='r')
+        return self._map[entry['offset']:end].reshape(packed_shape)
+
+    def read(self, name: str, rows: Optional[slice]=None) -> np.ndarray:
+        """
+        Return a mask (or a band of its rows) as a 2D boolean array.
+
+        Parameters
+        ----------
+        name : str
+            Key of the mask.
+        rows : slice, optional
+            Rows to unpack. Defaults to the full mask.
+        """
+        packed = self.read_packed(name)
+        if rows is not None:
+            packed = packed[rows]
+        return unpack_mask(packed, self.shape(name)[1])
+
+
+def _packed_shape(shape: tuple) -> tuple:
+    return (int(shape[0]), (int(shape[1]) + 7) // 8)
+
+
+def pack_mask(mask: np.ndarray) -> tuple:
+    """
+    Bit-pack a 2D mask along its rows.
+
+    Parameters
+    ----------
+    mask : ndarray
+        2D array, nonzero values are treated as True.
+
+    Returns
+    -------
+    packed : ndarray of uint8
+        Array with shape `(rows, ceil(columns / 8))`.
+    shape : tuple of int
+        Shape of `mask`, needed to unpack it.
+    """
+    mask = np.asarray(mask)
+    if mask.ndim != 2:
+        raise ValueError(f"Mask must be 2D, got shape {mask.shape}.")
+    return np.packbits(mask.astype(bool, copy=False), axis=-1), mask.shape
+
+
+def unpack_mask(packed: np.ndarray, width: int) -> np.ndarray:
+    """
+    Inverse of `pack_mask`: unpack row-packed bits into a boolean array of the given width.
+    """
+    return np.unpackbits(packed, axis=-1, count=width).view(bool)
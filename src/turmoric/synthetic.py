@@ -0,0 +1,132 @@
+import numpy as np
+from scipy import ndimage
+
+"""
+Deterministic synthetic microscopy images of microglia.
+
+Cells are drawn as a soma with branched processes. Each process is a smooth
+random walk that can fork once. The cells are rendered on a dim, uneven
+background with noise. The same seed always produces the same image, so the
+images can be used to time and test the pipeline without real data.
+"""
+
+MEGAPIXEL = 1_000_000
+
+
+def _draw_process(canvas: np.ndarray, rng: np.random.Generator, y: float, x: float,
+                  angle: float, length: int, intensity: float, fork: bool) -> None:
+    """
+    Draw one process as a random walk of half-pixel steps, optionally forking once.
+    """
+    steps = 2 * length
+    angles = angle + np.cumsum(rng.normal(0, 0.15, steps))
+    ys = y + np.cumsum(0.5 * np.sin(angles))
+    xs = x + np.cumsum(0.5 * np.cos(angles))
+    rows, cols = np.round(ys).astype(np.intp), np.round(xs).astype(np.intp)
+    inside = (rows >= 0) & (rows < canvas.shape[0]) & (cols >= 0) & (cols < canvas.shape[1])
+    # Processes thin out towards their tips
+    fade = np.linspace(1.0, 0.4, steps)
+    np.maximum.at(canvas, (rows[inside], cols[inside]), intensity * fade[inside])
+
+    if fork and steps > 8:
+        split = rng.integers(steps // 4, 3 * steps // 4)
+        _draw_process(canvas, rng, ys[split], xs[split], angles[split] + rng.choice([-1, 1]) * rng.uniform(0.4, 1.0),
+                      (steps - split) // 2, intensity * fade[split], fork=False)
+
+
+def synthetic_microglia_image(shape: tuple=(1024, 1024), n_channels: int=3, density: float=100.0,
+                              channel: int=1, seed: int=0, branches: tuple=(3, 7),
+                              branch_length: tuple=(30, 90), soma_radius: tuple=(6, 12),
+                              noise: float=0.02, dtype=np.uint8,
+                              return_somas: bool=False):
+    """
+    Generate a deterministic multi-channel image of branched microglia-like cells.
+
+    Parameters
+    ----------
+    shape : tuple of int, optional
+        `(rows, columns)` of the image. Defaults to `(1024, 1024)`.
+    n_channels : int, optional
+        Number of channels. Channel `channel` holds the microglia. When present, the
+        next channel holds a nuclear stain (the somas only). The remaining channels
+        hold background and noise. Defaults to 3.
+    density : float, optional
+        Cells per megapixel. Defaults to 100, i.e. about 100 cells in a 1024 x 1024 image.
+    channel : int, optional
+        Index of the microglia channel. Defaults to 1, the channel used by the
+        thresholding functions.
+    seed : int, optional
+        Seed of the random generator. Equal seeds and parameters give identical images.
+    branches : tuple of int, optional
+        Range `(min, max)` of the number of processes per cell.
+    branch_length : tuple of int, optional
+        Range of process lengths in pixels.
+    soma_radius : tuple of int, optional
+        Range of soma radii in pixels.
+    noise : float, optional
+        Standard deviation of the Gaussian noise, relative to the full intensity range.
+    dtype : dtype, optional
+        Integer dtype of the image, scaled to its full range. Defaults to `uint8`, whose
+        threshold values suit `create_microglia_mask`, which compares label ids to the
+        threshold.
+    return_somas : bool, optional
+        Also return the `(row, col)` centers of the cells.
+
+    Returns
+    -------
+    image : ndarray
+        Array of shape `(n_channels, rows, columns)`, channel first like the stacks
+        written by `nd2_to_tif`. If `n_channels` is 1, the shape is `(rows, columns)`.
+    somas : ndarray
+        Array of shape `(n_cells, 2)`, if `return_somas` is True.
+
+    Examples
+    --------
+    >>> image = synthetic_microglia_image((2048, 2048), density=150, seed=1)
+    >>> mask = create_microglia_mask(image[1])
+    """
+    if not 0 <= channel < n_channels:
+        raise ValueError(f"channel must be in range({n_channels}), got {channel}.")
+    rng = np.random.default_rng(seed)
+    rows, cols = shape
+
+    n_cells = int(round(density * rows * cols / MEGAPIXEL))
+    somas = np.column_stack([rng.uniform(0, rows, n_cells), rng.uniform(0, cols, n_cells)])
+
+    cells = np.zeros(shape, dtype=np.float32)
+    nuclei = np.zeros(shape, dtype=np.float32)
+    for y, x in somas:
+        intensity = rng.uniform(0.6, 1.0)
+        for angle in rng.uniform(0, 2 * np.pi, rng.integers(branches[0], branches[1] + 1)):
+            _draw_process(cells, rng, y, x, angle, int(rng.integers(*branch_length)),
+                          intensity, fork=rng.random() < 0.5)
+        radius = rng.uniform(*soma_radius)
+        r0, r1 = max(int(y - radius), 0), min(int(y + radius) + 2, rows)
+        c0, c1 = max(int(x - radius), 0), min(int(x + radius) + 2, cols)
+        yy, xx = np.ogrid[r0:r1, c0:c1]
+        soma = (yy - y) ** 2 + (xx - x) ** 2 <= radius ** 2
+        np.maximum(cells[r0:r1, c0:c1], intensity * soma, out=cells[r0:r1, c0:c1])
+        np.maximum(nuclei[r0:r1, c0:c1], 0.8 * soma, out=nuclei[r0:r1, c0:c1])
+
+    # Optical blur thickens the one-pixel processes
+    cells = ndimage.gaussian_filter(cells, 1.0)
+    cells /= max(float(cells.max()), 1e-6)
+    background = 0.1 + 0.05 * np.add.outer(np.linspace(0, 1, rows, dtype=np.float32),
+                                          np.linspace(0, 1, cols, dtype=np.float32))
+
+    image = np.empty((n_channels, rows, cols), dtype=dtype)
+    top = np.iinfo(dtype).max
+    for index in range(n_channels):
+        if index == channel:
+            signal = cells
+        elif index == channel + 1:
+            signal = ndimage.gaussian_filter(nuclei, 1.5)
+        else:
+            signal = np.zeros(shape, dtype=np.float32)
+        plane = background + 0.85 * signal + rng.normal(0, noise, shape).astype(np.float32)
+        np.clip(plane, 0, 1, out=plane)
+        plane *= top
+        image[index] = plane
+
+    image = image[0] if n_channels == 1 else image
+    return (image, somas) if return_somas else image
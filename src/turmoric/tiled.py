@@ -0,0 +1,563 @@
+import numpy as np
+import pandas as pd
+from functools import partial
+from scipy import ndimage
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Union
+from skimage.segmentation import clear_border as _clear_border
+from turmoric.apply_thresholds import (_threshold_li_from_histogram, _merge_components,
+                                       _diagonal_links, _select_microglia_components)
+from turmoric.cell_analysis import DEFAULT_PROPERTIES, measure_mask
+from turmoric.image_process import open_tif_channel
+from turmoric.mask_store import MaskStore
+
+"""
+Out-of-core thresholding of images that do not fit in memory, such as stitched
+whole-slice scans.
+
+Images are processed in square tiles read from any array-like that supports 2D
+slicing (a memory-mapped `.tif` channel from `open_tif_channel`, a `numpy.memmap`,
+a zarr or dask array). The global threshold is computed from a histogram that is
+accumulated tile by tile. Connected components are labelled per tile and linked
+across tile seams through the labels of the rows and columns on either side of each
+seam. Component filtering and border clearing therefore give the same result as on
+the whole image. The mask is written tile by tile to a memory-mapped `.npy` file.
+
+Peak memory is a few tiles plus a handful of numbers per connected component,
+independent of the image size.
+
+`grid_tiles` lays out the tiles of a shape, either as a grid of N x M tiles whose
+boundaries follow `np.array_split` (so a 2 x 2 grid gives the quadrants of
+`split_files`) or as tiles of a fixed size in raster order, optionally
+overlapping their neighbours. `iter_tiles` yields them as basic-slicing views of
+an array, so tiling a memory-mapped `.npy` reads only the tiles that are used.
+The tiles can be written to a single `MaskStore` with `write_tiles`, instead of one
+`.npy` per tile, or measured directly with `tile_regionprops` without being
+written at all.
+"""
+
+DEFAULT_TILE_SIZE = 4096
+FLOAT_BINS = 65536
+TILE_NAME_FORMAT = '{name}_tile{row}_{col}'
+
+
+@dataclass(frozen=True)
+class Tile:
+    """
+    Position of one tile in a tiling.
+
+    Attributes
+    ----------
+    row, col : int
+        Index of the tile in the grid of tiles.
+    rows, cols : slice
+        Rows and columns of the mask covered by the tile, including any overlap.
+    number : int
+        1-based position of the tile in raster order.
+    """
+    row: int
+    col: int
+    rows: slice
+    cols: slice
+    number: int
+
+    @property
+    def slices(self) -> tuple:
+        return self.rows, self.cols
+
+
+def _split_bounds(length: int, parts: int) -> list:
+    """
+    Start and stop of each part, sized like `np.array_split(range(length), parts)`.
+    """
+    if parts < 1:
+        raise ValueError(f"Grid dimensions must be positive, got {parts}.")
+    size, extra = divmod(length, parts)
+    stops = np.cumsum([size + (i < extra) for i in range(parts)])
+    return list(zip([0, *stops[:-1]], stops))
+
+
+def _size_bounds(length: int, tile_size: int) -> list:
+    if tile_size < 1:
+        raise ValueError(f"tile_size must be positive, got {tile_size}.")
+    return [(start, min(start + tile_size, length)) for start in range(0, length, tile_size)]
+
+
+def grid_tiles(shape: tuple, grid: Optional[tuple]=None, tile_size: Union[int, tuple, None]=None,
+               overlap: int=0) -> List[Tile]:
+    """
+    Lay out the tiles of a 2D shape.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the mask.
+    grid : tuple of int, optional
+        Number of tile rows and columns `(N, M)`. Tile sizes differ by at most one
+        pixel, as with `np.array_split`.
+    tile_size : int or tuple of int, optional
+        Tile shape `(rows, columns)`, or the side of square tiles. Tiles on the bottom
+        and right edges are smaller if the shape is not a multiple of the tile size.
+    overlap : int, optional
+        Pixels by which each tile extends into its neighbours on every side, clipped to
+        the mask. Defaults to 0.
+
+    Returns
+    -------
+    list of Tile
+        Tiles in raster order.
+
+    Raises
+    ------
+    ValueError
+        Unless exactly one of `grid` and `tile_size` is given.
+
+    Examples
+    --------
+    >>> [tile.slices for tile in grid_tiles((5, 4), grid=(2, 2))]
+    [(slice(0, 3), slice(0, 2)), (slice(0, 3), slice(2, 4)),
+     (slice(3, 5), slice(0, 2)), (slice(3, 5), slice(2, 4))]
+    """
+    if (grid is None) == (tile_size is None):
+        raise ValueError("Specify exactly one of grid and tile_size.")
+    if overlap < 0:
+        raise ValueError(f"overlap must be non-negative, got {overlap}.")
+
+    if grid is not None:
+        row_bounds, col_bounds = (_split_bounds(length, parts) for length, parts in zip(shape, grid))
+    else:
+        tile_shape = (tile_size, tile_size) if np.isscalar(tile_size) else tile_size
+        row_bounds, col_bounds = (_size_bounds(length, size) for length, size in zip(shape, tile_shape))
+
+    tiles = []
+    for row, (r0, r1) in enumerate(row_bounds):
+        for col, (c0, c1) in enumerate(col_bounds):
+            tiles.append(Tile(row=row, col=col,
+                              rows=slice(max(int(r0) - overlap, 0), min(int(r1) + overlap, shape[0])),
+                              cols=slice(max(int(c0) - overlap, 0), min(int(c1) + overlap, shape[1])),
+                              number=len(tiles) + 1))
+    return tiles
+
+
+def iter_tiles(mask: np.ndarray, grid: Optional[tuple]=None, tile_size: Union[int, tuple, None]=None,
+               overlap: int=0, clear_border: bool=False) -> Iterator[tuple]:
+    """
+    Yield the tiles of a mask as views, optionally clearing objects on their borders.
+
+    Parameters
+    ----------
+    mask : ndarray
+        2D mask, e.g. loaded with `np.load(path, mmap_mode='r')`.
+    grid, tile_size, overlap
+        Tiling, see `grid_tiles`.
+    clear_border : bool, optional
+        Remove the objects touching the border of each tile with
+        `skimage.segmentation.clear_border`. This is done when the tile is yielded, and
+        returns a new array for that tile only. Defaults to False.
+
+    Yields
+    ------
+    tile : Tile
+        Position of the tile.
+    data : ndarray
+        A view of the mask, or the cleared copy of that view.
+
+    Examples
+    --------
+    >>> mask = np.load('image_li_thresh.npy', mmap_mode='r')
+    >>> for tile, data in iter_tiles(mask, grid=(3, 3), clear_border=True):
+    ...     print(tile.row, tile.col, data.sum())
+    """
+    mask = np.asanyarray(mask)
+    if mask.ndim != 2:
+        raise ValueError(f"Mask must be 2D, got shape {mask.shape}.")
+    for tile in grid_tiles(mask.shape, grid, tile_size, overlap):
+        data = mask[tile.slices]
+        yield tile, (_clear_border(data) if clear_border else data)
+
+
+def write_tiles(mask: np.ndarray, store: MaskStore, name: str, grid: Optional[tuple]=None,
+                tile_size: Union[int, tuple, None]=None, overlap: int=0,
+                clear_border: bool=True, name_format: str=TILE_NAME_FORMAT) -> list:
+    """
+    Append the tiles of a mask to a `MaskStore`.
+
+    Parameters
+    ----------
+    mask : ndarray
+        2D binary mask.
+    store : MaskStore
+        Store opened with `mode='a'`.
+    name : str
+        Name of the mask, used to name its tiles.
+    grid, tile_size, overlap
+        Tiling, see `grid_tiles`.
+    clear_border : bool, optional
+        Clear objects touching the border of each tile. Defaults to True, as in
+        `split_files`.
+    name_format : str, optional
+        Format of the tile names, filled with `name`, `row`, `col` and `number`.
+        Defaults to `'{name}_tile{row}_{col}'`.
+
+    Returns
+    -------
+    list of str
+        Names of the appended tiles.
+
+    Examples
+    --------
+    >>> with MaskStore('results/tiles', mode='a') as store:
+    ...     write_tiles(mask, store, 'slice1/image1', tile_size=1024, overlap=64)
+    """
+    names = []
+    for tile, data in iter_tiles(mask, grid, tile_size, overlap, clear_border):
+        tile_name = name_format.format(name=name, row=tile.row, col=tile.col, number=tile.number)
+        store.append(tile_name, data)
+        names.append(tile_name)
+    return names
+
+
+def tile_regionprops(mask: np.ndarray, grid: Optional[tuple]=None,
+                     tile_size: Union[int, tuple, None]=None, overlap: int=0,
+                     clear_border: bool=True, properties_list: tuple=DEFAULT_PROPERTIES,
+                     filename: str='') -> pd.DataFrame:
+    """
+    Measure the regions of every tile of a mask, without writing the tiles.
+
+    Parameters
+    ----------
+    mask : ndarray
+        2D binary mask.
+    grid, tile_size, overlap
+        Tiling, see `grid_tiles`.
+    clear_border : bool, optional
+        Clear objects touching the border of each tile before measuring. Defaults to
+        True, as in `split_files`.
+    properties_list : tuple of str, optional
+        Properties accepted by `skimage.measure.regionprops_table`. Defaults to those
+        of `apply_regionprops_recursively`.
+    filename : str, optional
+        Value of the `'filename'` column.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per region, as from `apply_regionprops` on each tile saved separately,
+        plus `'tile_row'` and `'tile_col'` columns. Coordinates such as `'centroid-0'`
+        are relative to the tile.
+
+    Examples
+    --------
+    >>> df = tile_regionprops(np.load('image_li_thresh.npy', mmap_mode='r'),
+    ...                       grid=(4, 4), filename='image_li_thresh.npy')
+    """
+    tables = []
+    for tile, data in iter_tiles(mask, grid, tile_size, overlap, clear_border):
+        table = measure_mask(data, list(properties_list), filename)
+        table['tile_row'] = tile.row
+        table['tile_col'] = tile.col
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def streaming_histogram(image, tile_size: int=DEFAULT_TILE_SIZE, nbins: int=FLOAT_BINS) -> tuple:
+    """
+    Intensity histogram of an image, accumulated one tile at a time.
+
+    Parameters
+    ----------
+    image : array-like
+        2D image supporting slicing, e.g. a memory map.
+    tile_size : int, optional
+        Side length of the tiles read at once.
+    nbins : int, optional
+        Number of bins for float and wide integer images. 8- and 16-bit images get one
+        bin per intensity, like `skimage.exposure.histogram`.
+
+    Returns
+    -------
+    counts : ndarray
+        Pixels per bin.
+    bin_centers : ndarray
+        Center of each bin. Integer for integer images.
+    """
+    dtype = np.dtype(image.dtype)
+    if dtype == bool:
+        dtype = np.dtype(np.uint8)
+
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        # One bin per intensity, offset so that signed types start at bin 0
+        offset = int(np.iinfo(dtype).min)
+        counts = np.zeros(2 ** (8 * dtype.itemsize), dtype=np.int64)
+        for tile in grid_tiles(image.shape, tile_size=tile_size):
+            values = np.asarray(image[tile.slices]).astype(np.int64).ravel() - offset
+            counts += np.bincount(values, minlength=counts.size)
+        low, high = np.flatnonzero(counts)[[0, -1]]
+        return counts[low:high + 1], np.arange(low + offset, high + offset + 1)
+
+    low, high = np.inf, -np.inf
+    for tile in grid_tiles(image.shape, tile_size=tile_size):
+        values = np.asarray(image[tile.slices])
+        low, high = min(low, values.min()), max(high, values.max())
+    counts = np.zeros(nbins, dtype=np.int64)
+    for tile in grid_tiles(image.shape, tile_size=tile_size):
+        counts += np.histogram(np.asarray(image[tile.slices]), bins=nbins, range=(low, high))[0]
+    edges = np.linspace(low, high, nbins + 1)
+    return counts, (edges[:-1] + edges[1:]) / 2
+
+
+def threshold_li_tiled(image, tile_size: int=DEFAULT_TILE_SIZE) -> float:
+    """
+    Li threshold of an image computed from a streaming histogram.
+
+    For 8- and 16-bit images this equals `skimage.filters.threshold_li(image)`. For
+    float images it is computed from a 65536-bin histogram and agrees with it to
+    within a bin width.
+
+    Examples
+    --------
+    >>> microglia_im = open_tif_channel("whole_slice.tif", channel=1, channel_axis=0)
+    >>> thresh = threshold_li_tiled(microglia_im)
+    """
+    counts, bin_centers = streaming_histogram(image, tile_size)
+    if counts.size == 1:
+        return float(bin_centers[0])
+    return float(_threshold_li_from_histogram(counts, bin_centers))
+
+
+def _global_labels(edge: np.ndarray, offset: int) -> np.ndarray:
+    """
+    Shift the nonzero tile labels of a row or column of labels by the tile's offset.
+    """
+    return np.where(edge > 0, edge.astype(np.int64) + offset, 0)
+
+
+def _read_foreground(image, threshold: float, rows: slice, cols: slice) -> np.ndarray:
+    return np.asarray(image[rows, cols]) > threshold
+
+
+def _read_background(output, rows: slice, cols: slice) -> np.ndarray:
+    return ~np.asarray(output[rows, cols])
+
+
+def _label_tiles(read_tile: Callable[[slice, slice], np.ndarray], shape: tuple, tile_size: int,
+                 diagonal: bool=False) -> dict:
+    """
+    Label the foreground of each tile (4-connected) and link the labels across seams.
+
+    Labels are numbered globally: label `k` of a tile becomes `offset + k`, and 0 is
+    the background. Seams are stitched with the labels of the last row of the tile row
+    above and of the last column of the tile to the left.
+
+    Returns
+    -------
+    dict
+        `count` (number of labels), `offsets` (per tile), `sizes`, `first` (raster index
+        of each label's first pixel), `border` (labels touching the image border),
+        `links4` and, with `diagonal`, `links8` (pairs of linked labels).
+    """
+    height, width = shape
+    offsets, sizes, first, border = [], [np.zeros(1, np.int64)], [np.full(1, -1, np.int64)], []
+    links4, links8 = [], []
+    count = 0
+    above = np.zeros(width + 2, dtype=np.int64)  # padded by one column on each side
+    next_above = above.copy()
+    left = None
+
+    for rows, cols in (tile.slices for tile in grid_tiles(shape, tile_size=tile_size)):
+        if cols.start == 0:
+            above, next_above = next_above, above
+            next_above[:] = 0
+            left = None
+
+        labels, n = ndimage.label(read_tile(rows, cols))
+        offset = count
+        offsets.append(offset)
+        count += n
+
+        flat = labels.ravel()
+        sizes.append(np.bincount(flat, minlength=n + 1)[1:])
+        # Labels appear in raster order, so each one starts where the running maximum grows
+        start = np.flatnonzero(np.diff(np.maximum.accumulate(flat), prepend=0))
+        first.append((rows.start + start // labels.shape[1]) * width + cols.start + start % labels.shape[1])
+
+        top, bottom = _global_labels(labels[0], offset), _global_labels(labels[-1], offset)
+        first_col, last_col = _global_labels(labels[:, 0], offset), _global_labels(labels[:, -1], offset)
+
+        for on_border, edge in ((rows.start == 0, top), (rows.stop == height, bottom),
+                                (cols.start == 0, first_col), (cols.stop == width, last_col)):
+            if on_border:
+                border.append(edge[edge > 0])
+
+        if diagonal:
+            links8.extend((a + offset, b + offset) for a, b in _diagonal_links(labels))
+
+        if rows.start > 0:
+            straight = above[cols.start + 1:cols.stop + 1]
+            links4.append(_pairs(straight, top))
+            if diagonal:
+                links8.append(_pairs(above[cols.start:cols.stop], top))
+                links8.append(_pairs(above[cols.start + 2:cols.stop + 2], top))
+        if left is not None:
+            links4.append(_pairs(left, first_col))
+            if diagonal:
+                links8.append(_pairs(left[:-1], first_col[1:]))
+                links8.append(_pairs(left[1:], first_col[:-1]))
+
+        next_above[cols.start + 1:cols.stop + 1] = bottom
+        left = last_col
+
+    return {'count': count, 'offsets': offsets, 'sizes': np.concatenate(sizes),
+            'first': np.concatenate(first), 'border': np.concatenate(border or [np.zeros(0, np.int64)]),
+            'links4': links4, 'links8': links4 + links8}
+
+
+def _pairs(a: np.ndarray, b: np.ndarray) -> tuple:
+    linked = (a > 0) & (b > 0)
+    return a[linked], b[linked]
+
+
+def _write_mask_tiles(output: np.ndarray, read_tile: Callable[[slice, slice], np.ndarray],
+                 tile_size: int, offsets: list, lookup: np.ndarray, combine: bool=False) -> None:
+    """
+    Relabel each tile and write `lookup[label]` to `output` (or OR it in with `combine`).
+
+    Tiles are labelled exactly as in `_label_tiles`, so the global label of each pixel
+    is recovered without storing the label image.
+    """
+    for tile, offset in zip(grid_tiles(output.shape, tile_size=tile_size), offsets):
+        rows, cols = tile.slices
+        labels, n = ndimage.label(read_tile(rows, cols))
+        tile_lookup = lookup[offset:offset + n + 1].copy()
+        tile_lookup[0] = False
+        if combine:
+            output[rows, cols] |= tile_lookup[labels]
+        else:
+            output[rows, cols] = tile_lookup[labels]
+
+
+def _fill_holes_tiled(output: np.ndarray, tile_size: int) -> None:
+    """
+    Fill the holes of an on-disk mask: background components (4-connected) that do not
+    reach the image border.
+    """
+    read_background = partial(_read_background, output)
+    tiles = _label_tiles(read_background, output.shape, tile_size)
+    group = _merge_components(tiles['count'], tiles['links4'])
+    outside = np.zeros(int(group.max()) + 1, dtype=bool)
+    outside[group[tiles['border']]] = True
+    _write_mask_tiles(output, read_background, tile_size, tiles['offsets'], ~outside[group],
+                 combine=True)
+
+
+def _open_output(output_path: str, shape: tuple) -> np.memmap:
+    return np.lib.format.open_memmap(output_path, mode='w+', dtype=bool, shape=tuple(shape))
+
+
+def create_microglia_mask_tiled(image, output_path: str, threshold: Optional[float]=None,
+                                tile_size: int=DEFAULT_TILE_SIZE,
+                                large_object_size: int=50000,
+                                min_object_size: int=500) -> np.memmap:
+    """
+    Tiled, out-of-core version of `turmoric.apply_thresholds.create_microglia_mask`.
+
+    Parameters
+    ----------
+    image : array-like
+        2D single-channel image supporting slicing, e.g. from `open_tif_channel`.
+    output_path : str
+        Path of the `.npy` file the boolean mask is written to.
+    threshold : float, optional
+        Global threshold. Defaults to `threshold_li_tiled(image)`.
+    tile_size : int, optional
+        Side length of the tiles processed at once. Defaults to 4096.
+    large_object_size, min_object_size : int, optional
+        See `create_microglia_mask`.
+
+    Returns
+    -------
+    numpy.memmap
+        The mask, memory-mapped from `output_path`.
+
+    Notes
+    -----
+    - The mask is identical to `create_microglia_mask(image)` for 8- and 16-bit
+      images, whatever the tile size. For float images the Li threshold comes from a
+      binned histogram and can differ slightly.
+    - The image is read three times (histogram, labelling and writing, plus a
+      min/max pass for float images) and the mask twice more to fill holes.
+    - Besides a few tiles, memory holds a few numbers per connected component and
+      per pair of components touching across a seam or diagonally.
+
+    Examples
+    --------
+    >>> microglia_im = open_tif_channel("whole_slice.tif", channel=1, channel_axis=0)
+    >>> mask = create_microglia_mask_tiled(microglia_im, "whole_slice_mask.npy")
+    """
+    if len(image.shape) != 2:
+        raise ValueError(f"Expected a 2D image, got shape {image.shape}.")
+    if threshold is None:
+        threshold = threshold_li_tiled(image, tile_size)
+
+    read_foreground = partial(_read_foreground, image, threshold)
+    tiles = _label_tiles(read_foreground, image.shape, tile_size, diagonal=True)
+    keep = _select_microglia_components(tiles['sizes'], tiles['first'], tiles['border'],
+                                        _merge_components(tiles['count'], tiles['links4']),
+                                        _merge_components(tiles['count'], tiles['links8']),
+                                        threshold, large_object_size, min_object_size)
+
+    output = _open_output(output_path, image.shape)
+    _write_mask_tiles(output, read_foreground, tile_size, tiles['offsets'], keep)
+    _fill_holes_tiled(output, tile_size)
+    output.flush()
+    return output
+
+
+def apply_li_threshold_tiled(file: str, output_path: str, channel: int=1, channel_axis: int=-1,
+                             tile_size: int=DEFAULT_TILE_SIZE, microglia: bool=False) -> np.memmap:
+    """
+    Threshold one channel of a large `.tif` tile by tile and write the mask to disk.
+
+    Tiled, out-of-core counterpart of `turmoric.apply_thresholds.apply_li_threshold`
+    for images that do not fit in memory. The channel is memory-mapped (see
+    `open_tif_channel`), the Li threshold is computed from a streaming histogram, and
+    the mask is written tile by tile to a memory-mapped `.npy` file.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.tif` file.
+    output_path : str
+        Path of the `.npy` file the boolean mask is written to.
+    channel : int, optional
+        Index of the channel to threshold. Ignored for 2D images. Default is 1.
+    channel_axis : int, optional
+        Axis holding the channels (default is -1, channels last). Use 0 for
+        channel-first stacks such as those written by `nd2_to_tif`.
+    tile_size : int, optional
+        Side length of the tiles processed at once. Defaults to 4096.
+    microglia : bool, optional
+        Apply the full `create_microglia_mask` pipeline (border clearing, object size
+        filters and hole filling) instead of the plain threshold. Defaults to False.
+
+    Returns
+    -------
+    numpy.memmap
+        The mask, memory-mapped from `output_path`.
+
+    Examples
+    --------
+    >>> mask = apply_li_threshold_tiled("whole_slice.tif", "whole_slice_li.npy",
+    ...                                 channel=1, channel_axis=0, tile_size=8192)
+    >>> mask = np.load("whole_slice_li.npy", mmap_mode='r')
+    """
+    image = open_tif_channel(file, channel, channel_axis)
+    if microglia:
+        return create_microglia_mask_tiled(image, output_path, tile_size=tile_size)
+
+    threshold = threshold_li_tiled(image, tile_size)
+    output = _open_output(output_path, image.shape)
+    for tile in grid_tiles(image.shape, tile_size=tile_size):
+        output[tile.slices] = np.asarray(image[tile.slices]) > threshold
+    output.flush()
+    return output
@@ -1,7 +1,16 @@
 import os
+import csv
+import time
+import errno
 import shutil
+import zlib
 import random
-from collections import defaultdict
+import traceback
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+from turmoric.instrumentation import Instrumentation, collect_stages, stage
 # from skimage.filters import try_all_threshold
 # from skimage.filters import threshold_isodata
 # from skimage.filters import threshold_li
@@ -34,12 +43,41 @@ Returns:
                from an 80:20 split from the base directory.
 """
 
-# Function to organize files into training and testing folders
-# without slice leakage
+SPLIT_MODES = ('copy', 'hardlink', 'symlink', 'manifest')
+SPLIT_MANIFEST_COLUMNS = ['group', 'condition', 'slice_id', 'file', 'split']
+
+
+def _place_file(source: str, destination: str, mode: str) -> str:
+    """
+    Copy or link `source` to `destination`, replacing any existing file.
+
+    Hard links fall back to copies when the destination is on another filesystem.
+    Module-level so that it can be run by `run_batch`.
+    """
+    if mode == 'copy':
+        shutil.copy(source, destination)
+        return destination
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(source), destination)
+        return destination
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy(source, destination)
+    return destination
 
 
+# Function to organize files into training and testing folders
+# without slice leakage
 def organize_files_without_leakage(base_dir: str, train_dir: str, test_dir: str, groups: list,
-                                   treatment_conditions: list, test_size: float=0.2) -> None:
+                                   treatment_conditions: list, test_size: float=0.2,
+                                   mode: str='copy', manifest_path: Optional[str]=None,
+                                   workers: Optional[int]=None) -> List[dict]:
     """
     Organize files into training and testing sets without data leakage across brain slices.
 
@@ -62,21 +100,45 @@ def organize_files_without_leakage(base_dir: str, train_dir: str, test_dir: str,
         List of treatment condition subfolders under each group (e.g., ["vehicle", "drug"]).
     test_size : float, optional
         Proportion of slices to use for testing. Default is 0.2 (20%).
+    mode : {'copy', 'hardlink', 'symlink', 'manifest'}, optional
+        How the split is materialized:
+
+        - `'copy'` (default) copies every file into `train_dir` and `test_dir`.
+        - `'hardlink'` and `'symlink'` create links instead, which takes no extra space
+          and no time proportional to the file sizes. Hard links fall back to copies
+          across filesystems.
+        - `'manifest'` touches no files and only writes `manifest_path`. Use
+          `split_filepaths` to list the files of each split.
+    manifest_path : str, optional
+        Write the split as a CSV with one row per file and the columns `group`,
+        `condition`, `slice_id`, `file` (relative to `base_dir`) and `split`
+        (`'train'` or `'test'`). Required with `mode='manifest'`.
+    workers : int, optional
+        Number of threads copying or linking files in parallel. `None` or `1`
+        (default) places files serially.
 
     Returns
     -------
-    None
-        The function performs file copying to organize training and testing sets
-        but does not return a value.
+    list of dict
+        One record per file, with the columns of the manifest.
+
+    Raises
+    ------
+    ValueError
+        If `mode` is unknown, or `mode='manifest'` is used without `manifest_path`.
+    OSError
+        If any file could not be copied or linked. It is raised after every other
+        file was placed, and those files only are written to `manifest_path`.
 
     Notes
     -----
     - Slice IDs are extracted from the third underscore-separated token in each filename.
       Adjust the parsing logic if your filename structure differs.
     - Files are grouped and split at the slice level, not the file level, to prevent data leakage.
-    - The train/test split is deterministic due to a fixed random seed (`random.seed(42)`).
-    - Existing files in the output directories will not be overwritten.
-    - Uses `shutil.copy` to duplicate files into the train/test directories.
+    - The train/test split is deterministic due to a fixed random seed (`random.seed(42)`),
+      and is the same in every mode.
+    - Existing files in the output directories are overwritten.
+    - Files that cannot be copied or linked are left out of the manifest.
 
     Examples
     --------
@@ -90,7 +152,22 @@ def organize_files_without_leakage(base_dir: str, train_dir: str, test_dir: str,
     processing control drugB :)
     processing treated drugA :)
     processing treated drugB :)
+
+    Split a large dataset in seconds, without duplicating it:
+
+    >>> organize_files_without_leakage(base_dir, train_dir, test_dir, groups,
+    ...                                treatment_conditions, mode='hardlink')
+    >>> organize_files_without_leakage(base_dir, None, None, groups, treatment_conditions,
+    ...                                mode='manifest', manifest_path='split.csv')
+    >>> train_files = split_filepaths('split.csv', 'train', base_dir)
     """
+    if mode not in SPLIT_MODES:
+        raise ValueError(f"mode must be one of {SPLIT_MODES}, got {mode!r}.")
+    if mode == 'manifest' and manifest_path is None:
+        raise ValueError("mode='manifest' requires a manifest_path.")
+
+    records = []
+    jobs = []
     for group in groups:
         for condition in treatment_conditions:
             condition_path = os.path.join(base_dir, group, condition)
@@ -117,22 +194,83 @@ def organize_files_without_leakage(base_dir: str, train_dir: str, test_dir: str,
             train_slices = slice_ids[:split_index]
             test_slices = slice_ids[split_index:]
 
-            # Create subdirectories for training and testing
-            train_subdir = os.path.join(train_dir, group, condition)
-            test_subdir = os.path.join(test_dir, group, condition)
-            os.makedirs(train_subdir, exist_ok=True)
-            os.makedirs(test_subdir, exist_ok=True)
+            for split, split_dir, split_slices in (('train', train_dir, train_slices),
+                                                   ('test', test_dir, test_slices)):
+                if mode != 'manifest':
+                    # Create subdirectories for training and testing
+                    subdir = os.path.join(split_dir, group, condition)
+                    os.makedirs(subdir, exist_ok=True)
+
+                for slice_id in split_slices:
+                    for file in slice_files[slice_id]:
+                        records.append({'group': group, 'condition': condition, 'slice_id': slice_id,
+                                        'file': os.path.join(group, condition, file), 'split': split})
+                        if mode != 'manifest':
+                            jobs.append((os.path.join(condition_path, file),
+                                         os.path.join(subdir, file), mode))
+
+    failed = []
+    if jobs:
+        # Copying is I/O bound, so threads are enough to keep the disks busy
+        executor = ThreadPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+        try:
+            # One job per record, in record order. Only placed files keep their record
+            placed = []
+            for record, result in zip(records, run_batch(_place_file, jobs, executor=executor)):
+                if result.ok:
+                    placed.append(record)
+                else:
+                    failed.append(f"{result.file}: {result.error.strip().splitlines()[-1]}")
+            records = placed
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    if manifest_path is not None:
+        _write_split_manifest(records, manifest_path)
+    if failed:
+        raise OSError(f"Could not place {len(failed)} file(s) in the split:\n" + "\n".join(failed))
+    return records
+
+
+def _write_split_manifest(records: List[dict], manifest_path: str) -> None:
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    os.makedirs(directory, exist_ok=True)
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SPLIT_MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def split_filepaths(manifest_path: str, split: str, base_dir: Optional[str]=None) -> list:
+    """
+    List the files of one split of a manifest written by `organize_files_without_leakage`.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path of the split manifest CSV.
+    split : {'train', 'test'}
+        Split to return.
+    base_dir : str, optional
+        Directory the manifest paths are relative to, i.e. the `base_dir` of the split.
+        If None, the relative paths are returned.
 
-            # Move files to the appropriate folders
-            for slice_id in train_slices:
-                for file in slice_files[slice_id]:
-                    shutil.copy(os.path.join(condition_path, file),
-                                os.path.join(train_subdir, file))
+    Returns
+    -------
+    list of str
+        Paths of the files in the split, in manifest order.
 
-            for slice_id in test_slices:
-                for file in slice_files[slice_id]:
-                    shutil.copy(os.path.join(condition_path, file),
-                                os.path.join(test_subdir, file))
+    Examples
+    --------
+    >>> for file in split_filepaths('split.csv', 'test', '/data/brain_slices'):
+    ...     mask = np.load(file)
+    """
+    with open(manifest_path, newline='') as f:
+        files = [row['file'] for row in csv.DictReader(f) if row['split'] == split]
+    if base_dir is None:
+        return files
+    return [os.path.join(base_dir, file) for file in files]
 
 
 def recursively_get_all_filepaths(input_folder: str, file_type: str) -> list:
@@ -159,6 +297,8 @@ def recursively_get_all_filepaths(input_folder: str, file_type: str) -> list:
     -----
     - The function performs a case-sensitive match on the file extension.
     - Subdirectories are traversed using `os.walk`.
+    - See `iter_filepaths` for a lazy variant with multiple extensions,
+      case-insensitive matching and sharding.
 
     Examples
     --------
@@ -179,3 +319,281 @@ def recursively_get_all_filepaths(input_folder: str, file_type: str) -> list:
                 file_list.append(input_path)
 
     return file_list
+
+
+def iter_filepaths(input_folder: str, file_types, case_sensitive: bool=False,
+                   sort: bool=False, shard: Optional[int]=None, num_shards: int=1) -> Iterator[str]:
+    """
+    Lazily yield the paths of all files of the given types below a directory.
+
+    Unlike `recursively_get_all_filepaths`, paths are produced while the tree is being
+    walked with `os.scandir`, so processing can start on the first file and the full
+    list is never held in memory.
+
+    Parameters
+    ----------
+    input_folder : str
+        Root directory to search for files.
+    file_types : str or iterable of str
+        One or more file endings to match (e.g. `'.tif'` or `('.tif', '.tiff')`).
+    case_sensitive : bool, optional
+        Match the endings case-sensitively. Defaults to False, so `'.tif'` also
+        matches `IMAGE.TIF`.
+    sort : bool, optional
+        Visit the entries of each directory in name order, yielding its files before
+        descending into its subfolders. The output is then reproducible across runs
+        and machines. Defaults to False (directory order).
+    shard : int, optional
+        Only yield the files of this shard, in `range(num_shards)`. Files are assigned
+        to shards by a CRC32 of their path relative to `input_folder`, so every node
+        that walks the same tree gets a disjoint, stable subset without a pre-listing
+        step.
+    num_shards : int, optional
+        Total number of shards. Defaults to 1.
+
+    Yields
+    ------
+    str
+        Full path of each matching file.
+
+    Raises
+    ------
+    FileNotFoundError
+        If `input_folder` does not exist. Subfolders that cannot be read are skipped,
+        like `os.walk` does.
+    ValueError
+        If `shard` is not in `range(num_shards)`.
+
+    Examples
+    --------
+    >>> for path in iter_filepaths('/data/tiles', ('.tif', '.tiff')):
+    ...     process(path)
+
+    Split a walk across 4 nodes, this one processing the third shard:
+
+    >>> paths = iter_filepaths('/data/tiles', '.tif', sort=True, shard=2, num_shards=4)
+    """
+    if isinstance(file_types, str):
+        file_types = (file_types,)
+    file_types = tuple(file_types)
+    if not case_sensitive:
+        file_types = tuple(file_type.lower() for file_type in file_types)
+    if shard is not None and not 0 <= shard < num_shards:
+        raise ValueError(f"shard must be in range({num_shards}), got {shard}.")
+
+    # Stack of (directory, path relative to input_folder used for sharding)
+    stack = [(os.fspath(input_folder), '')]
+    while stack:
+        directory, relative = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            if directory == os.fspath(input_folder):
+                raise
+            continue
+
+        subdirectories = []
+        with entries:
+            if sort:
+                entries = sorted(entries, key=lambda entry: entry.name)
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append((entry.path, relative + entry.name + '/'))
+                        continue
+                except OSError:
+                    continue
+
+                name = entry.name if case_sensitive else entry.name.lower()
+                if not name.endswith(file_types):
+                    continue
+                if shard is not None and zlib.crc32((relative + entry.name).encode()) % num_shards != shard:
+                    continue
+                yield entry.path
+
+        stack.extend(reversed(subdirectories))
+
+
+@dataclass
+class FileResult:
+    """
+    Outcome of processing a single file in a batch.
+
+    Attributes
+    ----------
+    file : str
+        Path of the input file.
+    value : Any
+        Return value of the per-file function (e.g. the output path), or None if it failed.
+    error : str or None
+        Formatted exception (type, message and traceback) if processing failed.
+    elapsed : float
+        Wall time in seconds spent processing the file, measured inside the worker.
+    cached : bool
+        True if the file was skipped because its output was already up to date.
+    stages : list of StageRecord
+        Timings of the stages run for the file, when `run_batch` is instrumented.
+    """
+    file: str
+    value: Any = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    cached: bool = False
+    stages: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class BatchSummary:
+    """
+    Summary of a batch run, with one `FileResult` per input file in input order.
+
+    Attributes
+    ----------
+    results : list of FileResult
+        Per-file outcomes, ordered like the input files.
+    elapsed : float
+        Total wall time of the batch in seconds.
+    """
+    results: List[FileResult] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def succeeded(self) -> List[FileResult]:
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self) -> List[FileResult]:
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def cached(self) -> List[FileResult]:
+        return [result for result in self.results if result.cached]
+
+    def __str__(self) -> str:
+        cached = len(self.cached)
+        lines = [f"{len(self.succeeded) - cached} succeeded, {len(self.failed)} failed"
+                 + (f", {cached} cached" if cached else "")
+                 + f" in {self.elapsed:.2f}s"]
+        for result in self.failed:
+            message = result.error.strip().splitlines()[-1] if result.error else ''
+            lines.append(f"  FAILED {result.file}: {message}")
+        return "\n".join(lines)
+
+
+def _timed_call(func: Callable, file: str, *args, options=None) -> FileResult:
+    """
+    Call `func(file, *args)` and wrap the outcome in a `FileResult`.
+
+    Exceptions are caught and stored on the result so that a single bad file
+    does not abort the batch. Defined at module level so it can be pickled
+    into worker processes. With the stage `options` of an `Instrumentation`,
+    the call is timed as a `'file'` stage and the records of all its stages are
+    returned on the result.
+    """
+    start = time.perf_counter()
+    stages = []
+    try:
+        if options is None:
+            value = func(file, *args)
+        else:
+            with collect_stages(options) as stages, stage('file', file):
+                value = func(file, *args)
+        error = None
+    except Exception:
+        value = None
+        error = traceback.format_exc()
+    return FileResult(file=file, value=value, error=error,
+                      elapsed=time.perf_counter() - start, stages=stages)
+
+
+def run_batch(func: Callable, items: Iterable, workers: Optional[int]=None,
+              executor: Optional[Executor]=None, max_in_flight: Optional[int]=None,
+              instrumentation: Optional[Instrumentation]=None) -> Iterator[FileResult]:
+    """
+    Apply a function to many files, optionally across a process pool.
+
+    Results are yielded lazily and in input order. At most `max_in_flight`
+    items are submitted to the executor at any time, so memory use stays bounded
+    even when `items` is a long generator.
+
+    Parameters
+    ----------
+    func : callable
+        Function called as `func(file, *args)`. Must be picklable (defined at module
+        level) when a process pool is used.
+    items : iterable
+        Either file paths, or tuples `(file, *args)` passed through to `func`.
+    workers : int, optional
+        Number of worker processes. `None` or `1` runs serially in the current process.
+    executor : concurrent.futures.Executor, optional
+        An existing executor to submit work to. Takes precedence over `workers` and is
+        not shut down by this function.
+    max_in_flight : int, optional
+        Maximum number of submitted but not yet consumed items. Defaults to twice the
+        number of workers.
+    instrumentation : Instrumentation, optional
+        If given, the stages run for each item are recorded in the worker, returned on
+        `FileResult.stages` and emitted to the sink of `instrumentation` as the results
+        are yielded (see `turmoric.instrumentation`).
+
+    Yields
+    ------
+    FileResult
+        One result per item, in the same order as `items`.
+
+    Examples
+    --------
+    >>> for result in run_batch(os.path.getsize, ['a.tif', 'b.tif'], workers=2):
+    ...     print(result.file, result.value, result.error)
+    """
+    items = ((item,) if isinstance(item, (str, os.PathLike)) else tuple(item)
+             for item in items)
+    options = instrumentation.options if instrumentation is not None else None
+
+    if executor is None and (workers is None or workers <= 1):
+        for item in items:
+            yield _emit_stages(instrumentation, _timed_call(func, *item, options=options))
+        return
+
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    if max_in_flight is None:
+        max_in_flight = 2 * (workers or getattr(executor, '_max_workers', None) or os.cpu_count() or 1)
+
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item[0], executor.submit(_timed_call, func, *item, options=options)))
+            if len(pending) >= max_in_flight:
+                yield _emit_stages(instrumentation, _collect(*pending.popleft()))
+        while pending:
+            yield _emit_stages(instrumentation, _collect(*pending.popleft()))
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if owns_executor:
+            executor.shutdown(wait=True)
+
+
+def _emit_stages(instrumentation: Optional[Instrumentation], result: FileResult) -> FileResult:
+    if instrumentation is not None:
+        instrumentation.emit(result.stages)
+    return result
+
+
+def _collect(file: str, future) -> FileResult:
+    """
+    Wait for a submitted `_timed_call` and return its result.
+
+    Failures of the executor itself (e.g. a worker process dying) are recorded
+    on the result instead of being raised.
+    """
+    try:
+        return future.result()
+    except Exception:
+        return FileResult(file=file, error=traceback.format_exc())
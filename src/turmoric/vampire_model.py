@@ -1,8 +1,50 @@
+import time
+import logging
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Union
 import numpy as np
 import pandas as pd
 import vampire
+from turmoric.utils import BatchSummary, run_batch
+from turmoric.instrumentation import Instrumentation, instrumented, stage
+
+logger = logging.getLogger(__name__)
+
+
+def _extract_dataset(img_set_path: str) -> str:
+    """
+    Extract the VAMPIRE features of one image set. Module-level so that it can be
+    sent to worker processes by `run_batch`.
+    """
+    with stage('extract_features', img_set_path):
+        vampire.extraction.extract_properties(img_set_path)
+    return img_set_path
+
+
+def _transform_dataset(img_set_path: str, model_path: str, output_path: str,
+                       img_set_name: str) -> str:
+    """
+    Apply a VAMPIRE model to one image set, i.e. one row of the apply DataFrame.
+    """
+    with stage('apply_model', img_set_path):
+        vampire.quickstart.transform_datasets(pd.DataFrame([{'img_set_path': img_set_path,
+                                                             'model_path': model_path,
+                                                             'output_path': output_path,
+                                                             'img_set_name': img_set_name}]))
+    return output_path
+
+
+def _log_results(summary: BatchSummary, action: str) -> None:
+    """
+    Log the timing or the error of every dataset of a partitioned run.
+    """
+    for result in summary.results:
+        if result.ok:
+            logger.info(f"{action} {result.file} in {result.elapsed:.1f}s")
+        else:
+            logger.error(f"{action} {result.file} failed after {result.elapsed:.1f}s:\n{result.error}")
+    logger.info(f"{action}: {summary}")
 
 
 class VampireModelTrainer:
@@ -10,7 +52,8 @@ class VampireModelTrainer:
     A class to handle VAMPIRE model training and application for brain image analysis.
     """
 
-    def __init__(self, base_path: str, treatments: List[str], groups: List[str]):
+    def __init__(self, base_path: str, treatments: List[str], groups: List[str],
+                 instrumentation: Optional[Instrumentation] = None):
         """
         Initialize the VAMPIRE model trainer.
 
@@ -18,27 +61,53 @@ class VampireModelTrainer:
             base_path: Base directory path for image data
             treatments: List of treatment conditions
             groups: List of experimental groups
+            instrumentation: Records the time of the 'extract_features',
+                'train_model' and 'apply_model' stages of every dataset
+                (see `turmoric.instrumentation`)
         """
         self.base_path = Path(base_path)
         self.treatments = treatments
         self.groups = groups
         self.model_path: Optional[Path] = None
+        self.instrumentation = instrumentation
 
         # Validate base path exists
         if not self.base_path.exists():
             raise FileNotFoundError(f"Base path does not exist: {self.base_path}")
 
-    def extract_features(self, image_set_path: Path) -> None:
+    def extract_features(self, image_set_path: Union[Path, List[Path]],
+                         workers: Optional[int] = None,
+                         executor: Optional[Executor] = None) -> Optional[BatchSummary]:
         """
         Extract features from images using VAMPIRE.
 
         Args:
-            image_set_path: Path to the image dataset
+            image_set_path: Path to the image dataset, or a list of datasets to
+                extract independently (e.g. one per group and treatment)
+            workers: With a list of datasets, number of worker processes
+                (None or 1 extracts them one after the other)
+            executor: With a list of datasets, an existing executor to use
+                instead of creating a process pool
+
+        Returns:
+            None for a single dataset. For a list, a BatchSummary with the timing
+            or error of every dataset. A failing dataset does not stop the others.
         """
+        if isinstance(image_set_path, (list, tuple)):
+            start = time.perf_counter()
+            results = run_batch(_extract_dataset, [str(path) for path in image_set_path],
+                                workers=workers, executor=executor,
+                                instrumentation=self.instrumentation)
+            summary = BatchSummary(results=list(results),
+                                   elapsed=time.perf_counter() - start)
+            _log_results(summary, "Feature extraction")
+            return summary
+
         logger.info(f"Extracting features from: {image_set_path}")
         
         try:
-            vampire.extraction.extract_properties(str(image_set_path))
+            with instrumented(self.instrumentation):
+                _extract_dataset(str(image_set_path))
             logger.info("Feature extraction completed successfully")
         except Exception as e:
             logger.error(f"Error during feature extraction: {e}")
@@ -70,7 +139,8 @@ class VampireModelTrainer:
         })
         
         try:
-            vampire.quickstart.fit_models(build_info_df)
+            with instrumented(self.instrumentation), stage('train_model', str(image_set_path)):
+                vampire.quickstart.fit_models(build_info_df)
             
             # Find the generated model file
             model_pattern = f"model_{model_name}_({num_points}_{num_clusters}_*)__.pickle"
@@ -121,23 +191,49 @@ class VampireModelTrainer:
         
         return pd.DataFrame(apply_data)
     
-    def apply_model(self, test_base_path: Path) -> None:
+    def apply_model(self, test_base_path: Path, workers: Optional[int] = None,
+                    executor: Optional[Executor] = None) -> Optional[BatchSummary]:
         """
         Apply the trained model to test datasets.
         
         Args:
             test_base_path: Base path for test datasets
+            workers: If given, the apply DataFrame is partitioned by
+                `img_set_path` and each dataset is transformed separately on a
+                pool of this many processes (1 runs them one after the other)
+            executor: An existing executor to run the partitioned datasets on,
+                instead of creating a process pool
+
+        Returns:
+            None when all datasets are transformed in one call. Otherwise, a
+            BatchSummary with the timing or error of every dataset, in the order
+            of the apply DataFrame. A failing dataset is logged and does not stop
+            the others.
         """
         if self.model_path is None:
             raise ValueError("Model must be trained before applying")
         
         logger.info(f"Applying model to test datasets in: {test_base_path}")
+
+        if workers is not None or executor is not None:
+            apply_info_df = self.create_apply_dataframe(test_base_path, self.model_path)
+            logger.info(f"Applying model to {len(apply_info_df)} datasets in parallel")
+            jobs = apply_info_df[['img_set_path', 'model_path', 'output_path',
+                                  'img_set_name']].itertuples(index=False, name=None)
+            start = time.perf_counter()
+            results = run_batch(_transform_dataset, jobs, workers=workers, executor=executor,
+                                instrumentation=self.instrumentation)
+            summary = BatchSummary(results=list(results),
+                                   elapsed=time.perf_counter() - start)
+            _log_results(summary, "Model application")
+            return summary
         
         try:
             apply_info_df = self.create_apply_dataframe(test_base_path, self.model_path)
             logger.info(f"Applying model to {len(apply_info_df)} datasets")
             
-            vampire.quickstart.transform_datasets(apply_info_df)
+            with instrumented(self.instrumentation), stage('apply_model', str(test_base_path)):
+                vampire.quickstart.transform_datasets(apply_info_df)
             logger.info("Model application completed successfully")
             
         except Exception as e:
@@ -145,13 +241,19 @@ class VampireModelTrainer:
             raise
     
     def run_full_pipeline(self, training_subpath: str = "training/vampire_data", 
-                         testing_subpath: str = "testing/vampire_data") -> None:
+                         testing_subpath: str = "testing/vampire_data",
+                         workers: Optional[int] = None) -> Optional[BatchSummary]:
         """
         Run the complete training and application pipeline.
         
         Args:
             training_subpath: Relative path to training data
             testing_subpath: Relative path to testing data
+            workers: Number of processes applying the model to the group and
+                treatment datasets in parallel (see `apply_model`)
+
+        Returns:
+            The BatchSummary of `apply_model` when run with `workers`
         """
         train_path = self.base_path / training_subpath
         test_path = self.base_path / testing_subpath
@@ -167,6 +269,10 @@ class VampireModelTrainer:
         self.train_model(train_path)
         
         # Step 3: Apply model to test data
-        self.apply_model(test_path)
+        summary = self.apply_model(test_path, workers=workers)
         
-        logger.info("Pipeline completed successfully")
\ No newline at end of file
+        if summary is not None and summary.failed:
+            logger.warning(f"Pipeline completed with {len(summary.failed)} failed datasets")
+        else:
+            logger.info("Pipeline completed successfully")
+        return summary
\ No newline at end of file
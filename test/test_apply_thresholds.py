@@ -13,6 +13,10 @@ import turmoric
 from turmoric.apply_thresholds import apply_all_thresh
 from turmoric.apply_thresholds import apply_li_threshold
 from turmoric.apply_thresholds import apply_threshold_recursively
+from turmoric.apply_thresholds import compute_all_thresholds
+from turmoric.apply_thresholds import create_microglia_mask
+from turmoric.apply_thresholds import load_threshold_masks
+from turmoric.apply_thresholds import render_threshold_comparison
 
 
 @pytest.fixture
@@ -57,8 +61,8 @@ def output_folder():
 
 @pytest.fixture
 def channel():
+    return 1
 
-    
 
 
 def test_apply_all_thresh(input_folder, output_folder, channel, figsize):
@@ -147,3 +151,310 @@ def test_apply_threshold(temp_dirs):
 
         arr = np.load(expected_path)
         assert np.array_equal(arr, np.ones((10, 10), dtype=bool))
+
+
+# Dummy threshold function that fails on a specific file
+def failing_threshold(file_path):
+    if 'image2' in file_path:
+        raise ValueError("bad tile")
+    return np.ones((10, 10), dtype=bool)
+
+
+def test_apply_threshold_workers(temp_dirs):
+    input_dir, output_dir, test_files = temp_dirs
+
+    summary = apply_threshold_recursively(
+        input_folder=input_dir,
+        output_folder=output_dir,
+        threshold_function=failing_threshold,
+        workers=2
+    )
+
+    assert len(summary.results) == len(test_files)
+    assert [os.path.basename(r.file) for r in summary.failed] == ['image2.tif']
+    assert "bad tile" in summary.failed[0].error
+    assert [os.path.basename(r.file) for r in summary.succeeded] == ['image1.tif']
+    assert all(r.elapsed >= 0 for r in summary.results)
+    assert np.array_equal(np.load(os.path.join(output_dir, 'image1.npy')),
+                          np.ones((10, 10), dtype=bool))
+
+
+def test_compute_all_thresholds_matches_skimage():
+    from skimage import data, filters
+
+    image = data.camera()
+    thresholds = compute_all_thresholds(image)
+
+    assert list(thresholds) == ['Isodata', 'Li', 'Mean', 'Minimum', 'Otsu', 'Triangle', 'Yen']
+    assert thresholds['Isodata'] == filters.threshold_isodata(image)
+    assert thresholds['Li'] == filters.threshold_li(image)
+    assert thresholds['Mean'] == filters.threshold_mean(image)
+    assert thresholds['Minimum'] == filters.threshold_minimum(image)
+    assert thresholds['Otsu'] == filters.threshold_otsu(image)
+    assert thresholds['Triangle'] == filters.threshold_triangle(image)
+    assert thresholds['Yen'] == filters.threshold_yen(image)
+
+
+def test_compute_all_thresholds_failed_method_is_nan():
+    image = np.zeros((50, 50), dtype=np.uint8)
+    image[:, 25:] = 10  # two flat levels, Minimum cannot find two peaks
+
+    thresholds = compute_all_thresholds(image)
+
+    assert np.isnan(thresholds['Minimum'])
+    assert 0 <= thresholds['Otsu'] < 10
+
+
+def test_apply_all_thresh_headless_store(input_folder, output_folder):
+    from skimage import data
+    from turmoric.mask_store import MaskStore
+
+    image = np.stack([data.camera()[:, :301]] * 3, axis=-1)
+    for i in range(3):
+        imsave(os.path.join(input_folder, f"image{i}.tif"), image, check_contrast=False)
+
+    thresholds_df = apply_all_thresh(input_folder, output_folder, channel=1,
+                                     render='sample', sample_every=2, store_masks=True)
+
+    assert len(thresholds_df) == 3
+    assert os.path.exists(os.path.join(output_folder, 'thresholds.csv'))
+    rendered = sorted(f for f in os.listdir(output_folder) if f.endswith('_all_thresh.tif'))
+    assert len(rendered) == 2
+    # One store holds the masks of every image
+    assert not any(f.endswith('.npz') for f in os.listdir(output_folder))
+    with MaskStore(os.path.join(output_folder, 'threshold_masks')) as store:
+        assert len(store.keys()) == 3 * 7
+
+    masks, thresholds = load_threshold_masks(output_folder, 'image1')
+    assert np.array_equal(masks['Otsu'], image[:, :, 1] > thresholds['Otsu'])
+    assert masks['Otsu'].shape == image.shape[:2]
+
+    assert list(thresholds_df['channel']) == [1, 1, 1]
+    # Panels are drawn from the stored thumbnail, the image is not read again
+    os.remove(os.path.join(input_folder, "image1.tif"))
+    output_path = render_threshold_comparison(output_folder, 'image1')
+    assert output_path == os.path.join(output_folder, 'image1_all_thresh.tif')
+    assert os.path.exists(output_path)
+
+
+def test_apply_all_thresh_reruns_keep_earlier_rows():
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        images = {}
+        for name in ("image1", "image2"):
+            images[name] = rng.integers(0, 255, (40, 40), dtype=np.uint8)
+            folder = os.path.join(input_dir, name)
+            os.makedirs(folder)
+            imsave(os.path.join(folder, f"{name}.tif"), images[name], check_contrast=False)
+            apply_all_thresh(folder, output_dir, channel=0, render='none', store_masks=True)
+        # A rerun of the first folder replaces its row
+        rerun = apply_all_thresh(os.path.join(input_dir, "image1"), output_dir, channel=0,
+                                 render='none', store_masks=True)
+
+        assert list(rerun['name']) == ['image1']
+        table = pd.read_csv(os.path.join(output_dir, 'thresholds.csv'))
+        assert sorted(table['name']) == ['image1', 'image2']
+        for name, image in images.items():
+            masks, thresholds = load_threshold_masks(output_dir, name)
+            assert np.array_equal(masks['Otsu'], image > thresholds['Otsu'])
+            assert os.path.exists(render_threshold_comparison(output_dir, name))
+
+
+def test_apply_all_thresh_default_writes_only_figures():
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        image = np.random.default_rng(0).integers(0, 255, (60, 60, 3), dtype=np.uint8)
+        imsave(os.path.join(input_dir, "image.tif"), image, check_contrast=False)
+
+        assert apply_all_thresh(input_dir, output_dir, channel=1) is None
+        assert os.listdir(output_dir) == ["image_all_thresh.tif"]
+
+
+def test_apply_li_threshold_reads_file_once(input_folder, monkeypatch):
+    import tifffile
+    import turmoric.image_process
+
+    image = np.zeros((40, 40, 3), dtype=np.uint8)
+    image[20:, :, 1] = 200
+    image_path = os.path.join(input_folder, "image.tif")
+    tifffile.imwrite(image_path, image)
+
+    calls = []
+
+    def counting(func):
+        def wrapper(*args, **kwargs):
+            calls.append(args)
+            return func(*args, **kwargs)
+        return wrapper
+
+    # Pixels are decoded either by tifffile.imread or by read_tif_channel
+    monkeypatch.setattr(tifffile, "imread", counting(tifffile.imread))
+    monkeypatch.setattr(turmoric.image_process, "read_tif_channel",
+                        counting(turmoric.image_process.read_tif_channel))
+    binary = apply_li_threshold(image_path, channel=1)
+
+    assert len(calls) == 1
+    assert binary.shape == (40, 40)
+    assert binary[20:].all() and not binary[:20].any()
+
+
+def test_apply_li_threshold_tiff_extension():
+    import tifffile
+
+    image = np.zeros((40, 40, 3), dtype=np.uint8)
+    image[20:, :, 1] = 200
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_path = os.path.join(temp_dir, "image.TIFF")
+        tifffile.imwrite(image_path, image)
+        binary = apply_li_threshold(image_path, channel=1)
+
+    assert binary.shape == (40, 40)
+    assert binary[20:].all() and not binary[:20].any()
+
+
+def test_apply_threshold_mask_store(temp_dirs):
+    from turmoric.mask_store import MaskStore
+    from turmoric.cell_analysis import apply_regionprops_recursively
+
+    input_dir, output_dir, test_files = temp_dirs
+    store_path = os.path.join(output_dir, 'masks')
+
+    summary = apply_threshold_recursively(input_dir, threshold_function=dummy_threshold,
+                                          mask_store=store_path, workers=2)
+
+    assert not summary.failed
+    with MaskStore(store_path) as store:
+        assert sorted(store.keys()) == sorted(os.path.splitext(f)[0] for f in test_files)
+        assert np.array_equal(store.read('image1'), np.ones((10, 10), dtype=bool))
+
+    props_df = apply_regionprops_recursively(store_path, ('area',))
+    assert sorted(props_df['filename']) == sorted(os.path.splitext(f)[0] for f in test_files)
+    assert (props_df['area'] == 100).all()
+
+
+def counting_threshold(file_path):
+    with open(file_path + '.calls', 'a') as f:
+        f.write('x')
+    return np.ones((10, 10), dtype=bool)
+
+
+def test_apply_threshold_cache(temp_dirs):
+    input_dir, output_dir, test_files = temp_dirs
+
+    def calls(file):
+        path = os.path.join(input_dir, file + '.calls')
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    first = apply_threshold_recursively(input_dir, output_dir, counting_threshold, cache=True)
+    assert not first.cached and len(first.succeeded) == 2
+
+    # Unchanged inputs are skipped
+    second = apply_threshold_recursively(input_dir, output_dir, counting_threshold, cache=True)
+    assert len(second.cached) == 2
+    assert [calls(f) for f in test_files] == [1, 1]
+
+    # A modified input is recomputed, a removed input has its output evicted
+    with open(os.path.join(input_dir, 'image1.tif'), 'ab') as f:
+        f.write(b'more data')
+    os.remove(os.path.join(input_dir, 'subdir/image2.tif'))
+    third = apply_threshold_recursively(input_dir, output_dir, counting_threshold, cache=True)
+    assert [r.cached for r in third.results] == [False]
+    assert calls('image1.tif') == 2
+    assert not os.path.exists(os.path.join(output_dir, 'subdir/image2.npy'))
+
+    # A different threshold function invalidates the cache
+    fourth = apply_threshold_recursively(input_dir, output_dir, dummy_threshold, cache=True)
+    assert not fourth.cached and len(fourth.succeeded) == 1
+
+
+def _legacy_microglia_mask(image, threshold_method, large_object_size, min_object_size):
+    # The multi-pass pipeline from scripts/apply_single_threshold.py, with the
+    # strict `min_size` semantics of the pinned scikit-image 0.25
+    import inspect
+    from scipy import ndimage
+    from skimage.measure import label
+    from skimage.morphology import remove_small_objects
+    from skimage.segmentation import clear_border
+
+    def remove_smaller_than(ar, min_size):
+        if 'max_size' in inspect.signature(remove_small_objects).parameters:
+            return remove_small_objects(ar, max_size=min_size - 1)
+        return remove_small_objects(ar, min_size=min_size)
+
+    thresh_li = threshold_method(image)
+    objects = clear_border(label(image > thresh_li))
+    large_objects = remove_smaller_than(objects, large_object_size)
+    small_objects = label((objects ^ large_objects) > thresh_li)
+    return ndimage.binary_fill_holes(remove_smaller_than(small_objects > thresh_li, min_object_size))
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+@pytest.mark.parametrize("seed", range(6))
+def test_create_microglia_mask_matches_legacy(seed):
+    from scipy import ndimage
+    from skimage import filters
+
+    rng = np.random.default_rng(seed)
+    image = ndimage.gaussian_filter(rng.random((120, 150)), sigma=1 + seed / 2)
+    if seed % 2:
+        image = (image * 1000).astype(np.uint16)
+    threshold_method = [filters.threshold_li, filters.threshold_otsu,
+                        lambda im: np.percentile(im, 40)][seed % 3]
+
+    for large_object_size, min_object_size in ((50000, 500), (400, 5), (60, 2)):
+        expected = _legacy_microglia_mask(image, threshold_method,
+                                          large_object_size, min_object_size)
+        result = create_microglia_mask(image, threshold_method,
+                                       large_object_size, min_object_size)
+        assert result.dtype == bool
+        assert np.array_equal(result, expected)
+
+
+def test_apply_threshold_reads_nd2_directly(temp_dirs, monkeypatch):
+    import turmoric.image_process
+
+    input_dir, output_dir, _ = temp_dirs
+    image = np.zeros((2, 40, 40), dtype=np.uint16)
+    image[1, 20:] = 2000
+    monkeypatch.setattr(turmoric.image_process, 'read_nd2_channel',
+                        lambda file, channel=None, position=None: image[channel])
+    for name in ("image.nd2", "image.tif"):
+        open(os.path.join(input_dir, name), 'wb').close()
+
+    summary = apply_threshold_recursively(input_dir, output_dir, file_types=('.nd2',))
+
+    assert [os.path.basename(result.file) for result in summary.succeeded] == ["image.nd2"]
+    mask = np.load(os.path.join(output_dir, "image.npy"))
+    assert mask[20:].all() and not mask[:20].any()
+
+
+def test_multi_position_nd2_needs_a_position(temp_dirs, monkeypatch):
+    from functools import partial
+    import turmoric.image_process
+
+    input_dir, output_dir, _ = temp_dirs
+    stack = np.zeros((3, 2, 64, 64), dtype=np.uint8)  # (P, C, Y, X)
+    stack[:, 1, 20:40, 20:40] = 200
+
+    def read_nd2_channel(file, channel=None, position=None):
+        return stack[:, channel] if position is None else stack[position, channel]
+
+    monkeypatch.setattr(turmoric.image_process, 'read_nd2_channel', read_nd2_channel)
+    file = os.path.join(input_dir, "slice1.nd2")
+    open(file, 'wb').close()
+
+    with pytest.raises(ValueError, match="Set 'position'"):
+        apply_li_threshold(file)
+    assert apply_li_threshold(file, position=2).sum() == 400
+
+    summary = apply_threshold_recursively(input_dir, output_dir, file_types=('.nd2',))
+    assert len(summary.failed) == 1 and "Set 'position'" in str(summary.failed[0].error)
+    summary = apply_threshold_recursively(input_dir, output_dir, partial(apply_li_threshold, position=2),
+                                          file_types=('.nd2',))
+    assert len(summary.succeeded) == 1
+
+    with pytest.raises(ValueError, match="Set 'position'"):
+        apply_all_thresh(input_dir, output_dir, render='none', file_types=('.nd2',))
+    thresholds = apply_all_thresh(input_dir, output_dir, render='none', file_types=('.nd2',), position=2)
+    assert list(thresholds['name']) == ['slice1']
@@ -0,0 +1,46 @@
+import os
+import tempfile
+from functools import partial
+from turmoric.cache import CacheManifest, function_key
+
+
+def threshold(file, channel=1):
+    return file
+
+
+def test_function_key_changes_with_parameters():
+    assert function_key(threshold) == function_key(threshold)
+    assert function_key(threshold, channel=1) != function_key(threshold, channel=2)
+    assert function_key(partial(threshold, channel=2)) == function_key(threshold, channel=2)
+
+
+def test_manifest_fresh_and_hash_contents():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file = os.path.join(temp_dir, 'image.tif')
+        output = os.path.join(temp_dir, 'image.npy')
+        for path in (file, output):
+            with open(path, 'wb') as f:
+                f.write(b'data')
+
+        manifest_path = os.path.join(temp_dir, 'manifest.json')
+        manifest = CacheManifest(manifest_path, 'key', hash_contents=True)
+        assert not manifest.is_fresh('image.tif', file)
+        manifest.record('image.tif', file, output)
+        manifest.save()
+
+        manifest = CacheManifest(manifest_path, 'key', hash_contents=True)
+        assert manifest.is_fresh('image.tif', file)
+        assert not CacheManifest(manifest_path, 'other').is_fresh('image.tif', file)
+
+        # Touching the file keeps it fresh when comparing contents
+        stat = os.stat(file)
+        os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert manifest.is_fresh('image.tif', file)
+        assert not CacheManifest(manifest_path, 'key').is_fresh('image.tif', file)
+
+        with open(file, 'wb') as f:
+            f.write(b'DATA')
+        assert not manifest.is_fresh('image.tif', file)
+
+        assert manifest.evict([], remove=os.remove) == [output]
+        assert not os.path.exists(output) and len(manifest) == 0
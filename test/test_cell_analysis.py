@@ -10,6 +10,7 @@ import numpy as np
 import turmoric
 from turmoric.cell_analysis import apply_regionprops
 from turmoric.cell_analysis import apply_regionprops_recursively
+from turmoric.cell_analysis import read_regionprops_table
 
 
 def test_apply_regionprops(input_folder, properties_list):
@@ -71,4 +72,124 @@ def test_apply_regionprops_recursively(input_folder, properties_list):
 #     if not isinstance(channel, int) or channel < 0:
 #         raise ValueError("channel must be a non-negative integer")
 #     if not isinstance(properties_list, list):
-#         raise TypeError("properties_list must be a list of strings") 
\ No newline at end of file
+#         raise TypeError("properties_list must be a list of strings") 
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet"])
+def test_apply_regionprops_recursively_streaming(extension):
+    if extension == ".parquet":
+        pytest.importorskip("pyarrow")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i in range(4):
+            mask = np.zeros((60, 60), dtype=bool)
+            mask[5:5 + 10 * (i + 1), 5:15] = True
+            mask[40:50, 40:50] = True
+            np.save(os.path.join(temp_dir, f"image{i}_li_thresh.npy"), mask)
+
+        expected = apply_regionprops_recursively(temp_dir, ('area', 'perimeter'))
+        output_path = os.path.join(temp_dir, "props" + extension)
+        result = apply_regionprops_recursively(temp_dir, ('area', 'perimeter'),
+                                               workers=2, output_path=output_path)
+
+        assert result == output_path
+        written = pd.read_csv(output_path) if extension == ".csv" else pd.read_parquet(output_path)
+        assert len(written) == 8
+        written['filename'] = written['filename'].astype(object)
+        pd.testing.assert_frame_equal(written[['area', 'perimeter', 'filename']],
+                                      expected[['area', 'perimeter', 'filename']],
+                                      check_dtype=False)
+
+
+def test_parquet_output_is_dictionary_encoded():
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i in range(3):
+            mask = np.zeros((30, 30), dtype=bool)
+            mask[2:8, 2:8] = mask[12:20, 12:20] = True
+            np.save(os.path.join(temp_dir, f"image{i}_li_thresh.npy"), mask)
+
+        output_path = os.path.join(temp_dir, "props.parquet")
+        apply_regionprops_recursively(temp_dir, ('area',), output_path=output_path,
+                                      treatment='OGD')
+
+        schema = pq.read_schema(output_path)
+        assert pa.types.is_dictionary(schema.field('filename').type)
+        assert pa.types.is_dictionary(schema.field('treatment').type)
+
+        df = read_regionprops_table(output_path, columns=['area', 'treatment'])
+        assert list(df.columns) == ['area', 'treatment']
+        assert len(df) == 6
+        assert isinstance(df['treatment'].dtype, pd.CategoricalDtype)
+        assert (df['treatment'] == 'OGD').all()
+
+
+def test_measure_directory_matches_two_pass_pipeline():
+    import functools
+    import tifffile
+    from turmoric.apply_thresholds import apply_li_threshold
+    from turmoric.cell_analysis import measure_directory
+    from turmoric.synthetic import synthetic_microglia_image
+
+    properties = ('area', 'perimeter', 'centroid')
+    threshold = functools.partial(apply_li_threshold, channel=1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_folder = os.path.join(temp_dir, "images", "slice1")
+        os.makedirs(image_folder)
+        for seed, extension in enumerate((".tif", ".tif", ".TIF")):
+            image = np.moveaxis(synthetic_microglia_image((200, 200), density=200, seed=seed), 0, -1)
+            tifffile.imwrite(os.path.join(image_folder, f"image{seed}{extension}"), image)
+
+        mask_folder = os.path.join(temp_dir, "masks")
+        df = measure_directory(os.path.join(temp_dir, "images"), threshold, properties,
+                               mask_folder=mask_folder, treatment="control")
+        expected = apply_regionprops_recursively(mask_folder, properties)
+
+        assert set(df['treatment']) == {"control"}
+        # Endings match case-sensitively, as in apply_threshold_recursively
+        assert set(df['filename']) == {os.path.join(image_folder, f"image{seed}.tif") for seed in range(2)}
+        assert os.path.exists(os.path.join(mask_folder, "slice1", "image0_li_thresh.npy"))
+        df = df.sort_values(['filename', 'centroid-0', 'centroid-1'], ignore_index=True)
+        expected = expected.sort_values(['filename', 'centroid-0', 'centroid-1'], ignore_index=True)
+        assert np.array_equal(df[list(expected.columns[:-1])].to_numpy(),
+                              expected[list(expected.columns[:-1])].to_numpy())
+
+        # Without a mask folder only the table is written
+        output = os.path.join(temp_dir, "regionprops.csv")
+        assert measure_directory(os.path.join(temp_dir, "images"), threshold, properties,
+                                 output_path=output) == output
+        assert len(read_regionprops_table(output)) == len(df)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_fast_regionprops_match_skimage(seed):
+    from skimage.measure import label, regionprops_table
+    from turmoric.cell_analysis import FAST_PROPERTIES, _regionprops_table
+
+    label_image = label(np.random.default_rng(seed).random((123, 97)) > 0.6)
+    label_image[label_image == 3] = 0  # regionprops skips missing labels
+    properties = [name for name in FAST_PROPERTIES if name not in ('circularity', 'aspect_ratio')]
+    properties += ['solidity', 'eccentricity']  # measured by skimage
+    fast = _regionprops_table(label_image, properties)
+    expected = regionprops_table(label_image, properties=properties)
+
+    assert list(fast) == list(expected)
+    for column in expected:
+        assert fast[column].dtype == expected[column].dtype
+        np.testing.assert_allclose(fast[column], expected[column], rtol=1e-10, atol=1e-10)
+
+
+def test_derived_shape_metrics():
+    mask = np.zeros((20, 20), dtype=bool)
+    mask[2:8, 2:14] = True
+    mask[15, 15] = True  # a single pixel has no perimeter
+    from turmoric.cell_analysis import measure_mask
+
+    df = measure_mask(mask, ['area', 'perimeter', 'circularity', 'aspect_ratio'], 'mask')
+
+    assert list(df.columns) == ['area', 'perimeter', 'circularity', 'aspect_ratio', 'filename']
+    assert df['circularity'][0] == pytest.approx(4 * np.pi * 72 / df['perimeter'][0] ** 2)
+    assert df['aspect_ratio'][0] > 1
+    assert np.isnan(df['circularity'][1]) and np.isnan(df['aspect_ratio'][1])
@@ -10,6 +10,12 @@ import turmoric
 from turmoric.image_process import load_npy_file
 from turmoric.image_process import normalize_npy_data
 from turmoric.image_process import nd2_to_tif
+from turmoric.image_process import nd2_to_tif_streaming
+from turmoric.image_process import batch_nd2_to_tif, conversion_throughput, JOURNAL_FILE
+from turmoric.image_process import read_image, read_nd2_channel, register_reader, get_reader, READERS
+from turmoric.image_process import load_tif_file
+from turmoric.image_process import read_tif_metadata
+from turmoric.image_process import read_tif_channel
 
 def test_load_npy_file():
     # Create a temporary directory with a dummy .npy file
@@ -82,4 +88,208 @@ def test_nd2_to_tif():
         assert tif_data.shape == sample_data.shape, "TIFF data shape should match original data shape"
         assert np.all(tif_data >= 0) and np.all(tif_data <= 255), "TIFF data should be in [0, 255] range"
         # Clean up the temporary .nd2 file
-        os.remove(nd2_path)
\ No newline at end of file
+        os.remove(nd2_path)
+
+
+def test_load_tif_file_validates_from_metadata():
+    import tifffile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image = np.random.randint(0, 255, (20, 30, 3), dtype=np.uint8)
+        tif_path = os.path.join(temp_dir, "sample.tif")
+        tifffile.imwrite(tif_path, image)
+
+        metadata = read_tif_metadata(tif_path)
+        assert metadata['shape'] == (20, 30, 3)
+        assert metadata['dtype'] == np.uint8
+
+        assert np.array_equal(load_tif_file(tif_path, channel=2), image[:, :, 2])
+        assert np.array_equal(load_tif_file(tif_path), image)
+        with pytest.raises(ValueError):
+            load_tif_file(tif_path, channel=3)
+        with pytest.raises(FileNotFoundError):
+            load_tif_file(os.path.join(temp_dir, "missing.tif"), channel=0)
+
+
+@pytest.mark.parametrize("shape, channel_axis, kwargs", [
+    ((3, 64, 80), 0, {'photometric': 'rgb', 'planarconfig': 'separate'}),  # planar samples
+    ((3, 64, 80), 0, {'photometric': 'rgb', 'planarconfig': 'separate',
+                      'compression': 'zlib', 'tile': (32, 32)}),  # planar, tiled
+    ((4, 64, 80), 0, {'photometric': 'minisblack'}),  # one page per channel
+    ((64, 80, 3), -1, {}),  # interleaved RGB, memory-mapped
+    ((64, 80, 3), -1, {'compression': 'zlib', 'rowsperstrip': 16}),  # interleaved, strips
+])
+def test_read_tif_channel_matches_full_read(shape, channel_axis, kwargs):
+    import tifffile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image = np.random.randint(0, 4000, shape).astype(np.uint16)
+        tif_path = os.path.join(temp_dir, "stack.tif")
+        tifffile.imwrite(tif_path, image, **kwargs)
+
+        full = tifffile.imread(tif_path)
+        for channel in range(3):
+            expected = np.take(full, channel, axis=channel_axis)
+            assert np.array_equal(read_tif_channel(tif_path, channel, channel_axis), expected)
+
+
+class _FakeND2File:
+    """Minimal stand-in for `nd2.ND2File` that serves frames from an array."""
+
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+        self.dtype = data.dtype
+        self.is_rgb = 'S' in sizes
+        self.is_legacy = True
+        loop_axes = [axis for axis in sizes if axis not in 'CYXS']
+        self.loop_indices = [dict(zip(loop_axes, index)) for index in np.ndindex(*data.shape[:len(loop_axes)])]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def read_frame(self, index):
+        return self.data[tuple(self.loop_indices[index].values())]
+
+    def voxel_size(self):
+        from types import SimpleNamespace
+        return SimpleNamespace(x=0.5, y=0.5, z=1.0)
+
+
+@pytest.mark.parametrize("sizes, kwargs", [
+    ({'T': 3, 'C': 2, 'Y': 300, 'X': 500}, {'compression': 'zlib'}),  # tiled, padded edge tiles
+    ({'T': 2, 'P': 2, 'C': 2, 'Y': 64, 'X': 80}, {'tile': None}),  # one strip per plane
+    ({'T': 2, 'Y': 40, 'X': 48, 'S': 3}, {'tile': (32, 32)}),  # RGB
+])
+def test_nd2_to_tif_streaming_matches_asarray(monkeypatch, sizes, kwargs):
+    import tifffile
+
+    data = np.random.randint(0, 4000, tuple(sizes.values())).astype(np.uint16)
+    monkeypatch.setattr(turmoric.image_process, 'ND2File', lambda path: _FakeND2File(data, sizes))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tif_path = nd2_to_tif_streaming("sample.nd2", os.path.join(temp_dir, "sample.tif"),
+                                        ome=False, **kwargs)
+        with tifffile.TiffFile(tif_path) as tif:
+            assert tif.is_bigtiff
+            assert tif.pages[0].is_tiled == (kwargs.get('tile', (512, 512)) is not None)
+            assert np.array_equal(tif.asarray(), data)
+
+
+def test_batch_nd2_to_tif_resumes_from_journal(monkeypatch):
+    import tifffile
+
+    sizes = {'T': 2, 'C': 2, 'Y': 64, 'X': 80}
+    data = np.random.randint(0, 4000, tuple(sizes.values())).astype(np.uint16)
+    converted = []
+
+    def fake_nd2_file(path):
+        if path.endswith("broken.nd2"):
+            raise ValueError("corrupt file")
+        converted.append(os.path.basename(path))
+        return _FakeND2File(data, sizes)
+
+    monkeypatch.setattr(turmoric.image_process, 'ND2File', fake_nd2_file)
+
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        os.makedirs(os.path.join(input_dir, "slice1"))
+        for name in ("a.nd2", "slice1/b.nd2", "slice1/broken.nd2"):
+            with open(os.path.join(input_dir, name), 'wb') as f:
+                f.write(b'\0' * 100)
+
+        summary = batch_nd2_to_tif(input_dir, output_dir, tile=None, ome=False)
+        assert [os.path.basename(result.file) for result in summary.failed] == ["broken.nd2"]
+        assert np.array_equal(tifffile.imread(os.path.join(output_dir, "slice1", "b.tif")), data)
+        # Failed conversions leave neither a partial output nor a temporary directory
+        assert sorted(os.listdir(os.path.join(output_dir, "slice1"))) == ["b.tif"]
+
+        stats = conversion_throughput(summary)
+        assert list(stats) == [os.getpid()]
+        assert stats[os.getpid()]['files'] == 2
+        assert stats[os.getpid()]['frames'] == 4
+        assert stats[os.getpid()]['megabytes'] == pytest.approx(200 / 1e6)
+
+        # Simulate a crash: one output lost and a truncated line at the end of the journal
+        os.remove(os.path.join(output_dir, "a.tif"))
+        with open(os.path.join(output_dir, JOURNAL_FILE), 'a') as f:
+            f.write('{"input": "slice1/bro')
+        converted.clear()
+        summary = batch_nd2_to_tif(input_dir, output_dir, tile=None, ome=False)
+        assert converted == ["a.nd2"]  # opened once, frames are counted while converting
+        assert [os.path.basename(result.file) for result in summary.cached] == ["b.nd2"]
+        assert os.path.exists(os.path.join(output_dir, "a.tif"))
+
+        converted.clear()
+        batch_nd2_to_tif(input_dir, output_dir, resume=False, tile=None, ome=False)
+        assert sorted(set(converted)) == ["a.nd2", "b.nd2"]
+
+
+def test_read_nd2_channel_reads_only_selected_frames(monkeypatch):
+    sizes = {'T': 2, 'P': 3, 'C': 2, 'Y': 16, 'X': 20}
+    data = np.random.randint(0, 4000, tuple(sizes.values())).astype(np.uint16)
+    fake = _FakeND2File(data, sizes)
+    frames_read = []
+    read_frame = fake.read_frame
+    fake.read_frame = lambda index: frames_read.append(index) or read_frame(index)
+    monkeypatch.setattr(turmoric.image_process, 'ND2File', lambda path: fake)
+
+    image = read_image("slice1.ND2", channel=1, position=2)
+    assert np.array_equal(image, data[:, 2, 1])
+    assert [fake.loop_indices[index]['P'] for index in frames_read] == [2, 2]
+
+    assert np.array_equal(read_nd2_channel("slice1.nd2"), data)
+    assert np.array_equal(read_nd2_channel("slice1.nd2", channel=0), data[:, :, 0])
+    with pytest.raises(ValueError):
+        read_nd2_channel("slice1.nd2", channel=2)
+    with pytest.raises(ValueError):
+        read_nd2_channel("slice1.nd2", position=3)
+
+
+def test_register_reader(monkeypatch):
+    monkeypatch.setattr(turmoric.image_process, 'READERS', dict(READERS))
+
+    @register_reader('.ome.tif')
+    def read_ome(file, channel=None, channel_axis=-1, position=None):
+        return np.full((2, 2), channel)
+
+    assert get_reader("a/b.OME.TIF") is read_ome
+    assert get_reader("a/b.tif") is READERS['.tif']
+    assert np.array_equal(read_image("b.ome.tif", channel=3), np.full((2, 2), 3))
+    with pytest.raises(ValueError, match="No reader registered"):
+        read_image("b.czi")
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint16, np.int64, np.float32, np.float64])
+def test_normalize_npy_data_chunked_into_out(dtype):
+    rng = np.random.default_rng(0)
+    data = (rng.random((301, 257)) * 2000 - 500).astype(dtype)
+    data64 = data.astype(np.float64)
+    expected = np.floor((data64 - data64.min()) * 255 / np.ptp(data64)).astype(np.uint8)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        npy_path = os.path.join(temp_dir, "labels.npy")
+        np.save(npy_path, data)
+        mapped = np.load(npy_path, mmap_mode='r')
+
+        out = np.empty(data.shape, dtype=np.uint8)
+        result = normalize_npy_data(mapped, out=out, chunk_size=1000)
+        del mapped
+
+    # Integers are scaled exactly, floats in float32 may differ by one level at bin edges
+    tolerance = 1 if np.issubdtype(dtype, np.floating) else 0
+    assert result is out
+    assert np.abs(out.astype(int) - expected).max() <= tolerance
+    assert np.array_equal(normalize_npy_data(data), out)
+    assert out.min() == 0 and out.max() == 255
+
+
+def test_normalize_npy_data_edge_cases():
+    uint8_data = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    assert normalize_npy_data(uint8_data) is uint8_data
+    assert np.array_equal(normalize_npy_data(np.full((4, 4), 7.5)), np.zeros((4, 4), dtype=np.uint8))
+    assert np.array_equal(normalize_npy_data(np.array([-30000, 0, 30000], dtype=np.int16)), [0, 127, 255])
+    with pytest.raises(ValueError):
+        normalize_npy_data(np.zeros((4, 4)), out=np.empty((4, 4), dtype=np.float32))
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+from turmoric.apply_thresholds import apply_threshold_recursively
+from turmoric.cell_analysis import apply_regionprops_recursively
+from turmoric.instrumentation import (Instrumentation, JSONLinesSink, MemorySink, stage,
+                                      summarize_stages)
+
+
+def _write_masks(folder, count=2):
+    rng = np.random.default_rng(0)
+    masks = [rng.random((64, 80)) > 0.6 for _ in range(count)]
+    for index, mask in enumerate(masks):
+        np.save(os.path.join(folder, f"image{index}_li_thresh.npy"), mask)
+    return masks
+
+
+def test_stage_is_inert_outside_an_instrumented_run():
+    with stage('read', 'image.tif') as record:
+        record.pixels = 10
+    assert record.seconds == 0.0
+    assert record.peak_memory is None
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_regionprops_stages(workers):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        masks = _write_masks(temp_dir)
+        sink = MemorySink()
+        df = apply_regionprops_recursively(temp_dir, ('area',), workers=workers,
+                                           instrumentation=Instrumentation(sink, run='test'))
+        expected = apply_regionprops_recursively(temp_dir, ('area',))
+
+    pd.testing.assert_frame_equal(df, expected)
+    assert {record.stage for record in sink.records} == {'file', 'read', 'label', 'regionprops', 'concat'}
+    assert all(record.run == 'test' and record.seconds > 0 for record in sink.records)
+    reads = sink.stages('read')
+    assert [record.parent for record in reads] == ['file', 'file']
+    assert sorted(record.bytes_read for record in reads) == [mask.nbytes for mask in masks]
+    assert all(record.pixels == 64 * 80 for record in sink.stages('label'))
+    if workers:
+        assert {record.pid for record in reads} != {os.getpid()}
+
+
+def test_threshold_stages_to_json_lines_with_profiling():
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_dir = os.path.join(temp_dir, 'images')
+        os.makedirs(input_dir)
+        for index in range(2):
+            tifffile.imwrite(os.path.join(input_dir, f'image{index}.tif'),
+                             rng.integers(0, 255, (50, 60, 3), dtype=np.uint8))
+        timings = os.path.join(temp_dir, 'timings.jsonl')
+        profiles = os.path.join(temp_dir, 'profiles')
+        with Instrumentation(JSONLinesSink(timings), profile=('li_threshold',),
+                             trace_memory=('threshold',), profile_dir=profiles) as instrumentation:
+            summary = apply_threshold_recursively(input_dir, os.path.join(temp_dir, 'masks'),
+                                                  instrumentation=instrumentation)
+        assert not summary.failed
+
+        summary_df = summarize_stages(timings)
+        assert set(summary_df.index) == {'file', 'threshold', 'read', 'li_threshold', 'write'}
+        assert summary_df.loc['read', 'count'] == 2
+        assert summary_df.loc['read', 'pixels'] == 2 * 50 * 60
+        assert summary_df.loc['write', 'bytes_written'] == sum(
+            os.path.getsize(result.value) for result in summary.results)
+
+        stages = [result.stages for result in summary.results]
+        threshold = [record for records in stages for record in records if record.stage == 'threshold']
+        assert all(record.traced_peak > 0 for record in threshold)
+        profiled = [record.profile for records in stages for record in records if record.profile]
+        assert len(profiled) == 2 and all(os.path.isfile(path) for path in profiled)
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+from scipy import ndimage
+
+pytest.importorskip("dask")
+
+from turmoric.apply_thresholds import apply_li_threshold
+from turmoric.cell_analysis import apply_regionprops
+from turmoric.lazy import imread_lazy
+from turmoric.lazy import run_lazy_pipeline
+
+
+@pytest.fixture
+def image_folder():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, "slice1"))
+        for i in range(3):
+            image = ndimage.gaussian_filter(rng.random((90, 100, 3)), (3, 3, 0))
+            tifffile.imwrite(os.path.join(temp_dir, "slice1", f"image{i}.tif"),
+                             (image * 1000).astype(np.uint16), photometric="rgb")
+        yield temp_dir
+
+
+def test_imread_lazy_selects_channel(image_folder):
+    file = os.path.join(image_folder, "slice1", "image0.tif")
+    image = imread_lazy(file, channel=2)
+    assert image.shape == (90, 100)
+    assert np.array_equal(image.compute(), tifffile.imread(file)[..., 2])
+
+
+def test_run_lazy_pipeline_matches_eager(image_folder):
+    properties = ('area', 'perimeter')
+    df = run_lazy_pipeline(image_folder, channel=1, properties_list=properties,
+                           scheduler='synchronous')
+
+    file = os.path.join(image_folder, "slice1", "image1.tif")
+    with tempfile.TemporaryDirectory() as mask_dir:
+        mask_file = os.path.join(mask_dir, "mask.npy")
+        np.save(mask_file, apply_li_threshold(file, channel=1))
+        expected = apply_regionprops(mask_file, list(properties))
+
+    assert df['filename'].nunique() == 3
+    result = df[df['filename'] == file].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result[list(properties)], expected[list(properties)])
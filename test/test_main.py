@@ -0,0 +1,106 @@
+import os
+import json
+import tempfile
+import pytest
+import tifffile
+from turmoric.cell_analysis import read_regionprops_table
+from turmoric.main import load_config, main, run_pipeline, stage_order
+from turmoric.synthetic import synthetic_microglia_image
+
+
+def _write_images(folder):
+    for index, treatment in enumerate(('control', 'ogd')):
+        os.makedirs(os.path.join(folder, 'raw', treatment))
+        image = synthetic_microglia_image((256, 256), density=150, seed=index)
+        tifffile.imwrite(os.path.join(folder, 'raw', treatment, 'image1.tif'), image, photometric='minisblack')
+
+
+def _config(folder, **stages):
+    config = {"input_folder": "raw", "output_folder": "results", "workers": 1,
+              "stages": stages or {"threshold": {"method": "li"}, "measure": {"properties": ["area", "perimeter"]},
+                                   "aggregate": {}, "plot": {}}}
+    path = os.path.join(folder, 'pipeline.json')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def test_stage_order():
+    assert stage_order(['plot', 'aggregate', 'measure', 'threshold']) == ['threshold', 'measure', 'aggregate', 'plot']
+    assert sorted(stage_order(['threshold', 'convert'])) == ['convert', 'threshold']
+
+
+def test_load_config_resolves_and_validates():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = load_config(_config(temp_dir))
+        assert config['input_folder'] == os.path.join(temp_dir, 'raw')
+        assert config['stages']['threshold']['channel'] == 1
+        assert config['file_types'] == ['.tif']
+
+        with pytest.raises(ValueError, match="needs the output"):
+            load_config(_config(temp_dir, measure={}))
+        with pytest.raises(ValueError, match="Unknown options"):
+            load_config(_config(temp_dir, threshold={"sigma": 2}))
+        with pytest.raises(ValueError, match="Unknown stage"):
+            load_config(_config(temp_dir, skeletonize={}))
+
+
+def test_run_pipeline_skips_up_to_date_stages():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        _write_images(temp_dir)
+        path = _config(temp_dir)
+
+        first = run_pipeline(path)
+        assert first.order == ['threshold', 'measure', 'aggregate', 'plot']
+        assert first.ran == {'threshold': 2, 'measure': 2, 'aggregate': 1, 'plot': 1}
+        assert set(first.table['treatment']) == {'control', 'ogd'}
+        results = os.path.join(temp_dir, 'results')
+        assert os.path.exists(os.path.join(results, 'regionprops.csv'))
+        assert os.path.exists(os.path.join(results, 'tables', 'ogd', 'image1.csv'))
+        assert not os.path.exists(os.path.join(results, 'masks'))
+
+        again = run_pipeline(path)
+        assert again.ran == {'threshold': 0, 'measure': 0, 'aggregate': 0, 'plot': 0}
+
+        image = synthetic_microglia_image((256, 256), density=150, seed=5)
+        tifffile.imwrite(os.path.join(temp_dir, 'raw', 'ogd', 'image1.tif'), image, photometric='minisblack')
+        assert run_pipeline(path, dry_run=True).ran == {'threshold': 1, 'measure': 1, 'aggregate': 1, 'plot': 1}
+        changed = run_pipeline(path)
+        assert changed.ran == {'threshold': 1, 'measure': 1, 'aggregate': 1, 'plot': 1}
+        assert len(changed.table) != len(first.table)
+
+        os.remove(os.path.join(temp_dir, 'raw', 'control', 'image1.tif'))
+        removed = run_pipeline(path)
+        assert removed.ran['aggregate'] == 1
+        assert set(removed.table['treatment']) == {'ogd'}
+        assert not os.path.exists(os.path.join(results, 'tables', 'control', 'image1.csv'))
+
+        assert main([path, '--force']) == 0
+
+
+def test_multi_position_nd2_needs_a_position(monkeypatch):
+    import numpy as np
+    import turmoric.image_process
+
+    stack = np.zeros((3, 2, 64, 64), dtype=np.uint8)  # (P, C, Y, X)
+    stack[:, 1, 20:40, 20:40] = 200
+
+    def read_nd2_channel(file, channel=None, position=None):
+        return stack[:, channel] if position is None else stack[position, channel]
+
+    monkeypatch.setattr(turmoric.image_process, 'read_nd2_channel', read_nd2_channel)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, 'raw'))
+        open(os.path.join(temp_dir, 'raw', 'slice1.nd2'), 'wb').close()
+        stages = {"threshold": {"method": "li"}, "measure": {"properties": ["area"]}}
+        config = {"input_folder": os.path.join(temp_dir, 'raw'), "output_folder": os.path.join(temp_dir, 'results'),
+                  "file_types": [".nd2"], "stages": stages}
+
+        run = run_pipeline(config)
+        assert len(run.summary.failed) == 1
+        assert "Set 'position'" in str(run.summary.failed[0].error)
+
+        stages["threshold"]["position"] = 2
+        run = run_pipeline(config)
+        assert len(run.summary.succeeded) == 1
+        assert list(read_regionprops_table(os.path.join(temp_dir, 'results', 'tables', 'slice1.csv'))['area']) == [400]
@@ -0,0 +1,84 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from turmoric.mask_store import MaskStore, is_mask_store, pack_mask, unpack_mask
+
+
+def test_pack_unpack_roundtrip():
+    mask = np.random.rand(17, 29) > 0.5
+    packed, shape = pack_mask(mask)
+
+    assert packed.shape == (17, 4)
+    assert np.array_equal(unpack_mask(packed, shape[1]), mask)
+
+
+def test_mask_store_append_and_read():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store_path = os.path.join(temp_dir, "masks")
+        masks = {f"slice{i}/image{i}": np.random.rand(30 + i, 45) > 0.7 for i in range(3)}
+
+        with MaskStore(store_path, mode='a') as store:
+            for name, mask in masks.items():
+                store.append(name, mask)
+        assert is_mask_store(store_path)
+
+        # Reopen for appending, later records replace earlier ones
+        replacement = np.ones((5, 9), dtype=bool)
+        with MaskStore(store_path, mode='a') as store:
+            store.append("slice0/image0", replacement)
+        masks["slice0/image0"] = replacement
+
+        with MaskStore(store_path) as store:
+            assert store.keys() == list(masks)
+            for name, mask in masks.items():
+                assert store.shape(name) == mask.shape
+                assert np.array_equal(store.read(name), mask)
+            packed = store.read_packed("slice1/image1")
+            assert isinstance(packed.base, np.memmap) or isinstance(packed, np.memmap)
+            assert np.array_equal(store.read("slice2/image2", rows=slice(3, 10)),
+                                  masks["slice2/image2"][3:10])
+
+
+def test_mask_store_missing():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with pytest.raises(FileNotFoundError):
+            MaskStore(os.path.join(temp_dir, "missing"))
+
+
+def test_mask_store_records_are_not_padded():
+    rng = np.random.default_rng(0)
+    masks = [rng.random((10, 10)) > 0.5 for _ in range(100)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with MaskStore(temp_dir, mode='a') as store:
+            for index, mask in enumerate(masks):
+                store.append(f'mask{index}', mask)
+        # 10 rows of 2 packed bytes per mask
+        assert os.path.getsize(os.path.join(temp_dir, 'masks.bin')) == 100 * 20
+        store = MaskStore(temp_dir)
+        for index, mask in enumerate(masks):
+            assert np.array_equal(store.read(f'mask{index}'), mask)
+        store.close()
+
+
+def test_mask_store_ignores_truncated_index_line():
+    first = np.eye(12, dtype=bool)
+    second = ~first
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with MaskStore(temp_dir, mode='a') as store:
+            store.append('first', first)
+        # A crash halfway through writing the index line of a second append
+        with open(os.path.join(temp_dir, 'masks.bin'), 'ab') as f:
+            f.write(pack_mask(second)[0].tobytes())
+        with open(os.path.join(temp_dir, 'index.jsonl'), 'a') as f:
+            f.write('{"name": "second", "off')
+
+        with MaskStore(temp_dir) as store:
+            assert store.keys() == ['first']
+            assert np.array_equal(store.read('first'), first)
+
+        with MaskStore(temp_dir, mode='a') as store:
+            store.append('second', second)
+        with MaskStore(temp_dir) as store:
+            assert store.keys() == ['first', 'second']
+            assert np.array_equal(store.read('second'), second)
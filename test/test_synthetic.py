@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from skimage.filters import threshold_li
+from skimage.measure import label
+from turmoric.apply_thresholds import create_microglia_mask
+from turmoric.synthetic import synthetic_microglia_image
+
+
+def test_synthetic_image_is_deterministic():
+    first = synthetic_microglia_image((256, 300), seed=3)
+    second = synthetic_microglia_image((256, 300), seed=3)
+    assert first.shape == (3, 256, 300)
+    assert first.dtype == np.uint8
+    assert np.array_equal(first, second)
+    assert not np.array_equal(first, synthetic_microglia_image((256, 300), seed=4))
+
+
+def test_synthetic_image_channels_and_density():
+    image, somas = synthetic_microglia_image((512, 512), n_channels=4, channel=2, density=80,
+                                             dtype=np.uint16, return_somas=True)
+    assert image.shape == (4, 512, 512)
+    assert image.dtype == np.uint16
+    assert len(somas) == round(80 * 512 * 512 / 1_000_000)
+    # The cell channel is the brightest, followed by the nuclei
+    assert image[2].mean() > image[3].mean() > image[0].mean()
+
+    single = synthetic_microglia_image((64, 64), n_channels=1, channel=0)
+    assert single.shape == (64, 64)
+    with pytest.raises(ValueError):
+        synthetic_microglia_image((64, 64), n_channels=2, channel=2)
+
+
+def test_synthetic_cells_are_segmented():
+    image, somas = synthetic_microglia_image((1024, 1024), density=60, return_somas=True)
+    li_mask = image[1] > threshold_li(image[1])
+    rows, cols = np.round(somas).astype(int).clip(0, 1023).T
+    assert li_mask[rows, cols].mean() > 0.9
+    assert label(create_microglia_mask(image[1])).max() > 0
@@ -0,0 +1,121 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+import tifffile
+from scipy import ndimage
+from skimage import filters
+from skimage.segmentation import clear_border
+from turmoric.apply_thresholds import create_microglia_mask
+from turmoric.cell_analysis import measure_mask
+from turmoric.mask_store import MaskStore
+from turmoric.tiled import apply_li_threshold_tiled
+from turmoric.tiled import create_microglia_mask_tiled
+from turmoric.tiled import grid_tiles, iter_tiles
+from turmoric.tiled import threshold_li_tiled
+from turmoric.tiled import write_tiles, tile_regionprops
+
+
+def test_threshold_li_tiled_matches_skimage():
+    rng = np.random.default_rng(0)
+    image = (ndimage.gaussian_filter(rng.random((90, 110)), 2) * 4000).astype(np.uint16)
+    assert threshold_li_tiled(image, tile_size=32) == pytest.approx(filters.threshold_li(image))
+
+
+@pytest.mark.parametrize("tile_size", [7, 32, 500])
+def test_create_microglia_mask_tiled_matches_whole_image(tile_size):
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for seed in range(4):
+            image = ndimage.gaussian_filter(rng.random((100, 130)), 1 + seed / 2)
+            threshold = np.percentile(image, 50)
+            expected = create_microglia_mask(image, lambda im: threshold, 2000, 10)
+
+            output_path = os.path.join(temp_dir, f"mask{seed}.npy")
+            mask = create_microglia_mask_tiled(image, output_path, threshold=threshold,
+                                               tile_size=tile_size, large_object_size=2000,
+                                               min_object_size=10)
+            assert expected.any()
+            assert np.array_equal(np.load(output_path), expected)
+            del mask
+
+
+def test_apply_li_threshold_tiled_reads_channel():
+    rng = np.random.default_rng(2)
+    stack = (rng.random((3, 80, 90)) * 300).astype(np.uint16)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file = os.path.join(temp_dir, "stack.tif")
+        tifffile.imwrite(file, stack, photometric="minisblack")
+        output_path = os.path.join(temp_dir, "mask.npy")
+
+        apply_li_threshold_tiled(file, output_path, channel=1, channel_axis=0, tile_size=25)
+        assert np.array_equal(np.load(output_path), stack[1] > filters.threshold_li(stack[1]))
+
+
+def _random_mask(shape=(301, 257), seed=0):
+    return np.random.default_rng(seed).random(shape) > 0.7
+
+
+def test_grid_matches_array_split_quadrants():
+    mask = _random_mask()
+    quada, quadb = np.array_split(mask, 2)
+    expected = [*np.array_split(quada, 2, axis=1), *np.array_split(quadb, 2, axis=1)]
+
+    tiles = list(iter_tiles(mask, grid=(2, 2), clear_border=True))
+    assert [tile.number for tile, _ in tiles] == [1, 2, 3, 4]
+    for (tile, data), quad in zip(tiles, expected):
+        assert np.array_equal(data, clear_border(quad))
+
+
+def test_tiles_are_views_of_a_memory_map():
+    mask = _random_mask()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "mask.npy")
+        np.save(path, mask)
+        mapped = np.load(path, mmap_mode='r')
+        for tile, data in iter_tiles(mapped, tile_size=(100, 64)):
+            assert np.shares_memory(data, mapped)
+            assert np.array_equal(data, mask[tile.slices])
+        del mapped, data
+
+
+@pytest.mark.parametrize("kwargs", [{'grid': (3, 4)}, {'tile_size': 100, 'overlap': 8}])
+def test_tiles_cover_the_mask(kwargs):
+    shape = (301, 257)
+    covered = np.zeros(shape, dtype=int)
+    tiles = grid_tiles(shape, **kwargs)
+    for tile in tiles:
+        covered[tile.slices] += 1
+    assert covered.min() >= 1
+    if 'grid' in kwargs:
+        assert covered.max() == 1
+        assert len(tiles) == 12
+    else:
+        assert covered.max() == 4  # corners shared by four overlapping tiles
+        assert tiles[0].slices == (slice(0, 108), slice(0, 108))
+
+
+def test_grid_tiles_requires_one_layout():
+    with pytest.raises(ValueError):
+        grid_tiles((10, 10))
+    with pytest.raises(ValueError):
+        grid_tiles((10, 10), grid=(2, 2), tile_size=5)
+
+
+def test_write_tiles_and_tile_regionprops():
+    mask = _random_mask(seed=1)
+    properties = ('area', 'centroid')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with MaskStore(temp_dir, mode='a') as store:
+            names = write_tiles(mask, store, 'slice1/image1', grid=(2, 3))
+        store = MaskStore(temp_dir)
+        assert store.keys() == names
+        assert names[4] == 'slice1/image1_tile1_1'
+
+        df = tile_regionprops(mask, grid=(2, 3), properties_list=properties, filename='image1')
+        for tile, data in iter_tiles(mask, grid=(2, 3), clear_border=True):
+            assert np.array_equal(store.read(f'slice1/image1_tile{tile.row}_{tile.col}'), data)
+            expected = measure_mask(data, list(properties), 'image1')
+            rows = df[(df['tile_row'] == tile.row) & (df['tile_col'] == tile.col)]
+            assert np.array_equal(rows[expected.columns].to_numpy(), expected.to_numpy())
+        store.close()
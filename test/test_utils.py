@@ -9,6 +9,9 @@ import numpy as np
 import turmoric
 from turmoric.utils import organize_files_without_leakage
 from turmoric.utils import recursively_get_all_filepaths
+from turmoric.utils import iter_filepaths
+from turmoric.utils import run_batch
+from turmoric.utils import split_filepaths
 
 
 def test_organize_files_without_leakage(input_folder, output_folder):
@@ -66,4 +69,103 @@ def test_recursively_get_all_filepaths_invalid_input():
     with pytest.raises(FileNotFoundError):
         recursively_get_all_filepaths("/non/existent/path", "txt")  # Non-existent path
 #     """
-#     Recursively retrieve all file paths of a specific type from a directory.
\ No newline at end of file
+#     Recursively retrieve all file paths of a specific type from a directory.
+
+
+def test_run_batch_ordered_with_errors():
+    files = [str(i) for i in range(20)]
+    results = list(run_batch(int, files + ['not a number'], workers=3, max_in_flight=4))
+
+    assert [r.file for r in results] == files + ['not a number']
+    assert [r.value for r in results[:-1]] == list(range(20))
+    assert not results[-1].ok and 'ValueError' in results[-1].error
+
+
+def test_iter_filepaths_extensions_sort_and_shards():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        names = ['b.tif', 'A.TIF', 'c.tiff', 'notes.txt', 'sub/d.tif', 'sub/deeper/e.Tif']
+        for name in names:
+            path = os.path.join(temp_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        def relative(paths):
+            return [os.path.relpath(path, temp_dir).replace(os.sep, '/') for path in paths]
+
+        found = relative(iter_filepaths(temp_dir, ('.tif', '.tiff'), sort=True))
+        assert found == ['A.TIF', 'b.tif', 'c.tiff', 'sub/d.tif', 'sub/deeper/e.Tif']
+        assert relative(iter_filepaths(temp_dir, '.tif', case_sensitive=True, sort=True)) == \
+            ['b.tif', 'sub/d.tif']
+
+        shards = [relative(iter_filepaths(temp_dir, ('.tif', '.tiff'), sort=True,
+                                          shard=i, num_shards=3)) for i in range(3)]
+        assert sorted(sum(shards, [])) == sorted(found)
+        assert shards == [relative(iter_filepaths(temp_dir, ('.tif', '.tiff'), sort=True,
+                                                  shard=i, num_shards=3)) for i in range(3)]
+
+    with pytest.raises(ValueError):
+        next(iter_filepaths(temp_dir, '.tif', shard=3, num_shards=3))
+    with pytest.raises(FileNotFoundError):
+        next(iter_filepaths('/non/existent/path', '.tif'))
+
+
+@pytest.mark.parametrize("mode, workers", [('copy', 4), ('hardlink', None), ('symlink', 2)])
+def test_organize_files_links_and_manifest(mode, workers):
+    with tempfile.TemporaryDirectory() as base_dir, tempfile.TemporaryDirectory() as out_dir:
+        condition_path = os.path.join(base_dir, "female", "HC")
+        os.makedirs(condition_path)
+        for slice_number in range(10):
+            for image in range(2):
+                with open(os.path.join(condition_path, f"P14_F_Slice{slice_number}_{image}.npy"), 'w') as f:
+                    f.write(f"{slice_number} {image}")
+
+        train_dir, test_dir = os.path.join(out_dir, "train"), os.path.join(out_dir, "test")
+        manifest_path = os.path.join(out_dir, "split.csv")
+        records = organize_files_without_leakage(base_dir, train_dir, test_dir, ["female"], ["HC"],
+                                                 mode=mode, manifest_path=manifest_path,
+                                                 workers=workers)
+
+        # The split does not depend on the mode, and keeps each slice in one set
+        manifest_records = organize_files_without_leakage(base_dir, None, None, ["female"], ["HC"],
+                                                          mode='manifest',
+                                                          manifest_path=manifest_path)
+        assert manifest_records == records
+        train = {os.path.basename(file) for file in split_filepaths(manifest_path, 'train')}
+        test = {os.path.basename(file) for file in split_filepaths(manifest_path, 'test')}
+        assert len(train) == 16 and len(test) == 4
+        assert not {file.split("_")[2] for file in train} & {file.split("_")[2] for file in test}
+
+        assert set(os.listdir(os.path.join(train_dir, "female", "HC"))) == train
+        for file in split_filepaths(manifest_path, 'test', base_dir):
+            placed = os.path.join(test_dir, "female", "HC", os.path.basename(file))
+            with open(placed) as f, open(file) as g:
+                assert f.read() == g.read()
+            assert os.path.islink(placed) == (mode == 'symlink')
+            assert os.path.samefile(placed, file) == (mode != 'copy')
+
+    with pytest.raises(ValueError):
+        organize_files_without_leakage("base", None, None, [], [], mode='manifest')
+
+
+def test_organize_files_reports_failed_placements(monkeypatch):
+    import turmoric.utils
+
+    def place_file(source, destination, mode):
+        if "Slice0" in source:
+            raise PermissionError("read-only")
+        return destination
+
+    monkeypatch.setattr(turmoric.utils, '_place_file', place_file)
+    with tempfile.TemporaryDirectory() as base_dir, tempfile.TemporaryDirectory() as out_dir:
+        condition_path = os.path.join(base_dir, "female", "HC")
+        os.makedirs(condition_path)
+        for slice_number in range(5):
+            open(os.path.join(condition_path, f"P14_F_Slice{slice_number}_0.npy"), 'w').close()
+
+        manifest_path = os.path.join(out_dir, "split.csv")
+        with pytest.raises(OSError, match="Could not place 1 file"):
+            organize_files_without_leakage(base_dir, os.path.join(out_dir, "train"),
+                                           os.path.join(out_dir, "test"), ["female"], ["HC"],
+                                           manifest_path=manifest_path)
+        placed = split_filepaths(manifest_path, 'train') + split_filepaths(manifest_path, 'test')
+        assert len(placed) == 4 and not any("Slice0" in file for file in placed)